@@ -3,17 +3,66 @@
 mijnahlib package
 
 Imports all parts from mijnahlib here
+
+The objects are imported lazily on first access so that importing the
+package does not load requests or numpy until they are actually needed.
 """
+import sys
+from importlib import import_module
+
 from ._version import __version__
 from .mijnahlibexceptions import (InvalidCredentials,
                                   UnknownServerError,
-                                  NoAuthRedirect)
-
-from .mijnahlib import Server
+                                  NoAuthRedirect,
+                                  CircuitOpenError)
 
 __author__ = '''Costas Tyfoxylos'''
 __email__ = '''costas.tyf@gmail.com'''
 
+# The module every lazily imported object lives in.
+LAZY_OBJECTS = {'Server': '.mijnahlib',
+                'DescriptionResolver': '.mijnahlibresolver',
+                'ProductCache': '.mijnahlibcache',
+                'SessionStore': '.mijnahlibcache',
+                'StoreDirectoryCache': '.mijnahlibcache',
+                'StoreIndex': '.mijnahlibgeo',
+                'StoreTable': '.mijnahlibgeo',
+                'WriteBehindQueue': '.mijnahlibqueue',
+                'Instrumentation': '.mijnahlibmetrics',
+                'PriceHistory': '.mijnahlibhistory',
+                'ServerPool': '.mijnahlibpool',
+                'RetryPolicy': '.mijnahlibretry',
+                'CircuitBreaker': '.mijnahlibretry'}
+
+if sys.version_info >= (3, 5):
+    LAZY_OBJECTS['AsyncServer'] = '.mijnahlibasync'
+
+__all__ = ['__version__',
+           'InvalidCredentials',
+           'UnknownServerError',
+           'NoAuthRedirect',
+           'CircuitOpenError'] + sorted(LAZY_OBJECTS)
+
+
+def __getattr__(name):
+    module = LAZY_OBJECTS.get(name)
+    if module is None:
+        raise AttributeError('module {!r} has no attribute {!r}'.format(
+            __name__, name))
+    value = getattr(import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(LAZY_OBJECTS))
+
+
+# Module level __getattr__ is only supported from python 3.7 onwards.
+if sys.version_info < (3, 7):  # pragma: no cover
+    for _name in LAZY_OBJECTS:
+        __getattr__(_name)
+
 # This is to 'use' the module(s), so lint doesn't complain
 assert __version__
 
@@ -21,6 +70,4 @@ assert __version__
 assert InvalidCredentials
 assert UnknownServerError
 assert NoAuthRedirect
-
-# assert objects
-assert Server
+assert CircuitOpenError
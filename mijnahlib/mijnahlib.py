@@ -8,12 +8,33 @@ Put your classes here
 """
 
 import logging
-from requests import Session
-from bs4 import BeautifulSoup as Bfs
-
+import re
+import threading
+import time
+import weakref
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from operator import attrgetter
+
+try:
+    from html.parser import HTMLParser
+except ImportError:  # pragma: no cover
+    from HTMLParser import HTMLParser
+
+try:
+    from urllib.parse import quote
+except ImportError:  # pragma: no cover
+    from urllib import quote
+
+from .mijnahlibcache import ProductCache, StoreDirectoryCache
+from .mijnahlibhours import OpeningHoursIndex, parse_opening_hours
+from .mijnahlibmetrics import endpoint_name
+from .mijnahlibresolver import DescriptionResolver, normalize
+from .mijnahlibstream import iter_lane_items
 from .mijnahlibexceptions import (InvalidCredentials,
                                   UnknownServerError,
-                                  NoAuthRedirect)
+                                  NoAuthRedirect,
+                                  CircuitOpenError)
 
 __author__ = '''Costas Tyfoxylos <costas.tyf@gmail.com>'''
 __docformat__ = 'plaintext'
@@ -25,174 +46,719 @@ LOGGER = logging.getLogger(LOGGER_BASENAME)
 LOGGER.addHandler(logging.NullHandler())
 
 LOGIN_ERROR_MESSAGE = 'Het e-mailadres en/of wachtwoord is onjuist'
+LOGIN_PATH = '/mijn/inloggen'
+
+# The internal product ids look like 'wi382975', anything else submitted in
+# bulk is treated as a free text description.
+PRODUCT_ID_PATTERN = re.compile(r'^wi\d+$')
+
+# The opening tag of the element holding the error notices of a page.
+ERROR_NOTICES_PATTERN = re.compile(r'<div[^>]*\sclass=["\'][^"\']*'
+                                   r'\berror_notices\b')
+
+# The size of the keep-alive connection pool of the session, this caps the
+# number of concurrent requests that can reuse connections.
+CONNECTION_POOL_SIZE = 10
+DEFAULT_WORKERS = 8
+
+# How long the contents of the shopping cart are served without asking the
+# server again. Local additions invalidate them immediately.
+DEFAULT_CART_TTL = 60
+
+# The size of the chunks the shopping list is read in when streaming.
+STREAM_CHUNK_SIZE = 16 * 1024
+
+CartDiff = namedtuple('CartDiff', ('added', 'removed', 'changed'))
+
+ItemSubmission = namedtuple('ItemSubmission', ('item',
+                                               'quantity',
+                                               'success',
+                                               'status_code',
+                                               'error'))
+
+SyncReport = namedtuple('SyncReport', ('added',
+                                       'updated',
+                                       'removed',
+                                       'unchanged'))
 
 
 class Server(object):
     """Object modeling the server connection.
     
     Handles the authentication and exposes all the internal parts as 
-    attributes.
+    attributes. Authentication is deferred until the first request that
+    needs it and is renewed once when the server reports the session as
+    expired. If a session store is provided a stored session is resumed
+    instead of logging in, as long as the server still accepts it. A store
+    directory cache can be shared between servers, by default every server
+    keeps its own copy of the stores. The contents of the shopping cart are
+    cached for cart_ttl seconds. If an instrumentation object is provided
+    every request of the session is recorded by it. Failed requests are
+    retried according to the retry policy and endpoints that keep failing
+    are cut off by the circuit breaker, which can be shared between servers.
+    A transport adapter can replace the default one to record, replay or
+    fake the interactions with the server. Product details are looked up
+    through the products catalogue, backed by a product cache that can be
+    shared between servers. Descriptions are resolved to products by the
+    resolver, which learns the products seen in the cart and the catalogue
+    and can be shared between servers as well.
     """
-    def __init__(self, username, password):
+    def __init__(self,
+                 username,
+                 password,
+                 session_store=None,
+                 store_cache=None,
+                 cart_ttl=DEFAULT_CART_TTL,
+                 instrumentation=None,
+                 retry_policy=None,
+                 circuit_breaker=None,
+                 transport=None,
+                 product_cache=None,
+                 resolver=None):
         logger_name = '{base}.{suffix}'.format(base=LOGGER_BASENAME,
                                                suffix=self.__class__.__name__)
         self._logger = logging.getLogger(logger_name)
+        # requests is only loaded once a server is created so that the models
+        # can be used without paying for its import.
+        from requests import Session
+        from requests.adapters import HTTPAdapter
+        from .mijnahlibretry import CircuitBreaker, RetryPolicy
         self.username = username
         self.password = password
         self.session = Session()
+        self.session.mount('https://',
+                           transport or HTTPAdapter(
+                               pool_maxsize=CONNECTION_POOL_SIZE))
         self.url = 'https://www.ah.nl'
-        self._authenticate()
-        self.shopping_cart = ShoppingCart(self)
+        self.instrumentation = instrumentation
+        if instrumentation:
+            instrumentation.attach(self.session)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self._session_store = session_store
+        self._authenticated = False
+        self._authentication_lock = threading.Lock()
+        self._authentication_generation = 0
+        self.shopping_cart = ShoppingCart(self, cart_ttl)
+        self.products = ProductCatalogue(self, product_cache or ProductCache())
+        self.resolver = resolver or DescriptionResolver()
+        if self.resolver.search is None:
+            self.resolver.search = self.products.search
+        self._store_cache = store_cache or StoreDirectoryCache(ttl=None)
+        self._stores_payload = None
         self._stores = None
-        self._services = None
+        self._service_index = None
+        self._opening_hours = None
+
+    def _ensure_authenticated(self):
+        if not self._authenticated:
+            with self._authentication_lock:
+                if not self._authenticated:
+                    if not self._resume_session():
+                        self._authenticate()
+                    self._authenticated = True
+        return self._authentication_generation
+
+    def _reauthenticate(self, generation):
+        # Only the first of the callers that saw the session expire logs in
+        # again, the rest wait on the lock and reuse the new session.
+        with self._authentication_lock:
+            if generation == self._authentication_generation:
+                self._logger.info('Session of %s expired, authenticating',
+                                  self.username)
+                self.session.cookies.clear()
+                self._authenticate()
+                self._authenticated = True
+                self._authentication_generation += 1
+
+    @staticmethod
+    def _is_expired(response):
+        if response.status_code in (401, 403):
+            return True
+        locations = [entry.headers.get('location', '')
+                     for entry in response.history]
+        return any(LOGIN_PATH in location for location in locations)
+
+    def _request(self, method, url, **kwargs):
+        """Performs an authenticated request on the session
+
+        Authenticates if needed and replays the request once if the session
+        turned out to be expired.
+
+        :param method: The http method of the request
+        :param url: The url of the request
+        :param kwargs: The keyword arguments are passed to the session
+        :return: The response object
+        """
+        generation = self._ensure_authenticated()
+        response = self._send(method, url, **kwargs)
+        if self._is_expired(response):
+            self._reauthenticate(generation)
+            response = self._send(method, url, **kwargs)
+        return response
+
+    def _send(self, method, url, **kwargs):
+        """Performs a request on the session applying the retry policy
+
+        :param method: The http method of the request
+        :param url: The url of the request
+        :param kwargs: The keyword arguments are passed to the session
+        :raises CircuitOpenError: If the endpoint is failing and cut off
+        :return: The response object
+        """
+        from requests.exceptions import RequestException
+        endpoint = endpoint_name(method, url)
+        attempt = 0
+        while True:
+            self.circuit_breaker.before(endpoint)
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except RequestException as error:
+                self.circuit_breaker.failure(endpoint)
+                if (attempt >= self.retry_policy.max_retries or
+                        not self.retry_policy.is_retryable(method,
+                                                           error=error)):
+                    raise
+                delay = self.retry_policy.backoff(attempt)
+                self._logger.warning('Request to %s failed with %s, '
+                                     'retrying in %.2fs', endpoint, error,
+                                     delay)
+            else:
+                if response.status_code >= 500:
+                    self.circuit_breaker.failure(endpoint)
+                else:
+                    self.circuit_breaker.success(endpoint)
+                if (attempt >= self.retry_policy.max_retries or
+                        not self.retry_policy.is_retryable(
+                            method, response=response)):
+                    return response
+                delay = self.retry_policy.backoff(attempt, response)
+                self._logger.warning('Request to %s got status %s, '
+                                     'retrying in %.2fs', endpoint,
+                                     response.status_code, delay)
+                response.close()
+            attempt += 1
+            if self.instrumentation:
+                self.instrumentation.record_retry(endpoint)
+            time.sleep(delay)
+
+    def _resume_session(self):
+        if not self._session_store:
+            return False
+        cookies = self._session_store.load(self.username)
+        if cookies is None:
+            return False
+        self.session.cookies.update(cookies)
+        if self._is_authenticated():
+            self._logger.debug('Resumed stored session of %s', self.username)
+            return True
+        self._logger.debug('Stored session of %s is no longer valid',
+                           self.username)
+        self.session.cookies.clear()
+        self._session_store.clear(self.username)
+        return False
+
+    def _is_authenticated(self):
+        url = '{base}/mijn'.format(base=self.url)
+        response = self._send('GET', url, allow_redirects=False)
+        location = response.headers.get('location', '')
+        return response.ok and LOGIN_PATH not in location
 
     def _authenticate(self):
         data = {'userName': self.username,
                 'password': self.password,
                 'rememberUser': True}
-        url = '{base}/mijn/inloggen/basis'.format(base=self.url)
-        response = self.session.post(url, data=data)
+        url = '{base}{login}/basis'.format(base=self.url, login=LOGIN_PATH)
+        response = self._send('POST', url, data=data)
         # at this point we don't have enough information to know what went
         # wrong if we didn't get a valid response.
         if not response.ok:
             raise UnknownServerError(response.text)
-        soup = Bfs(response.text, 'html.parser')
-        # we did not login successfully
-        if LOGIN_ERROR_MESSAGE in response.text:
-            error = soup.find('div', {'class': 'error_notices'}).text
-            raise InvalidCredentials(error)
-        # we try to get the redirect we are provided with the history headers
-        try:
-            redirect = response.history[0].headers.get('location')
-            if not redirect:
-                raise NoAuthRedirect
-            success_url = '{base}{redirect}'.format(base=self.url,
-                                                    redirect=redirect)
-            self.session.get(success_url)
-            return True
-        except IndexError:
+        # a successful login is redirected, so the page only needs to be
+        # looked at when there is no redirect.
+        redirect = (response.history[0].headers.get('location')
+                    if response.history else None)
+        if not redirect:
+            # we did not login successfully
+            if LOGIN_ERROR_MESSAGE in response.text:
+                raise InvalidCredentials(extract_error_notice(response.text))
             raise NoAuthRedirect
+        success_url = '{base}{redirect}'.format(base=self.url,
+                                                redirect=redirect)
+        self._send('GET', success_url)
+        if self._session_store:
+            self._session_store.save(self.username, self.session.cookies)
+        return True
 
     @property
     def stores(self):
-        if not self._stores:
-            url = ('{base}/data/winkelinformatie/winkels/'
-                   'json').format(base=self.url)
-            response = self.session.get(url)
-            data = response.json()
-            # self._services = [Service(values)
-            #                   for name, values in data.get('services').items()
-            #                   ]
-            self._stores = [Store(info) for info in data.get('stores')]
+        """The stores of the chain
+
+        :return: A list of store objects
+        """
+        self._load_stores()
         return self._stores
 
+    @property
+    def services(self):
+        """The services offered in the stores of the chain
 
-# TODO implement the service and bind it with store object.
-class Service(object):
-    def __init__(self):
-        pass
+        :return: A list of service objects
+        """
+        self._load_stores()
+        return list(self._service_index.services.values())
 
+    @property
+    def opening_hours(self):
+        """The index of the stores of the chain by their opening hours
 
-class Store(object):
-    def __init__(self, info):
-        self._info = info
+        :return: An OpeningHoursIndex object
+        """
+        self._load_stores()
+        return self._opening_hours
 
     @property
-    def _format(self):
-        return self._info.get('format')
+    def service_index(self):
+        """The index of the stores of the chain by the services they offer
 
-    @property
-    def city(self):
-        return self._info.get('city')
+        :return: A ServiceIndex object
+        """
+        self._load_stores()
+        return self._service_index
+
+    def _load_stores(self):
+        url = ('{base}/data/winkelinformatie/winkels/'
+               'json').format(base=self.url)
+        data = self._store_cache.get(self._send, url)
+        if data is not self._stores_payload:
+            self._stores = [Store(info) for info in data.get('stores')]
+            services = [Service(code, info) for code, info
+                        in (data.get('services') or {}).items()]
+            self._service_index = ServiceIndex(services, self._stores)
+            self._opening_hours = OpeningHoursIndex(self._stores)
+            self._stores_payload = data
 
-    @property
-    def street(self):
-        return self._info.get('street')
 
-    @property
-    def street_number(self):
-        return self._info.get('housenr')
+class _ErrorNoticeParser(HTMLParser):  # pylint: disable=abstract-method
+    """Collects the text of the first element it is fed"""
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.depth = 0
+        self.done = False
+        self.text = []
 
-    @property
-    def zip_code(self):
-        return self._info.get('zip')
+    def handle_starttag(self, tag, attrs):
+        if tag == 'div' and not self.done:
+            self.depth += 1
 
-    @property
-    def address(self):
-        return u'{street} {nr} {zip} {city}'.format(street=self.street,
-                                                    nr=self.street_number,
-                                                    zip=self.zip_code,
-                                                    city=self.city)
+    def handle_endtag(self, tag):
+        if tag == 'div' and not self.done:
+            self.depth -= 1
+            self.done = self.depth <= 0
 
-    @property
-    def telephone(self):
-        return self._info.get('phoneNumber')
+    def handle_data(self, data):
+        if self.depth and not self.done:
+            self.text.append(data)
 
-    @property
-    def opening_times_today(self):
-        return self._info.get('status')
 
-    @property
-    def latitude(self):
-        return self._info.get('lat')
+def extract_error_notice(page):
+    """Extracts the text of the error notices of a page
 
-    @property
-    def longtitude(self):
-        return self._info.get('lng')
+    Only the div with the error_notices class is parsed instead of the
+    whole page.
+
+    :param page: The html of the page
+    :return: The text of the error notices or the login error message if
+    they could not be found
+    """
+    match = ERROR_NOTICES_PATTERN.search(page)
+    if match is None:
+        return LOGIN_ERROR_MESSAGE
+    start = match.start()
+    # the parser is fed up to every closing div until the notices are done
+    parser = _ErrorNoticeParser()
+    while not parser.done and start < len(page):
+        end = page.find('</div>', start)
+        end = len(page) if end == -1 else end + len('</div>')
+        parser.feed(page[start:end])
+        start = end
+    return u''.join(parser.text)
 
-    @property
-    def opens_sunday(self):
-        return True if self._info.get('sunday') else False
+
+class Service(object):
+    """Object modeling a service offered in stores of the chain.
+
+    The stores offering the service are linked by the service index.
+    """
+    __slots__ = ('_info', 'code', 'name', 'stores')
+
+    def __init__(self, code, info):
+        self._info = info
+        #: The code the service is referenced by
+        self.code = code
+        if isinstance(info, dict):
+            name = info.get('name') or info.get('label') or code
+        else:
+            name = info or code
+        #: The name of the service
+        self.name = name
+        #: The stores offering the service
+        self.stores = ()
 
     @property
-    def opens_evenings(self):
-        return True if self._info.get('openEvening') else False
+    def store_ids(self):
+        """The ids of the stores the payload lists for the service"""
+        if isinstance(self._info, dict):
+            return self._info.get('stores') or ()
+        return ()
+
+
+class ServiceIndex(object):
+    """Object modeling an inverted index of the stores by service and city.
+
+    The index is built once per stores payload. Services are linked with
+    the stores offering them, whether the payload lists the stores under
+    the service or the services under the store. Queries over many services
+    are intersections and unions of the sets of store ids.
+    """
+    def __init__(self, services, stores):
+        self.services = OrderedDict((service.code, service)
+                                    for service in services)
+        self._stores = OrderedDict((store.id, store) for store in stores)
+        self._positions = {store_id: position
+                           for position, store_id in enumerate(self._stores)}
+        self._by_service = {code: set() for code in self.services}
+        self._by_city = {}
+        for service in self.services.values():
+            self._by_service[service.code].update(
+                store_id for store_id in service.store_ids
+                if store_id in self._stores)
+        for store in self._stores.values():
+            for code in store.service_codes:
+                if code not in self.services:
+                    self.services[code] = Service(code, None)
+                    self._by_service[code] = set()
+                self._by_service[code].add(store.id)
+            self._by_city.setdefault((store.city or u'').lower(),
+                                     set()).add(store.id)
+        store_services = {store_id: [] for store_id in self._stores}
+        for code, store_ids in self._by_service.items():
+            service = self.services[code]
+            service.stores = tuple(
+                self._stores[store_id]
+                for store_id in sorted(store_ids, key=self._positions.get))
+            for store_id in store_ids:
+                store_services[store_id].append(service)
+        for store_id, services in store_services.items():
+            self._stores[store_id].services = tuple(services)
+
+    def store_ids(self, code):
+        """The ids of the stores offering a service
+
+        :param code: The code of the service
+        :return: A frozenset of store ids, empty for unknown services
+        """
+        return frozenset(self._by_service.get(code, ()))
+
+    def filter(self, all_of=(), any_of=(), city=None):
+        """Retrieves the stores offering a combination of services
+
+        :param all_of: The codes of services that all have to be offered
+        :param any_of: The codes of services of which one has to be offered
+        :param city: The city the stores have to be in
+        :return: A list of store objects in the order of the stores payload
+        """
+        sets = [self._by_service.get(code, set()) for code in all_of]
+        if any_of:
+            sets.append(set().union(*(self._by_service.get(code, set())
+                                      for code in any_of)))
+        if city is not None:
+            sets.append(self._by_city.get(city.lower(), set()))
+        if not sets:
+            return list(self._stores.values())
+        sets.sort(key=len)
+        selection = set(sets[0]).intersection(*sets[1:])
+        return [self._stores[store_id]
+                for store_id in sorted(selection, key=self._positions.get)]
+
+
+class Store(object):
+    """Object modeling a store of the chain.
+
+    The payload is decoded once on instantiation.
+    """
+    __slots__ = ('_info', '_format', 'city', 'street', 'street_number',
+                 'zip_code', 'telephone', 'opening_times_today', 'latitude',
+                 'longtitude', 'opens_sunday', 'opens_evenings', 'id',
+                 'service_codes', 'services', 'opening_hours', '_address')
+
+    def __init__(self, info):
+        self._info = info
+        self._format = info.get('format')
+        self.city = info.get('city')
+        self.street = info.get('street')
+        self.street_number = info.get('housenr')
+        self.zip_code = info.get('zip')
+        self.telephone = info.get('phoneNumber')
+        self.opening_times_today = info.get('status')
+        self.latitude = info.get('lat')
+        self.longtitude = info.get('lng')
+        self.opens_sunday = True if info.get('sunday') else False
+        self.opens_evenings = True if info.get('openEvening') else False
+        self.id = info.get('no')  # pylint: disable=invalid-name
+        self.service_codes = tuple(info.get('services') or ())
+        #: The services offered in the store, linked by the service index
+        self.services = ()
+        #: The weekly opening hours of the store or None if unknown
+        self.opening_hours = parse_opening_hours(info)
+        self._address = None
 
     @property
-    def id(self):
-        return self._info.get('no')
+    def address(self):
+        if self._address is None:
+            self._address = u'{street} {nr} {zip} {city}'.format(
+                street=self.street,
+                nr=self.street_number,
+                zip=self.zip_code,
+                city=self.city)
+        return self._address
 
 
 class ShoppingCart(object):
     """Object modeling the shopping cart.
     
-    It is able to add items to the cart, by id or description.
-    It exposes item objects through the content attribute"""
-    def __init__(self, ah_instance):
+    It is able to add items to the cart, by id or description, and to
+    synchronize the cart with a desired list of items. Additions by id or
+    description can optionally be queued and sent behind the caller.
+    It exposes item objects through the content attribute. The contents are
+    kept in a snapshot that is refreshed after the ttl passes, on demand or
+    after items are added through the cart. A ttl of 0 always refreshes and
+    a ttl of None only refreshes on demand.
+    """
+    def __init__(self, ah_instance, ttl=DEFAULT_CART_TTL):
         logger_name = '{base}.{suffix}'.format(base=LOGGER_BASENAME,
                                                suffix=self.__class__.__name__)
         self._logger = logging.getLogger(logger_name)
         self._ah = ah_instance
         self._url = ('{base}/service/rest/shoppinglists/0/'
                      'items').format(base=self._ah.url)
+        self._contents_url = ('{base}/service/rest/delegate'
+                              '?url=%2Fmijnlijst').format(base=self._ah.url)
+        self.ttl = ttl
+        self.write_behind = None
+        self._snapshot = None
 
     def add_item_by_id(self, item_id, quantity=1):
         """Adds items to the shopping cart by the internal id representation
 
         :param item_id: The internal representation of the item
         :param quantity: The quantity as an integer
-        :return: True on success False otherwise.
+        :return: True on success False otherwise, or a future of it when
+        write behind is enabled.
         """
         return self._add_item('PRODUCT', 'id', item_id, quantity)
 
-    def add_item_by_description(self, description, quantity=1):
+    def add_item_by_description(self, description, quantity=1, resolve=False):
         """Adds items to the shopping cart by the internal id representation
 
         :param description: The description of the item
         :param quantity: The quantity as an integer
-        :return: True on success False otherwise.
+        :param resolve: Whether to add the product the description resolves
+        to, if any, instead of the free text
+        :return: True on success False otherwise, or a future of it when
+        write behind is enabled.
         """
+        if resolve:
+            product_id = self._ah.resolver.resolve(description)
+            if product_id is not None:
+                return self.add_item_by_id(product_id, quantity)
         return self._add_item('UNSPECIFIED',
                               'description',
                               description,
                               quantity)
 
+    def add_items(self, items, workers=DEFAULT_WORKERS, resolve=False):
+        """Adds multiple items to the shopping cart concurrently
+
+        Items are given as (id or description, quantity) pairs. Ids are
+        recognised by their internal representation, everything else is
+        submitted as a description. Duplicate entries are merged into a
+        single submission with the summed quantity.
+
+        :param items: An iterable of (id or description, quantity) pairs
+        :param workers: The maximum number of concurrent submissions
+        :param resolve: Whether to add the products descriptions resolve to,
+        if any, instead of the free text
+        :return: A list of ItemSubmission results in the order first seen
+        """
+        items = [(item, quantity) for item, quantity in items]
+        if resolve:
+            resolved = self._ah.resolver.resolve_many(
+                item for item, _ in items
+                if not PRODUCT_ID_PATTERN.match(item))
+            items = [(resolved.get(item) or item, quantity)
+                     for item, quantity in items]
+        merged = OrderedDict()
+        for item, quantity in items:
+            merged[item] = merged.get(item, 0) + int(quantity)
+        if not merged:
+            return []
+        workers = max(1, min(workers, CONNECTION_POOL_SIZE, len(merged)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(lambda entry: self._submit(*entry),
+                                     merged.items()))
+
+    def _submit(self, item, quantity):
+        if PRODUCT_ID_PATTERN.match(item):
+            return self._send_item('PRODUCT', 'id', item, quantity)
+        return self._send_item('UNSPECIFIED', 'description', item, quantity)
+
+    def _send_item(self, submission_type, item_type, item, quantity):
+        from requests.exceptions import RequestException
+        try:
+            response = self._post_item(submission_type,
+                                       item_type,
+                                       item,
+                                       quantity)
+        except (RequestException, CircuitOpenError) as error:
+            self._logger.error('Submitting item %s failed with %s',
+                               item, error)
+            return ItemSubmission(item, quantity, False, None, error)
+        return ItemSubmission(item,
+                              quantity,
+                              response.ok,
+                              response.status_code,
+                              None)
+
+    def sync(self, desired, remove_missing=True, workers=DEFAULT_WORKERS):
+        """Makes the shopping cart match a desired list of items
+
+        Items are given as (id or description, quantity) pairs like for
+        add_items and are matched against the current contents by id for
+        products and by normalized description otherwise. Only the
+        differences are sent, concurrently, as additions, quantity updates
+        and removals. A quantity of 0 removes an item.
+
+        :param desired: An iterable of (id or description, quantity) pairs
+        :param remove_missing: Whether to remove items not in the desired list
+        :param workers: The maximum number of concurrent requests
+        :return: A SyncReport with lists of ItemSubmission results of the
+        additions, updates and removals and a list of the unchanged items
+        """
+        wanted = OrderedDict()
+        for item, quantity in desired:
+            if PRODUCT_ID_PATTERN.match(item):
+                key = 'product', item
+            else:
+                key = 'unspecified', normalize(item)
+            previous = wanted.get(key, (item, 0))
+            wanted[key] = previous[0], previous[1] + int(quantity)
+        current = self.refresh()
+        operations, unchanged = [], []
+        for key, (item, quantity) in wanted.items():
+            existing = current.get(key)
+            if existing is None:
+                if quantity > 0:
+                    operations.append(('added', item, quantity, None))
+            elif quantity <= 0:
+                operations.append(('removed', item, 0, existing))
+            elif quantity != existing.quantity:
+                operations.append(('updated', item, quantity, existing))
+            else:
+                unchanged.append(item)
+        if remove_missing:
+            operations.extend(('removed', key[1], 0, existing)
+                              for key, existing in current.index.items()
+                              if key not in wanted)
+        report = SyncReport([], [], [], unchanged)
+        if not operations:
+            return report
+        workers = max(1, min(workers, CONNECTION_POOL_SIZE, len(operations)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda entry: self._apply(*entry),
+                                        operations))
+        for (action, _, _, _), result in zip(operations, results):
+            getattr(report, action).append(result)
+        return report
+
+    def _apply(self, action, item, quantity, existing):
+        from requests.exceptions import RequestException
+        if action == 'added':
+            return self._submit(item, quantity)
+        if existing.list_item_id is None:
+            error = ValueError('No list item id for {}'.format(item))
+            self._logger.error('Cannot change item %s, %s', item, error)
+            return ItemSubmission(item, quantity, False, None, error)
+        url = '{url}/{list_item_id}'.format(
+            url=self._url, list_item_id=existing.list_item_id)
+        try:
+            if action == 'removed':
+                response = self._ah._request('DELETE', url)
+            else:
+                response = self._ah._request('PATCH', url,
+                                             json={'quantity': quantity})
+        except (RequestException, CircuitOpenError) as error:
+            self._logger.error('Changing item %s failed with %s', item, error)
+            return ItemSubmission(item, quantity, False, None, error)
+        if response.ok:
+            self.invalidate()
+        return ItemSubmission(item,
+                              quantity,
+                              response.ok,
+                              response.status_code,
+                              None)
+
+    def enable_write_behind(self,
+                            path,
+                            flush_interval=None,
+                            flush_size=None):
+        """Queues the additions by id or description instead of sending them
+
+        While enabled add_item_by_id and add_item_by_description return a
+        future right after the addition is written to the queue, resolving
+        to True once the addition is delivered or False if the server
+        rejected it.
+
+        :param path: The path of the sqlite database file of the queue
+        :param flush_interval: The seconds between background flushes
+        :param flush_size: The number of distinct pending items that
+        triggers an early flush
+        :return: The WriteBehindQueue object
+        """
+        from .mijnahlibqueue import WriteBehindQueue
+        options = {name: value for name, value
+                   in (('flush_interval', flush_interval),
+                       ('flush_size', flush_size)) if value is not None}
+        self.disable_write_behind()
+        self.write_behind = WriteBehindQueue(self, path, **options)
+        return self.write_behind
+
+    def disable_write_behind(self):
+        """Flushes and closes the write behind queue if enabled"""
+        queue, self.write_behind = self.write_behind, None
+        if queue is not None:
+            queue.close()
+
     def _add_item(self, submission_type, item_type, item_info, quantity):
+        if self.write_behind is not None:
+            return _chain(self.write_behind.put(submission_type,
+                                                item_info,
+                                                quantity),
+                          lambda submission: submission.success)
+        response = self._post_item(submission_type,
+                                   item_type,
+                                   item_info,
+                                   quantity)
+        return response.ok
+
+    def _post_item(self, submission_type, item_type, item_info, quantity):
         data = {'type': submission_type,
                 'item': {item_type: item_info},
                 'quantity': int(quantity)}
-        response = self._ah.session.post(self._url, json=data)
-        return response.ok
+        response = self._ah._request('POST', self._url, json=data)
+        if response.ok:
+            self.invalidate()
+        return response
 
     @property
     def contents(self):
@@ -200,17 +766,74 @@ class ShoppingCart(object):
 
         :return: A list of items according to their type
         """
-        url = ('{base}/service/rest/delegate'
-               '?url=%2Fmijnlijst').format(base=self._ah.url)
-        response = self._ah.session.get(url)
+        return list(self.snapshot.items)
+
+    @property
+    def snapshot(self):
+        """The snapshot of the shopping cart contents
+
+        The cached snapshot is returned unless it is older than the ttl or has
+        been invalidated.
+
+        :return: A CartSnapshot object
+        """
+        snapshot = self._snapshot
+        if snapshot is None or (self.ttl is not None and
+                                snapshot.age >= self.ttl):
+            snapshot = self.refresh()
+        return snapshot
+
+    def refresh(self):
+        """Retrieves the contents of the shopping cart from the server
+
+        :return: A CartSnapshot object
+        """
+        response = self._ah._request('GET', self._contents_url)
         data = response.json()
         items_lanes = [lane for lane in data['_embedded']['lanes']
                        if lane['type'] == 'ShoppingListLane']
 
-        products = [ItemFactory(self._ah, item)
-                    for cart in items_lanes
-                    for item in cart.get('_embedded').get('items')]
-        return products
+        items = [ItemFactory(self._ah, item)
+                 for cart in items_lanes
+                 for item in cart.get('_embedded').get('items')]
+        # items of types without a model are left out of the snapshot
+        products = [item for item in items if item is not None]
+        self._ah.resolver.add_products(item for item in products
+                                       if isinstance(item, Product))
+        self._snapshot = CartSnapshot(products)
+        return self._snapshot
+
+    def iter_contents(self, chunk_size=STREAM_CHUNK_SIZE):
+        """Streams the contents of the shopping cart from the server
+
+        The response is parsed while it downloads, so memory stays flat for
+        large lists and the first item is available early. The cached
+        snapshot is neither used nor updated.
+
+        :param chunk_size: The size of the chunks to read the response in
+        :return: A generator of items according to their type
+        """
+        response = self._ah._request('GET', self._contents_url, stream=True)
+        try:
+            for info in iter_lane_items(response.iter_content(chunk_size),
+                                        'ShoppingListLane'):
+                item = ItemFactory(self._ah, info)
+                if item is not None:
+                    yield item
+        finally:
+            response.close()
+
+    def invalidate(self):
+        """Discards the cached snapshot so the next access refreshes it"""
+        self._snapshot = None
+
+    def diff(self, previous_snapshot):
+        """Compares the current contents with a previous snapshot
+
+        :param previous_snapshot: A CartSnapshot retrieved earlier
+        :return: A CartDiff of the added, removed and quantity changed items
+        """
+        return self.snapshot.diff(previous_snapshot)
 
     def get_items_with_discount(self):
         """Get the items that are on discount on the shopping cart
@@ -220,123 +843,374 @@ class ShoppingCart(object):
         return [item for item in self.contents if item.has_discount]
 
 
-class ItemFactory(object):
-    """A factory that instantiates the appropriate object based on type"""
-    def __new__(cls, ah_instance, info):
-        product_type = info.get('type').lower()
-        if product_type == 'product':
-            return Product(ah_instance, info)
-        elif product_type == 'unspecifieditem':
-            return UnspecifiedProduct(ah_instance, info)
+def _chain(future, function):
+    """Creates a future resolving to a function of the result of another"""
+    chained = Future()
 
+    def done(source):
+        error = source.exception()
+        if error is not None:
+            chained.set_exception(error)
+        else:
+            chained.set_result(function(source.result()))
+    future.add_done_callback(done)
+    return chained
 
-class Item(object):
-    """Generic class of the products objects
-    
-    Handles all the common parts
+
+class ProductCatalogue(object):
+    """Object modeling the product catalogue of the server.
+
+    Product details are looked up by id without them being in the shopping
+    cart. Lookups are served from the product cache while current and
+    fetched concurrently otherwise.
     """
-    def __init__(self, ah_instance, info):
+    def __init__(self, ah_instance, cache):
         logger_name = '{base}.{suffix}'.format(base=LOGGER_BASENAME,
                                                suffix=self.__class__.__name__)
         self._logger = logging.getLogger(logger_name)
         self._ah = ah_instance
-        self._info = info
+        self.cache = cache
+
+    @staticmethod
+    def _iter_products(data):
+        # the products are embedded somewhere in the lanes of the page
+        pending = [data]
+        while pending:
+            value = pending.pop()
+            if isinstance(value, dict):
+                product = value.get('product')
+                if isinstance(product, dict) and product.get('id'):
+                    yield product
+                pending.extend(reversed(list(value.values())))
+            elif isinstance(value, list):
+                pending.extend(reversed(value))
+
+    def _page(self, path, description):
+        from requests.exceptions import RequestException
+        url = '{base}/service/rest/delegate?url={path}'.format(
+            base=self._ah.url, path=quote(path, safe=''))
+        try:
+            response = self._ah._send('GET', url)
+        except (RequestException, CircuitOpenError) as error:
+            self._logger.error('Retrieving %s failed with %s',
+                               description, error)
+            return None
+        if not response.ok:
+            self._logger.warning('Retrieving %s got status %s',
+                                 description, response.status_code)
+            return None
+        return response.json()
+
+    def _fetch(self, product_id):
+        data = self._page('/producten/product/{}'.format(product_id),
+                          'product {}'.format(product_id))
+        for product in self._iter_products(data):
+            if product['id'] == product_id:
+                self.cache.put(product_id, product)
+                return product
+        return None
+
+    def _product(self, payload, partial=False):
+        product = Product(self._ah, {'type': 'Product',
+                                     '_embedded': {'product': payload}},
+                          partial)
+        self._ah.resolver.add(product.id, product.description)
+        return product
+
+    def search(self, query):
+        """Searches the products matching a query
+
+        :param query: The free text to search for
+        :return: A list of Product objects in the order of relevance
+        """
+        data = self._page('/zoeken?rq={}'.format(quote(query)),
+                          'search results of {}'.format(query))
+        products = OrderedDict()
+        for payload in self._iter_products(data):
+            products.setdefault(payload['id'], payload)
+        return [self._product(payload) for payload in products.values()]
+
+    @staticmethod
+    def _fields(fields):
+        # the id is always needed to build the product
+        return None if fields is None else set(fields) | {'id'}
+
+    def get(self, product_id, fields=None):
+        """Retrieves the details of a product
+
+        :param product_id: The internal id of the product
+        :param fields: The payload fields needed, like description or
+        priceLabel. All fields if not set, otherwise the cached product is
+        used while these fields are current and only they are set along
+        with the details already known for the product
+        :return: A Product object or None if it could not be found
+        """
+        payload = self.cache.get(product_id, self._fields(fields))
+        if payload:
+            return self._product(payload, fields is not None)
+        payload = self._fetch(product_id)
+        return self._product(payload) if payload else None
+
+    def get_many(self, product_ids, workers=DEFAULT_WORKERS, fields=None):
+        """Retrieves the details of many products
+
+        Duplicate ids are looked up once and the ids missing from the cache
+        are fetched concurrently.
+
+        :param product_ids: An iterable of internal product ids
+        :param workers: The maximum number of concurrent lookups
+        :param fields: The payload fields needed, like for get
+        :return: A dictionary of product id to Product object or None
+        """
+        fields = self._fields(fields)
+        payloads = OrderedDict((product_id, self.cache.get(product_id,
+                                                           fields))
+                               for product_id in product_ids)
+        missing = [product_id for product_id, payload in payloads.items()
+                   if payload is None]
+        products = OrderedDict((product_id,
+                                self._product(payload, fields is not None)
+                                if payload else None)
+                               for product_id, payload in payloads.items())
+        if missing:
+            workers = max(1, min(workers, CONNECTION_POOL_SIZE, len(missing)))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                products.update((product_id, self._product(payload)
+                                 if payload else None)
+                                for product_id, payload
+                                in zip(missing, executor.map(self._fetch,
+                                                             missing)))
+        return products
 
-    @property
-    def url(self):
-        """The url of the item
 
-        :return: The url of the item
+class CartSnapshot(object):
+    """Object modeling the contents of the shopping cart at a point in time.
+
+    Items are keyed by their id for products and by their normalized
+    description for unspecified products.
+    """
+    def __init__(self, items):
+        self.items = tuple(items)
+        self.created_at = time.time()
+        self.index = OrderedDict((self.key(item), item)
+                                 for item in self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def get(self, key):
+        """Retrieves an item by its key
+
+        :param key: The key of the item as produced by the key method
+        :return: The item if present None otherwise
         """
-        _url = self._info.get('navItem', {}).get('link', {}).get('href', {})
-        return self._ah.url + _url
+        return self.index.get(key)
 
     @property
-    def quantity(self):
-        """The quantity of the items in the shopping cart
+    def age(self):
+        """The seconds since the snapshot was taken"""
+        return time.time() - self.created_at
+
+    @staticmethod
+    def key(item):
+        """Calculates the key an item is tracked by
 
-        :return: The quantity of the items
+        :param item: A product or unspecified product
+        :return: A tuple of the item type and its identifier
         """
-        return self._info.get('_embedded',
-                              {}).get('listItem', {}).get('quantity')
+        if isinstance(item, Product):
+            return 'product', item.id
+        return 'unspecified', normalize(item.description)
 
+    def diff(self, previous):
+        """Compares the snapshot with an older one
 
-class UnspecifiedProduct(Item):
-    """An object to model the unspecified products"""
-    def __init__(self, ah_instance, info):
-        super(UnspecifiedProduct, self).__init__(ah_instance, info)
+        :param previous: The older snapshot
+        :return: A CartDiff with lists of the added and removed items and a
+        list of (previous, current) tuples for the items whose quantity
+        changed
+        """
+        added = [item for key, item in self.index.items()
+                 if key not in previous]
+        removed = [item for key, item in previous.index.items()
+                   if key not in self]
+        changed = [(previous.get(key), item)
+                   for key, item in self.index.items()
+                   if key in previous and
+                   previous.get(key).quantity != item.quantity]
+        return CartDiff(added, removed, changed)
 
-    @property
-    def description(self):
-        """The description of the product"""
-        description = self._info.get('description')
-        return description.replace(u'\xad', u'')
 
-    def __getattr__(self, attribute):
-        item = self.__dict__.get(attribute)
-        if not item:
-            message = ('Unspecified Products do not support all the '
-                       'attributes of Products. {} is not a supported '
-                       'attribute'.format(attribute))
-            self._logger.warning(message)
-        return item
+class ItemFactory(object):
+    """A factory that instantiates the appropriate object based on type"""
+    def __new__(cls, ah_instance, info):
+        product_type = info.get('type').lower()
+        if product_type == 'product':
+            return Product(ah_instance, info)
+        elif product_type == 'unspecifieditem':
+            return UnspecifiedProduct(ah_instance, info)
 
 
-class Product(Item):
-    """An object to model the products."""
-    def __init__(self, ah_instance, info):
-        super(Product, self).__init__(ah_instance, info)
+def strip_soft_hyphens(text):
+    """Removes the soft hyphens AH uses in descriptions
 
-    @property
-    def _product(self):
-        return self._info.get('_embedded').get('product')
+    :param text: The text to clean up
+    :return: The text without soft hyphens
+    """
+    return text.replace(u'\xad', u'') if text else text
 
-    @property
-    def id(self):
-        """The internal id of the item"""
-        return self._product.get('id')
 
-    @property
-    def is_orderable(self):
-        """Whether the object is orderable on not
+class Item(object):
+    """Generic class of the products objects
+    
+    Handles all the common parts. The payload is decoded once on
+    instantiation into slots, only the parts specific to the shopping cart
+    entry are kept.
+    """
+    __slots__ = ('_ah', 'url', 'quantity', 'list_item_id')
+    _logger = logging.getLogger('{base}.Item'.format(base=LOGGER_BASENAME))
 
-        :return: A boolean of the state
-        """
-        return self._product.get('availability', {}).get('orderable', False)
+    def __init__(self, ah_instance, info):
+        self._ah = ah_instance
+        _url = info.get('navItem', {}).get('link', {}).get('href', '')
+        #: The url of the item
+        self.url = ah_instance.url + _url
+        list_item = info.get('_embedded', {}).get('listItem', {})
+        #: The quantity of the items in the shopping cart
+        self.quantity = list_item.get('quantity')
+        #: The id of the entry of the item in the shopping cart
+        self.list_item_id = list_item.get('id')
 
-    @property
-    def category(self):
-        """The category of the product"""
-        return self._product.get('categoryName')
 
-    @property
-    def price(self):
-        """The price of the product"""
-        return self._product.get('priceLabel', {}).get('now')
+class UnspecifiedProduct(Item):
+    """An object to model the unspecified products"""
+    __slots__ = ('description',)
+    _logger = logging.getLogger('{base}.UnspecifiedProduct'.format(
+        base=LOGGER_BASENAME))
 
-    @property
-    def price_previously(self):
-        """The previous price of the product if on discount."""
-        return self._product.get('priceLabel', {}).get('was')
+    def __init__(self, ah_instance, info):
+        super(UnspecifiedProduct, self).__init__(ah_instance, info)
+        #: The description of the product
+        self.description = strip_soft_hyphens(info.get('description'))
 
-    @property
-    def has_discount(self):
-        """Whether the object is a discounted one"""
-        discount = self._product.get('discount')
-        return True if discount else False
+    def __getattr__(self, attribute):
+        if attribute.startswith('__'):
+            raise AttributeError(attribute)
+        message = ('Unspecified Products do not support all the '
+                   'attributes of Products. {} is not a supported '
+                   'attribute'.format(attribute))
+        self._logger.warning(message)
+        return None
+
+
+class ProductData(object):
+    """Object modeling the details of a product.
+
+    The details do not change for a product payload so they are interned
+    by product id and shared by all the Product objects of an equal payload,
+    in every cart of every account. A product whose payload changed gets new
+    details, the fields of a partial payload are merged into the details
+    already known. Details no product refers to any more are released.
+    """
+    __slots__ = ('payload', 'id', 'is_orderable', 'category', 'price',
+                 'price_previously', 'has_discount', 'measurement_unit',
+                 'description', 'brand', '__weakref__')
+    _interned = weakref.WeakValueDictionary()
+    _lock = threading.Lock()
+
+    def __init__(self, payload):
+        price_label = payload.get('priceLabel', {})
+        self.payload = payload
+        self.id = payload.get('id')  # pylint: disable=invalid-name
+        self.is_orderable = payload.get('availability',
+                                        {}).get('orderable', False)
+        self.category = payload.get('categoryName')
+        self.price = price_label.get('now')
+        self.price_previously = price_label.get('was')
+        self.has_discount = True if payload.get('discount') else False
+        self.measurement_unit = payload.get('unitSize')
+        self.description = strip_soft_hyphens(payload.get('description'))
+        self.brand = payload.get('brandName')
+
+    def _holds(self, payload, partial):
+        if self.payload is payload:
+            return True
+        if partial:
+            return all(field in self.payload and self.payload[field] == value
+                       for field, value in payload.items())
+        return self.payload == payload
+
+    @classmethod
+    def intern(cls, payload, partial=False):
+        """Retrieves the shared details of a product payload
+
+        :param payload: The product payload
+        :param partial: Whether the payload holds only some of the fields of
+        the product, which are then merged into the details already known
+        :return: The ProductData object of the payload
+        """
+        product_id = payload.get('id')
+        if product_id is None:
+            return cls(payload)
+        data = cls._interned.get(product_id)
+        if data is not None and data._holds(payload, partial):
+            return data
+        with cls._lock:
+            data = cls._interned.get(product_id)
+            if data is None or not data._holds(payload, partial):
+                if partial and data is not None:
+                    merged = dict(data.payload)
+                    merged.update(payload)
+                    payload = merged
+                data = cls._interned[product_id] = cls(payload)
+        return data
+
+    @classmethod
+    def interned(cls):
+        """The number of product details currently shared"""
+        return len(cls._interned)
+
+
+def _detail(name, doc):
+    # the details of a product are read from its shared ProductData
+    return property(attrgetter('_data.{}'.format(name)), doc=doc)
 
-    @property
-    def measurement_unit(self):
-        """The measurement unit of the product according to AH"""
-        return self._product.get('unitSize')
 
-    @property
-    def description(self):
-        """The description of the object"""
-        description = self._product.get('description')
-        return description.replace(u'\xad', u'')
+class Product(Item):
+    """An object to model the products.
 
-    @property
-    def brand(self):
-        """The brand of the product"""
-        return self._product.get('brandName')
+    The details of the product are read from the details shared with the
+    other products of the same payload, only the shopping cart entry is
+    kept per object.
+    """
+    __slots__ = ('_data',)
+    _logger = logging.getLogger('{base}.Product'.format(base=LOGGER_BASENAME))
+
+    id = _detail('id', 'The internal id of the item')
+    is_orderable = _detail('is_orderable', 'Whether the object is orderable '
+                                           'on not')
+    category = _detail('category', 'The category of the product')
+    price = _detail('price', 'The price of the product')
+    price_previously = _detail('price_previously', 'The previous price of '
+                                                   'the product if on '
+                                                   'discount')
+    has_discount = _detail('has_discount', 'Whether the object is a '
+                                           'discounted one')
+    measurement_unit = _detail('measurement_unit', 'The measurement unit of '
+                                                   'the product according '
+                                                   'to AH')
+    description = _detail('description', 'The description of the object')
+    brand = _detail('brand', 'The brand of the product')
+
+    def __init__(self, ah_instance, info, partial=False):
+        super(Product, self).__init__(ah_instance, info)
+        #: The shared details of the product, holding them keeps them
+        #: interned while the product is alive
+        self._data = ProductData.intern(info.get('_embedded').get('product'),
+                                        partial)
@@ -0,0 +1,529 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: mijnahlibasync.py
+"""
+Asyncio module file
+
+Exposes asyncio counterparts of the server and shopping cart objects built
+on the httpx asynchronous client
+"""
+
+import asyncio
+import logging
+from collections import OrderedDict
+
+from .mijnahlib import (CONNECTION_POOL_SIZE,
+                        DEFAULT_CART_TTL,
+                        DEFAULT_WORKERS,
+                        LOGGER_BASENAME,
+                        LOGIN_ERROR_MESSAGE,
+                        LOGIN_PATH,
+                        PRODUCT_ID_PATTERN,
+                        CartSnapshot,
+                        ItemFactory,
+                        ItemSubmission,
+                        Product,
+                        Store,
+                        extract_error_notice)
+from .mijnahlibcache import StoreDirectoryCache
+from .mijnahlibexceptions import (CircuitOpenError,
+                                  InvalidCredentials,
+                                  NoAuthRedirect,
+                                  UnknownServerError)
+from .mijnahlibmetrics import endpoint_name
+from .mijnahlibresolver import DescriptionResolver
+from .mijnahlibretry import IDEMPOTENT_METHODS, CircuitBreaker, RetryPolicy
+
+__author__ = '''Costas Tyfoxylos <costas.tyf@gmail.com>'''
+__docformat__ = 'plaintext'
+__date__ = '''10-05-2017'''
+
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+
+def _is_retryable_error(method, error):
+    """Decides whether a request that raised an httpx error can be retried
+
+    Like the retry policy, requests that never reached the server are always
+    retried and other transport errors only for idempotent methods.
+    """
+    import httpx
+    if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout)):
+        return True
+    return (method.upper() in IDEMPOTENT_METHODS and
+            isinstance(error, httpx.TransportError))
+
+
+class AsyncServer(object):
+    """Object modeling the server connection for asyncio applications.
+
+    Mirrors the Server object, with every network bound attribute returning
+    an awaitable. Requests are made by an httpx asynchronous client, so a
+    single event loop can drive many accounts without any threads. The
+    transport of the client can be shared between servers to share their
+    connection pool, every server keeps its own cookies. Authentication is
+    deferred and renewed like for the Server and the session store, store
+    directory cache, instrumentation, retry policy, circuit breaker and
+    resolver objects apply the same way and can be shared with Server
+    objects. Requires the httpx package.
+    """
+    def __init__(self,
+                 username,
+                 password,
+                 session_store=None,
+                 store_cache=None,
+                 cart_ttl=DEFAULT_CART_TTL,
+                 instrumentation=None,
+                 retry_policy=None,
+                 circuit_breaker=None,
+                 transport=None,
+                 resolver=None):
+        logger_name = '{base}.{suffix}'.format(base=LOGGER_BASENAME,
+                                               suffix=self.__class__.__name__)
+        self._logger = logging.getLogger(logger_name)
+        import httpx
+        self.username = username
+        self.password = password
+        self.url = 'https://www.ah.nl'
+        # a shared transport is closed by its owner, not by the servers
+        self._owns_transport = transport is None
+        self.client = httpx.AsyncClient(
+            transport=transport or shared_transport(),
+            follow_redirects=True)
+        self.instrumentation = instrumentation
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.resolver = resolver or DescriptionResolver()
+        self._session_store = session_store
+        self._authenticated = False
+        self._authentication_lock = None
+        self._authentication_generation = 0
+        self._store_cache = store_cache or StoreDirectoryCache(ttl=None)
+        self._stores_payload = None
+        self._stores = None
+        self._stores_loading = None
+        self.shopping_cart = AsyncShoppingCart(self, cart_ttl)
+
+    @classmethod
+    async def create(cls, username, password, **kwargs):
+        """Instantiates and authenticates an asynchronous server
+
+        :param username: The username of the account
+        :param password: The password of the account
+        :return: An authenticated AsyncServer object
+        """
+        instance = cls(username, password, **kwargs)
+        await instance._ensure_authenticated()
+        return instance
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        """Closes the client and its transport unless it is shared"""
+        if self._owns_transport:
+            await self.client.aclose()
+
+    def _lock(self):
+        # the lock is created on first use so it binds to the running loop
+        if self._authentication_lock is None:
+            self._authentication_lock = asyncio.Lock()
+        return self._authentication_lock
+
+    async def _ensure_authenticated(self):
+        if not self._authenticated:
+            async with self._lock():
+                if not self._authenticated:
+                    if not await self._resume_session():
+                        await self._authenticate()
+                    self._authenticated = True
+        return self._authentication_generation
+
+    async def _reauthenticate(self, generation):
+        async with self._lock():
+            if generation == self._authentication_generation:
+                self._logger.info('Session of %s expired, authenticating',
+                                  self.username)
+                self.client.cookies.clear()
+                await self._authenticate()
+                self._authenticated = True
+                self._authentication_generation += 1
+
+    @staticmethod
+    def _is_expired(response):
+        if response.status_code in (401, 403):
+            return True
+        return any(LOGIN_PATH in entry.headers.get('location', '')
+                   for entry in response.history)
+
+    async def _request(self, method, url, **kwargs):
+        """Performs an authenticated request on the client
+
+        Authenticates if needed and replays the request once if the session
+        turned out to be expired.
+
+        :param method: The http method of the request
+        :param url: The url of the request
+        :param kwargs: The keyword arguments are passed to the client
+        :return: The httpx response object
+        """
+        generation = await self._ensure_authenticated()
+        response = await self._send(method, url, **kwargs)
+        if self._is_expired(response):
+            await self._reauthenticate(generation)
+            response = await self._send(method, url, **kwargs)
+        return response
+
+    async def _send(self, method, url, **kwargs):
+        """Performs a request on the client applying the retry policy
+
+        :param method: The http method of the request
+        :param url: The url of the request
+        :param kwargs: The keyword arguments are passed to the client
+        :raises CircuitOpenError: If the endpoint is failing and cut off
+        :return: The httpx response object
+        """
+        import httpx
+        endpoint = endpoint_name(method, url)
+        attempt = 0
+        while True:
+            self.circuit_breaker.before(endpoint)
+            try:
+                response = await self.client.request(method, url, **kwargs)
+            except httpx.TransportError as error:
+                self.circuit_breaker.failure(endpoint)
+                if (attempt >= self.retry_policy.max_retries or
+                        not _is_retryable_error(method, error)):
+                    raise
+                delay = self.retry_policy.backoff(attempt)
+                self._logger.warning('Request to %s failed with %s, '
+                                     'retrying in %.2fs', endpoint, error,
+                                     delay)
+            else:
+                if self.instrumentation:
+                    self._record(response)
+                if response.status_code >= 500:
+                    self.circuit_breaker.failure(endpoint)
+                else:
+                    self.circuit_breaker.success(endpoint)
+                if (attempt >= self.retry_policy.max_retries or
+                        not self.retry_policy.is_retryable(
+                            method, response=response)):
+                    return response
+                delay = self.retry_policy.backoff(attempt, response)
+                self._logger.warning('Request to %s got status %s, '
+                                     'retrying in %.2fs', endpoint,
+                                     response.status_code, delay)
+            attempt += 1
+            if self.instrumentation:
+                self.instrumentation.record_retry(endpoint)
+            await asyncio.sleep(delay)
+
+    def _record(self, response):
+        # every redirect hop is recorded like the session hook does
+        for entry in response.history + [response]:
+            request = entry.request
+            self.instrumentation.record_response(
+                request.method,
+                str(request.url),
+                entry.status_code,
+                entry.elapsed.total_seconds(),
+                len(request.content),
+                len(entry.content))
+
+    async def _resume_session(self):
+        if not self._session_store:
+            return False
+        cookies = self._session_store.load(self.username)
+        if cookies is None:
+            return False
+        for cookie in cookies:
+            self.client.cookies.jar.set_cookie(cookie)
+        if await self._is_authenticated():
+            self._logger.debug('Resumed stored session of %s', self.username)
+            return True
+        self._logger.debug('Stored session of %s is no longer valid',
+                           self.username)
+        self.client.cookies.clear()
+        self._session_store.clear(self.username)
+        return False
+
+    async def _is_authenticated(self):
+        url = '{base}/mijn'.format(base=self.url)
+        response = await self._send('GET', url, follow_redirects=False)
+        location = response.headers.get('location', '')
+        return response.is_success and LOGIN_PATH not in location
+
+    async def _authenticate(self):
+        data = {'userName': self.username,
+                'password': self.password,
+                'rememberUser': True}
+        url = '{base}{login}/basis'.format(base=self.url, login=LOGIN_PATH)
+        response = await self._send('POST', url, data=data)
+        if not response.is_success:
+            raise UnknownServerError(response.text)
+        # the client follows the redirect of a successful login itself
+        if not response.history:
+            if LOGIN_ERROR_MESSAGE in response.text:
+                raise InvalidCredentials(extract_error_notice(response.text))
+            raise NoAuthRedirect
+        if self._session_store:
+            self._session_store.save(self.username, self.client.cookies.jar)
+        return True
+
+    async def _get_stores(self):
+        # concurrent callers share a single lookup of the store directory
+        loading = self._stores_loading
+        if loading is None:
+            loading = asyncio.ensure_future(self._load_stores())
+            self._stores_loading = loading
+            loading.add_done_callback(self._stores_loaded)
+        return await asyncio.shield(loading)
+
+    def _stores_loaded(self, _):
+        self._stores_loading = None
+
+    async def _load_stores(self):
+        import httpx
+        from requests.exceptions import ConnectionError as RequestsError
+        loop = asyncio.get_running_loop()
+        url = ('{base}/data/winkelinformatie/winkels/'
+               'json').format(base=self.url)
+
+        def request(method, url, **kwargs):
+            future = asyncio.run_coroutine_threadsafe(
+                self._send(method, url, **kwargs), loop)
+            try:
+                return future.result()
+            except httpx.TransportError as error:
+                raise RequestsError(str(error))
+        # the cache locks and reads its snapshot from disk, so it is asked on
+        # the executor while its request is sent on the loop.
+        data = await loop.run_in_executor(None, self._store_cache.get,
+                                          request, url)
+        if data is not self._stores_payload:
+            self._stores = [Store(info) for info in data.get('stores')]
+            self._stores_payload = data
+        return self._stores
+
+    @property
+    def stores(self):
+        """The stores of the chain as an awaitable of a list
+
+        :raises UnknownServerError: If the server failed to answer and no
+        payload was retrieved before
+        """
+        return self._get_stores()
+
+
+class AsyncShoppingCart(object):
+    """Object modeling the shopping cart for asyncio applications.
+
+    Mirrors the ShoppingCart object of the server the cart belongs to, with
+    concurrent additions bounded by a semaphore instead of a thread pool.
+    """
+    def __init__(self, ah_instance, ttl=DEFAULT_CART_TTL):
+        logger_name = '{base}.{suffix}'.format(base=LOGGER_BASENAME,
+                                               suffix=self.__class__.__name__)
+        self._logger = logging.getLogger(logger_name)
+        self._ah = ah_instance
+        self._url = ('{base}/service/rest/shoppinglists/0/'
+                     'items').format(base=self._ah.url)
+        self._contents_url = ('{base}/service/rest/delegate'
+                              '?url=%2Fmijnlijst').format(base=self._ah.url)
+        self.ttl = ttl
+        self._snapshot = None
+
+    async def add_item_by_id(self, item_id, quantity=1):
+        """Adds items to the shopping cart by the internal id representation
+
+        :param item_id: The internal representation of the item
+        :param quantity: The quantity as an integer
+        :return: True on success False otherwise.
+        """
+        response = await self._post_item('PRODUCT', 'id', item_id, quantity)
+        return response.is_success
+
+    async def add_item_by_description(self, description, quantity=1,
+                                      resolve=False):
+        """Adds items to the shopping cart by description
+
+        :param description: The description of the item
+        :param quantity: The quantity as an integer
+        :param resolve: Whether to add the product the description resolves
+        to, if any, instead of the free text
+        :return: True on success False otherwise.
+        """
+        if resolve:
+            product_id = (await self._resolve([description])).get(description)
+            if product_id is not None:
+                return await self.add_item_by_id(product_id, quantity)
+        response = await self._post_item('UNSPECIFIED',
+                                         'description',
+                                         description,
+                                         quantity)
+        return response.is_success
+
+    async def add_items(self, items, workers=DEFAULT_WORKERS, resolve=False):
+        """Adds multiple items to the shopping cart concurrently
+
+        :param items: An iterable of (id or description, quantity) pairs
+        :param workers: The maximum number of concurrent submissions
+        :param resolve: Whether to add the products descriptions resolve to,
+        if any, instead of the free text
+        :return: A list of ItemSubmission results in the order first seen
+        """
+        items = [(item, quantity) for item, quantity in items]
+        if resolve:
+            resolved = await self._resolve(
+                item for item, _ in items
+                if not PRODUCT_ID_PATTERN.match(item))
+            items = [(resolved.get(item) or item, quantity)
+                     for item, quantity in items]
+        merged = OrderedDict()
+        for item, quantity in items:
+            merged[item] = merged.get(item, 0) + int(quantity)
+        semaphore = asyncio.Semaphore(max(1, min(workers,
+                                                 CONNECTION_POOL_SIZE)))
+
+        async def submit(item, quantity):
+            async with semaphore:
+                return await self._submit(item, quantity)
+        return list(await asyncio.gather(*[submit(item, quantity)
+                                           for item, quantity
+                                           in merged.items()]))
+
+    async def _resolve(self, descriptions):
+        # a resolver shared with a Server may search remotely and block
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None,
+                                          self._ah.resolver.resolve_many,
+                                          list(descriptions))
+
+    async def _submit(self, item, quantity):
+        import httpx
+        if PRODUCT_ID_PATTERN.match(item):
+            arguments = 'PRODUCT', 'id', item, quantity
+        else:
+            arguments = 'UNSPECIFIED', 'description', item, quantity
+        try:
+            response = await self._post_item(*arguments)
+        except (httpx.TransportError, CircuitOpenError) as error:
+            self._logger.error('Submitting item %s failed with %s',
+                               item, error)
+            return ItemSubmission(item, quantity, False, None, error)
+        return ItemSubmission(item,
+                              quantity,
+                              response.is_success,
+                              response.status_code,
+                              None)
+
+    async def _post_item(self, submission_type, item_type, item_info,
+                         quantity):
+        data = {'type': submission_type,
+                'item': {item_type: item_info},
+                'quantity': int(quantity)}
+        response = await self._ah._request('POST', self._url, json=data)  # pylint: disable=protected-access
+        if response.is_success:
+            self.invalidate()
+        return response
+
+    async def refresh(self):
+        """Retrieves the contents of the shopping cart from the server
+
+        :return: A CartSnapshot object
+        """
+        response = await self._ah._request('GET', self._contents_url)  # pylint: disable=protected-access
+        data = response.json()
+        items = [ItemFactory(self._ah, item)
+                 for lane in data['_embedded']['lanes']
+                 if lane['type'] == 'ShoppingListLane'
+                 for item in lane.get('_embedded').get('items')]
+        # items of types without a model are left out of the snapshot
+        products = [item for item in items if item is not None]
+        self._ah.resolver.add_products(item for item in products
+                                       if isinstance(item, Product))
+        self._snapshot = CartSnapshot(products)
+        return self._snapshot
+
+    async def _get_snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is None or (self.ttl is not None and
+                                snapshot.age >= self.ttl):
+            snapshot = await self.refresh()
+        return snapshot
+
+    @property
+    def snapshot(self):
+        """The snapshot of the shopping cart contents as an awaitable"""
+        return self._get_snapshot()
+
+    async def _get_contents(self):
+        return list((await self._get_snapshot()).items)
+
+    @property
+    def contents(self):
+        """The contents of the shopping cart as an awaitable of a list"""
+        return self._get_contents()
+
+    def invalidate(self):
+        """Discards the cached snapshot so the next access refreshes it"""
+        self._snapshot = None
+
+    async def get_items_with_discount(self):
+        """Get the items that are on discount on the shopping cart
+
+        :return: A list of product objects or empty.
+        """
+        return [item for item in await self.contents if item.has_discount]
+
+
+def shared_transport(max_connections=CONNECTION_POOL_SIZE):
+    """Creates an httpx transport to share between many asynchronous servers
+
+    :param max_connections: The maximum number of connections of the pool
+    :return: An httpx AsyncHTTPTransport object
+    """
+    import httpx
+    return httpx.AsyncHTTPTransport(
+        limits=httpx.Limits(max_connections=max_connections,
+                            max_keepalive_connections=max_connections))
+
+
+def async_transport(adapter):
+    """Wraps a transport adapter so the AsyncServer client can use it
+
+    The requests of the httpx client are sent through the adapter, like the
+    fake server or a replayed cassette, on the default executor of the
+    running loop since adapters block.
+
+    :param adapter: A requests transport adapter
+    :return: An httpx transport object
+    """
+    import httpx
+    from requests import Request
+    from requests.exceptions import ConnectionError as RequestsError
+
+    async def handle(request):
+        body = await request.aread()
+        prepared = Request(request.method,
+                           str(request.url),
+                           headers=dict(request.headers),
+                           data=body.decode('utf-8') if body else None
+                           ).prepare()
+        loop = asyncio.get_running_loop()
+        try:
+            response = await loop.run_in_executor(None, adapter.send,
+                                                  prepared)
+        except RequestsError as error:
+            raise httpx.ConnectError(str(error), request=request)
+        # the body is streamed like from a real transport so the client
+        # times the response when it is read
+        return httpx.Response(response.status_code,
+                              headers=list(response.headers.items()),
+                              stream=httpx.ByteStream(response.content))
+    return httpx.MockTransport(handle)
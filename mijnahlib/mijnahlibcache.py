@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: mijnahlibcache.py
+"""
+Cache module file
+
+Holds the persistent caches that can be shared between processes
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+from .mijnahlibexceptions import CircuitOpenError, UnknownServerError
+
+__author__ = '''Costas Tyfoxylos <costas.tyf@gmail.com>'''
+__docformat__ = 'plaintext'
+__date__ = '''10-05-2017'''
+
+LOGGER_BASENAME = '''mijnahlib'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+# How long a stored session is considered usable if the cookies themselves
+# do not expire earlier.
+DEFAULT_SESSION_TTL = 12 * 60 * 60
+
+# How long the store directory is served without asking the server again.
+DEFAULT_STORES_TTL = 24 * 60 * 60
+
+# How long the fields of a product are considered current. Prices and
+# availability change often, the rest of the details rarely.
+DEFAULT_PRODUCT_TTL = 7 * 24 * 60 * 60
+DEFAULT_PRODUCT_FIELD_TTLS = {'priceLabel': 60 * 60,
+                              'discount': 60 * 60,
+                              'availability': 60 * 60}
+DEFAULT_PRODUCT_CACHE_SIZE = 4096
+
+
+@contextmanager
+def file_lock(path, exclusive=True):
+    """Holds an advisory lock on a lock file next to the provided path
+
+    On platforms without fcntl no locking takes place.
+
+    :param path: The path of the file to guard
+    :param exclusive: Whether to hold an exclusive or a shared lock
+    """
+    if fcntl is None:  # pragma: no cover
+        yield
+        return
+    with open('{path}.lock'.format(path=path), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def write_atomically(path, content):
+    """Writes the content to a temporary file and moves it in place
+
+    :param path: The path of the file to write
+    :param content: The text to write
+    """
+    temporary = '{path}.{pid}.tmp'.format(path=path, pid=os.getpid())
+    with open(temporary, 'w') as output:
+        output.write(content)
+    os.rename(temporary, path)
+
+
+class SessionStore(object):
+    """Object modeling an on disk store of authenticated sessions.
+
+    The cookies of a session are saved along with their expiry per username
+    so that processes sharing the directory can resume them instead of
+    logging in again.
+    """
+    def __init__(self, path, ttl=DEFAULT_SESSION_TTL):
+        logger_name = '{base}.{suffix}'.format(base=LOGGER_BASENAME,
+                                               suffix=self.__class__.__name__)
+        self._logger = logging.getLogger(logger_name)
+        self.path = path
+        self.ttl = ttl
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _file(self, username):
+        digest = hashlib.sha1(username.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, '{}.session'.format(digest))
+
+    def load(self, username):
+        """Loads the stored cookies of a user if they have not expired
+
+        :param username: The username the session belongs to
+        :return: A cookie jar on success None otherwise
+        """
+        path = self._file(username)
+        if not os.path.isfile(path):
+            return None
+        with file_lock(path, exclusive=False):
+            try:
+                with open(path) as input_file:
+                    data = json.load(input_file)
+            except (IOError, ValueError):
+                self._logger.warning('Could not read session of %s', username)
+                return None
+        if data.get('expires', 0) <= time.time():
+            self._logger.debug('Stored session of %s has expired', username)
+            return None
+        from requests.cookies import RequestsCookieJar, create_cookie
+        jar = RequestsCookieJar()
+        for cookie in data.get('cookies', []):
+            jar.set_cookie(create_cookie(**cookie))
+        return jar
+
+    def save(self, username, cookies):
+        """Saves the cookies of a user's session
+
+        :param username: The username the session belongs to
+        :param cookies: The cookie jar of the authenticated session
+        :return: True on success
+        """
+        expires = time.time() + self.ttl
+        serialized = []
+        for cookie in cookies:
+            if cookie.expires:
+                expires = min(expires, cookie.expires)
+            serialized.append({'name': cookie.name,
+                               'value': cookie.value,
+                               'domain': cookie.domain,
+                               'path': cookie.path,
+                               'secure': cookie.secure,
+                               'expires': cookie.expires,
+                               'rest': cookie._rest})  # pylint: disable=protected-access
+        path = self._file(username)
+        with file_lock(path):
+            write_atomically(path, json.dumps({'expires': expires,
+                                               'cookies': serialized}))
+        return True
+
+    def clear(self, username):
+        """Removes the stored session of a user
+
+        :param username: The username the session belongs to
+        """
+        path = self._file(username)
+        with file_lock(path):
+            if os.path.isfile(path):
+                os.remove(path)
+
+
+class StoreDirectoryCache(object):
+    """Object modeling a cache of the store directory payload.
+
+    A single instance can be shared between Server objects. The payload is
+    served from memory until the ttl passes and is then revalidated with a
+    conditional request. If a path is provided a compact snapshot is kept on
+    disk so that other processes and restarts can load it without any
+    network traffic. A ttl of None never expires the payload. If the server
+    cannot be reached, its endpoint is cut off or it fails to answer, a
+    stale payload is kept and served until it does.
+    """
+    def __init__(self, ttl=DEFAULT_STORES_TTL, path=None):
+        logger_name = '{base}.{suffix}'.format(base=LOGGER_BASENAME,
+                                               suffix=self.__class__.__name__)
+        self._logger = logging.getLogger(logger_name)
+        self.ttl = ttl
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self._payload = None
+        self._etag = None
+        self._last_modified = None
+        self._fetched_at = 0
+        self._lock = threading.Lock()
+        if path:
+            self._load_snapshot()
+
+    def _is_fresh(self):
+        if self._payload is None:
+            return False
+        if self.ttl is None:
+            return True
+        return time.time() - self._fetched_at < self.ttl
+
+    def _load_snapshot(self):
+        if not os.path.isfile(self.path):
+            return False
+        with file_lock(self.path, exclusive=False):
+            try:
+                with open(self.path) as input_file:
+                    snapshot = json.load(input_file)
+            except (IOError, ValueError):
+                self._logger.warning('Could not read snapshot %s', self.path)
+                return False
+        if snapshot.get('fetched_at', 0) <= self._fetched_at:
+            return False
+        self._payload = snapshot.get('payload')
+        self._etag = snapshot.get('etag')
+        self._last_modified = snapshot.get('last_modified')
+        self._fetched_at = snapshot.get('fetched_at')
+        return True
+
+    def _save_snapshot(self):
+        snapshot = {'payload': self._payload,
+                    'etag': self._etag,
+                    'last_modified': self._last_modified,
+                    'fetched_at': self._fetched_at}
+        with file_lock(self.path):
+            write_atomically(self.path,
+                             json.dumps(snapshot, separators=(',', ':')))
+
+    def get(self, request, url):
+        """Retrieves the store directory payload
+
+        :param request: A callable accepting a method, a url and the keyword
+        arguments of a session request, used if the server has to be asked.
+        It can return the response of a requests session or an httpx client
+        :param url: The url of the store directory
+        :raises UnknownServerError: If the server failed to answer and there
+        is no payload to fall back to
+        :raises RequestException: If the server could not be reached and
+        there is no payload to fall back to
+        :raises CircuitOpenError: If the endpoint is cut off and there is no
+        payload to fall back to
+        :return: The decoded payload of the store directory
+        """
+        with self._lock:
+            if self._is_fresh() or (self.path and
+                                    self._load_snapshot() and
+                                    self._is_fresh()):
+                self.hits += 1
+                return self._payload
+            self.misses += 1
+            headers = {}
+            if self._payload is not None and self._etag:
+                headers['If-None-Match'] = self._etag
+            if self._payload is not None and self._last_modified:
+                headers['If-Modified-Since'] = self._last_modified
+            from requests.exceptions import RequestException
+            try:
+                response = request('GET', url, headers=headers)
+            except (RequestException, CircuitOpenError) as error:
+                if self._payload is None:
+                    raise
+                self._logger.warning('Retrieving the stores failed with %s, '
+                                     'serving the stale payload', error)
+                return self._payload
+            if response.status_code == 304:
+                self.revalidations += 1
+            elif response.status_code >= 400:
+                if self._payload is None:
+                    raise UnknownServerError(response.text)
+                self._logger.warning('Retrieving the stores failed with '
+                                     'status %s, serving the stale payload',
+                                     response.status_code)
+                return self._payload
+            else:
+                self._payload = response.json()
+                self._etag = response.headers.get('etag')
+                self._last_modified = response.headers.get('last-modified')
+            self._fetched_at = time.time()
+            if self.path:
+                self._save_snapshot()
+            return self._payload
+
+    def invalidate(self):
+        """Forces the next access to revalidate the payload"""
+        with self._lock:
+            self._fetched_at = 0
+
+    @property
+    def statistics(self):
+        """The hit, miss and revalidation counters of the cache"""
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'revalidations': self.revalidations}
+
+
+class LRUCache(object):
+    """Object modeling a bounded thread safe least recently used cache"""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Retrieves an entry marking it as the most recently used
+
+        :param key: The key of the entry
+        :param default: The value to return if the entry is missing
+        :return: The value of the entry or the default
+        """
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return default
+            self._entries[key] = value
+            return value
+
+    def put(self, key, value):
+        """Stores an entry evicting the least recently used ones if full
+
+        :param key: The key of the entry
+        :param value: The value of the entry
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+class ProductCache(object):
+    """Object modeling a cache of product details.
+
+    Products are kept in a bounded in memory LRU and, if a path is provided,
+    in a sqlite database that outlives the process. Every field of a product
+    expires on its own ttl and a product is served from the cache while the
+    fields asked for are current, so stale prices do not evict descriptions.
+    """
+    def __init__(self,
+                 maxsize=DEFAULT_PRODUCT_CACHE_SIZE,
+                 path=None,
+                 field_ttls=None,
+                 default_ttl=DEFAULT_PRODUCT_TTL):
+        logger_name = '{base}.{suffix}'.format(base=LOGGER_BASENAME,
+                                               suffix=self.__class__.__name__)
+        self._logger = logging.getLogger(logger_name)
+        self.field_ttls = dict(DEFAULT_PRODUCT_FIELD_TTLS
+                               if field_ttls is None else field_ttls)
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        self._memory = LRUCache(maxsize)
+        self._lock = threading.Lock()
+        self._database = None
+        if path:
+            self._database = sqlite3.connect(path, check_same_thread=False)
+            with self._database:
+                self._database.execute(
+                    'CREATE TABLE IF NOT EXISTS product_fields ('
+                    'product_id TEXT NOT NULL, '
+                    'field TEXT NOT NULL, '
+                    'value TEXT, '
+                    'fetched_at REAL NOT NULL, '
+                    'PRIMARY KEY (product_id, field))')
+
+    def _is_fresh(self, fields, now):
+        return all(now - fetched_at < self.field_ttls.get(field,
+                                                          self.default_ttl)
+                   for field, (_, fetched_at) in fields.items())
+
+    def _load(self, product_id):
+        with self._lock:
+            rows = self._database.execute(
+                'SELECT field, value, fetched_at FROM product_fields '
+                'WHERE product_id = ?', (product_id,)).fetchall()
+        return {field: (json.loads(value), fetched_at)
+                for field, value, fetched_at in rows}
+
+    def get(self, product_id, fields=None):
+        """Retrieves the payload of a product if its fields are current
+
+        :param product_id: The internal id of the product
+        :param fields: The fields needed, all the stored fields if not set.
+        Only the fields needed have to be current and only they are returned
+        :return: The product payload or None
+        """
+        now = time.time()
+        stored = self._memory.get(product_id)
+        if stored is None and self._database is not None:
+            stored = self._load(product_id) or None
+            if stored is not None:
+                self._memory.put(product_id, stored)
+        if stored is not None and fields is not None:
+            stored = {field: stored[field] for field in fields
+                      if field in stored}
+        if not stored or not self._is_fresh(stored, now):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return {field: value for field, (value, _) in stored.items()}
+
+    def put(self, product_id, payload):
+        """Stores the payload of a product
+
+        :param product_id: The internal id of the product
+        :param payload: The product payload
+        """
+        now = time.time()
+        fields = {field: (value, now) for field, value in payload.items()}
+        self._memory.put(product_id, fields)
+        if self._database is None:
+            return
+        with self._lock:
+            with self._database:
+                self._database.execute(
+                    'DELETE FROM product_fields WHERE product_id = ?',
+                    (product_id,))
+                self._database.executemany(
+                    'INSERT INTO product_fields VALUES (?, ?, ?, ?)',
+                    [(product_id, field, json.dumps(value), now)
+                     for field, value in payload.items()])
+
+    @property
+    def statistics(self):
+        """The hit and miss counters of the cache"""
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._memory)}
+
+    def close(self):
+        """Closes the database of the cache if any"""
+        if self._database is not None:
+            self._database.close()
@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: mijnahlibcli.py
+"""
+Command line module file
+
+Holds the mijnahlib command line tool that streams order files into the
+shopping carts of many accounts
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .mijnahlib import LOGGER_BASENAME, DEFAULT_WORKERS
+from .mijnahlibcache import SessionStore, write_atomically
+from .mijnahlibpool import DEFAULT_MAX_CONNECTIONS, ServerPool
+
+__author__ = '''Costas Tyfoxylos <costas.tyf@gmail.com>'''
+__docformat__ = 'plaintext'
+__date__ = '''10-05-2017'''
+
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+# The number of order lines of an account submitted together.
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_ACCOUNT_WORKERS = 4
+# The number of line numbers appended to a checkpoint before compacting it.
+# It is compacted later while they are not twice the lines left after it,
+# so the cost of compacting stays proportional to what was appended.
+COMPACT_ENTRIES = 1000
+
+
+def _open_text(path):
+    if path == '-':
+        return sys.stdin
+    if sys.version_info[0] < 3:
+        return open(path, 'rb')
+    return open(path, newline='')
+
+
+def read_orders(path, format_=None):
+    """Reads the lines of an order file lazily
+
+    CSV files need account, item and quantity columns and JSONL files
+    objects with the same keys. The quantity defaults to 1.
+
+    :param path: The path of the file or - for the standard input
+    :param format_: csv or jsonl, guessed from the extension if not set
+    :return: A generator of (line number, account, item, quantity) tuples
+    """
+    if format_ is None:
+        format_ = 'jsonl' if path.endswith(('.jsonl', '.json')) else 'csv'
+    orders = _open_text(path)
+    try:
+        if format_ == 'csv':
+            # the header is line 1
+            records = enumerate(csv.DictReader(orders), 2)
+        else:
+            records = ((number, json.loads(line))
+                       for number, line in enumerate(orders, 1)
+                       if line.strip())
+        for number, record in records:
+            account = (record.get('account') or u'').strip()
+            item = (record.get('item') or u'').strip()
+            if not account or not item:
+                LOGGER.warning('Skipping incomplete order line %s', number)
+                continue
+            yield number, account, item, int(record.get('quantity') or 1)
+    finally:
+        if orders is not sys.stdin:
+            orders.close()
+
+
+class Checkpoint(object):
+    """Object modeling the progress of an import.
+
+    The lines done are kept as the line up to which all lines are done and
+    the set of lines done after it, so batches can complete out of order.
+    Every batch appends the lines it did to the file instead of rewriting
+    it, so a line that keeps failing early does not turn saving into a
+    rewrite of all the lines done after it. The file is compacted once the
+    appended lines are twice the progress they describe. Without a path
+    nothing is persisted.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.watermark = 0
+        self.done = set()
+        self._appended = 0
+        self._lock = threading.Lock()
+        if path and os.path.isfile(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path) as checkpoint:
+            for line in checkpoint:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # only the last entry can be cut short by a crash
+                    LOGGER.warning('Ignoring a partial entry of checkpoint '
+                                   '%s', self.path)
+                    continue
+                self.watermark = max(self.watermark,
+                                     entry.get('watermark', 0))
+                self.done.update(entry.get('done', ()))
+                self._appended += len(entry.get('done', ())) + 1
+        self.done = set(number for number in self.done
+                        if number > self.watermark)
+
+    def is_done(self, number):
+        """Whether a line has been done
+
+        :param number: The line number
+        :return: True if done False otherwise
+        """
+        return number <= self.watermark or number in self.done
+
+    def mark_done(self, numbers, watermark):
+        """Marks lines as done and saves the progress
+
+        :param numbers: The line numbers done
+        :param watermark: The line up to which all lines are done
+        """
+        with self._lock:
+            numbers = [number for number in numbers
+                       if number > max(watermark, self.watermark)]
+            self.done.update(numbers)
+            advanced = watermark > self.watermark
+            if advanced:
+                self.watermark = watermark
+                self.done = set(number for number in self.done
+                                if number > watermark)
+            if not self.path or not (numbers or advanced):
+                return
+            if self._appended > max(COMPACT_ENTRIES, 2 * len(self.done)):
+                self._appended = len(self.done) + 1
+                write_atomically(self.path, json.dumps(
+                    {'watermark': self.watermark,
+                     'done': sorted(self.done)}) + '\n')
+            else:
+                self._appended += len(numbers) + 1
+                with open(self.path, 'a') as checkpoint:
+                    checkpoint.write(json.dumps({'watermark': self.watermark,
+                                                 'done': numbers}) + '\n')
+
+
+class OrderImporter(object):
+    """Object modeling an import of order lines into shopping carts.
+
+    Lines are read lazily and grouped per account into batches that are
+    added concurrently, with a bounded number of batches in flight so
+    memory stays flat for files of any size. Lines are checkpointed once
+    their items were added, lines that failed are left for the next run.
+    Server options are passed to the pool when an account is added to it.
+    """
+    def __init__(self,
+                 pool,
+                 passwords,
+                 checkpoint=None,
+                 server_options=None,
+                 batch_size=DEFAULT_BATCH_SIZE,
+                 workers=DEFAULT_WORKERS,
+                 account_workers=DEFAULT_ACCOUNT_WORKERS):
+        logger_name = '{base}.{suffix}'.format(base=LOGGER_BASENAME,
+                                               suffix=self.__class__.__name__)
+        self._logger = logging.getLogger(logger_name)
+        self.pool = pool
+        self.passwords = passwords
+        self.checkpoint = checkpoint or Checkpoint()
+        self.server_options = server_options or {}
+        self.batch_size = batch_size
+        self.workers = workers
+        self.account_workers = account_workers
+        self.statistics = OrderedDict((('lines', 0),
+                                       ('skipped', 0),
+                                       ('added', 0),
+                                       ('failed', 0),
+                                       ('seconds', 0.0)))
+        # the lines read and not added yet, failed lines stay pending
+        self._pending = set()
+        self._last_read = 0
+        self._lock = threading.Lock()
+        self._accounts_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(account_workers * 2)
+
+    def _server(self, account):
+        with self._accounts_lock:
+            try:
+                return self.pool[account]
+            except KeyError:
+                return self.pool.add(account, self.passwords[account],
+                                     **self.server_options)
+
+    def _add(self, account, batch):
+        try:
+            lines = OrderedDict()
+            for number, item, quantity in batch:
+                lines.setdefault(item, []).append(number)
+            try:
+                results = self._server(account).shopping_cart.add_items(
+                    [(item, quantity) for _, item, quantity in batch],
+                    self.workers)
+            except Exception as error:  # pylint: disable=broad-except
+                self._logger.error('Adding items for %s failed with %s',
+                                   account, error)
+                results = []
+            done = [number for result in results if result.success
+                    for number in lines[result.item]]
+            with self._lock:
+                self.statistics['added'] += len(done)
+                self.statistics['failed'] += len(batch) - len(done)
+                self._pending.difference_update(done)
+                watermark = (min(self._pending) - 1 if self._pending
+                             else self._last_read)
+                self.checkpoint.mark_done(done, min(watermark,
+                                                    self._last_read))
+        finally:
+            self._slots.release()
+
+    def run(self, orders):
+        """Imports order lines
+
+        :param orders: An iterable of (line number, account, item, quantity)
+        tuples as read by read_orders
+        :return: The statistics of the import
+        """
+        start = time.time()
+        batches = {}
+
+        def submit(executor, account):
+            batch = batches.pop(account)
+            self._slots.acquire()
+            executor.submit(self._add, account, batch)
+
+        with ThreadPoolExecutor(max_workers=self.account_workers) as executor:
+            for number, account, item, quantity in orders:
+                self.statistics['lines'] += 1
+                if self.checkpoint.is_done(number):
+                    self.statistics['skipped'] += 1
+                    continue
+                with self._lock:
+                    self._pending.add(number)
+                    self._last_read = number
+                if account not in self.passwords:
+                    self._logger.error('No password for account %s, skipping '
+                                       'line %s', account, number)
+                    self.statistics['failed'] += 1
+                    continue
+                batches.setdefault(account, []).append((number, item,
+                                                        quantity))
+                if len(batches[account]) >= self.batch_size:
+                    submit(executor, account)
+            for account in list(batches):
+                submit(executor, account)
+        self.statistics['seconds'] = time.time() - start
+        return self.statistics
+
+
+def _report(statistics, latencies, output):
+    seconds = statistics['seconds'] or 1e-9
+    output.write('lines: {lines} skipped: {skipped} added: {added} '
+                 'failed: {failed}\n'.format(**statistics))
+    output.write('elapsed: {:.2f}s throughput: {:.1f} lines/s\n'.format(
+        statistics['seconds'], statistics['added'] / seconds))
+    count = sum(latency['count'] for latency in latencies.values())
+    total = sum(latency['total'] for latency in latencies.values())
+    maximum = max([latency['max'] for latency in latencies.values()] or [0])
+    output.write('requests: {} mean latency: {:.1f}ms max latency: '
+                 '{:.1f}ms\n'.format(count,
+                                     total / count * 1000 if count else 0,
+                                     maximum * 1000))
+    for username, latency in latencies.items():
+        output.write('  {}: {} requests, mean {:.1f}ms, max {:.1f}ms\n'.format(
+            username, latency['count'], latency['mean'] * 1000,
+            latency['max'] * 1000))
+
+
+def get_arguments(arguments=None):
+    """Parses the command line arguments
+
+    :param arguments: The arguments to parse, the command line if not set
+    :return: The parsed arguments
+    """
+    parser = argparse.ArgumentParser(
+        prog='mijnahlib',
+        description='Interacts with the albert heijn on line store')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    importer = commands.add_parser(
+        'import', help='Adds the lines of an order file to shopping carts')
+    importer.add_argument('orders',
+                          help='CSV or JSONL file of account, item and '
+                               'quantity lines, - for the standard input')
+    importer.add_argument('--accounts', required=True,
+                          help='JSON file mapping accounts to passwords')
+    importer.add_argument('--format', dest='format_',
+                          choices=('csv', 'jsonl'),
+                          help='The format of the orders, guessed from the '
+                               'extension if not set')
+    importer.add_argument('--checkpoint',
+                          help='File to keep the progress in so an '
+                               'interrupted import resumes')
+    importer.add_argument('--session-dir',
+                          help='Directory to keep the sessions of the '
+                               'accounts in')
+    importer.add_argument('--batch-size', type=int,
+                          default=DEFAULT_BATCH_SIZE,
+                          help='Order lines of an account added together')
+    importer.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                          help='Concurrent additions per batch')
+    importer.add_argument('--account-workers', type=int,
+                          default=DEFAULT_ACCOUNT_WORKERS,
+                          help='Batches added concurrently')
+    importer.add_argument('--max-connections', type=int,
+                          default=DEFAULT_MAX_CONNECTIONS,
+                          help='Connections to the server shared by all '
+                               'accounts')
+    importer.add_argument('--rate', type=float,
+                          help='Maximum requests per second per account')
+    parser.add_argument('--log-level', default='warning',
+                        choices=('debug', 'info', 'warning', 'error'))
+    return parser.parse_args(arguments)
+
+
+def main(arguments=None):
+    """Runs the command line tool
+
+    :param arguments: The arguments to run with, the command line if not set
+    :return: The exit status
+    """
+    args = get_arguments(arguments)
+    logging.basicConfig(level=args.log_level.upper(),
+                        format='%(asctime)s %(name)s %(levelname)s '
+                               '%(message)s')
+    with open(args.accounts) as accounts:
+        passwords = json.load(accounts)
+    pool = ServerPool(max_connections=args.max_connections,
+                      workers=args.account_workers,
+                      account_rate=args.rate)
+    server_options = {}
+    if args.session_dir:
+        server_options['session_store'] = SessionStore(args.session_dir)
+    importer = OrderImporter(pool,
+                             passwords,
+                             Checkpoint(args.checkpoint),
+                             server_options,
+                             args.batch_size,
+                             args.workers,
+                             args.account_workers)
+    status = 0
+    try:
+        importer.run(read_orders(args.orders, args.format_))
+    except KeyboardInterrupt:
+        LOGGER.warning('Interrupted, progress is kept in the checkpoint')
+        status = 130
+    finally:
+        _report(importer.statistics, pool.latencies, sys.stdout)
+        pool.close()
+    return status or (1 if importer.statistics['failed'] else 0)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -23,3 +23,7 @@ class InvalidCredentials(Exception):
 
 class NoAuthRedirect(Exception):
     """There is no authenticated redirection provided"""
+
+
+class CircuitOpenError(Exception):
+    """Requests to the endpoint are rejected while the server is degraded"""
@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: mijnahlibgeo.py
+"""
+Geo module file
+
+Holds the spatial lookups over the stores of the chain
+"""
+
+import heapq
+import logging
+import math
+from collections import defaultdict
+
+# numpy is imported on the first use of a StoreTable.
+numpy = None  # pylint: disable=invalid-name
+
+__author__ = '''Costas Tyfoxylos <costas.tyf@gmail.com>'''
+__docformat__ = 'plaintext'
+__date__ = '''10-05-2017'''
+
+LOGGER_BASENAME = '''mijnahlib'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+# The size of a grid cell in degrees, about 5.5km north to south.
+DEFAULT_CELL_SIZE = 0.05
+
+
+def _load_numpy():
+    global numpy  # pylint: disable=global-statement,invalid-name
+    if numpy is None:
+        try:
+            import numpy as module
+        except ImportError:
+            raise ImportError('StoreTable requires numpy to be installed')
+        numpy = module
+    return numpy
+
+
+def distance_km(latitude, longitude, other_latitude, other_longitude):
+    """Calculates the great circle distance between two points
+
+    :param latitude: The latitude of the first point
+    :param longitude: The longitude of the first point
+    :param other_latitude: The latitude of the second point
+    :param other_longitude: The longitude of the second point
+    :return: The distance in kilometers
+    """
+    latitude = math.radians(latitude)
+    other_latitude = math.radians(other_latitude)
+    delta_latitude = other_latitude - latitude
+    delta_longitude = math.radians(other_longitude - longitude)
+    value = (math.sin(delta_latitude / 2) ** 2 +
+             math.cos(latitude) * math.cos(other_latitude) *
+             math.sin(delta_longitude / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(value)))
+
+
+class StoreIndex(object):
+    """Object modeling a spatial index over stores.
+
+    Stores are bucketed in a grid of fixed size cells over their coordinates
+    so that nearest and radius lookups only visit the cells around the point
+    asked for instead of every store. Stores without coordinates are left
+    out of the index.
+    """
+    def __init__(self, stores, cell_size=DEFAULT_CELL_SIZE):
+        logger_name = '{base}.{suffix}'.format(base=LOGGER_BASENAME,
+                                               suffix=self.__class__.__name__)
+        self._logger = logging.getLogger(logger_name)
+        self.cell_size = cell_size
+        self._cells = defaultdict(list)
+        self._size = 0
+        max_latitude = 0
+        for store in stores:
+            if store.latitude is None or store.longtitude is None:
+                self._logger.debug('Store %s has no coordinates', store.id)
+                continue
+            latitude, longitude = (float(store.latitude),
+                                   float(store.longtitude))
+            self._cells[self._cell(latitude,
+                                   longitude)].append((latitude,
+                                                       longitude,
+                                                       store))
+            max_latitude = max(max_latitude, abs(latitude))
+            self._size += 1
+        rows = [row for row, _ in self._cells] or [0]
+        columns = [column for _, column in self._cells] or [0]
+        self._bounds = (min(rows), max(rows), min(columns), max(columns))
+        self._max_latitude = max_latitude
+
+    def __len__(self):
+        return self._size
+
+    def _cell(self, latitude, longitude):
+        return (int(math.floor(latitude / self.cell_size)),
+                int(math.floor(longitude / self.cell_size)))
+
+    @staticmethod
+    def _matches(store, opens_sunday, opens_evenings):
+        if opens_sunday is not None and store.opens_sunday != opens_sunday:
+            return False
+        if (opens_evenings is not None and
+                store.opens_evenings != opens_evenings):
+            return False
+        return True
+
+    def _ring(self, row, column, radius):
+        if not radius:
+            return [(row, column)]
+        min_row, max_row, min_column, max_column = self._bounds
+        cells = []
+        columns = range(max(column - radius, min_column),
+                        min(column + radius, max_column) + 1)
+        for edge in (row - radius, row + radius):
+            if min_row <= edge <= max_row:
+                cells.extend((edge, step) for step in columns)
+        rows = range(max(row - radius + 1, min_row),
+                     min(row + radius - 1, max_row) + 1)
+        for edge in (column - radius, column + radius):
+            if min_column <= edge <= max_column:
+                cells.extend((step, edge) for step in rows)
+        return cells
+
+    def _max_radius(self, row, column):
+        min_row, max_row, min_column, max_column = self._bounds
+        return max(abs(row - min_row), abs(row - max_row),
+                   abs(column - min_column), abs(column - max_column))
+
+    def nearest(self, latitude, longitude, k=1,
+                opens_sunday=None, opens_evenings=None):
+        """Finds the stores closest to a point
+
+        :param latitude: The latitude of the point
+        :param longitude: The longitude of the point
+        :param k: The number of stores to return
+        :param opens_sunday: If set only stores matching the flag are returned
+        :param opens_evenings: If set only stores matching the flag are
+        returned
+        :return: A list of (distance in km, store) tuples, closest first
+        """
+        row, column = self._cell(latitude, longitude)
+        # the narrowest cell of the grid, used as the lower bound of the
+        # distance to stores outside the rings visited so far.
+        min_cell_km = self.cell_size * KM_PER_DEGREE * max(
+            math.cos(math.radians(max(self._max_latitude, abs(latitude)))),
+            0.01)
+        best = []
+        for radius in range(self._max_radius(row, column) + 1):
+            for cell in self._ring(row, column, radius):
+                for store_latitude, store_longitude, store in self._cells.get(
+                        cell, ()):
+                    if not self._matches(store, opens_sunday, opens_evenings):
+                        continue
+                    distance = distance_km(latitude, longitude,
+                                           store_latitude, store_longitude)
+                    entry = (-distance, id(store), store)
+                    if len(best) < k:
+                        heapq.heappush(best, entry)
+                    elif distance < -best[0][0]:
+                        heapq.heapreplace(best, entry)
+            if len(best) >= k and -best[0][0] <= radius * min_cell_km:
+                break
+        return [(-distance, store)
+                for distance, _, store in sorted(best, reverse=True)]
+
+    def within(self, latitude, longitude, radius_km,
+               opens_sunday=None, opens_evenings=None):
+        """Finds the stores within a distance of a point
+
+        :param latitude: The latitude of the point
+        :param longitude: The longitude of the point
+        :param radius_km: The maximum distance in kilometers
+        :param opens_sunday: If set only stores matching the flag are returned
+        :param opens_evenings: If set only stores matching the flag are
+        returned
+        :return: A list of (distance in km, store) tuples, closest first
+        """
+        latitude_span = radius_km / KM_PER_DEGREE
+        longitude_span = radius_km / (KM_PER_DEGREE * max(
+            math.cos(math.radians(min(abs(latitude) + latitude_span, 90))),
+            0.01))
+        min_row, min_column = self._cell(latitude - latitude_span,
+                                         longitude - longitude_span)
+        max_row, max_column = self._cell(latitude + latitude_span,
+                                         longitude + longitude_span)
+        results = []
+        for row in range(min_row, max_row + 1):
+            for column in range(min_column, max_column + 1):
+                for store_latitude, store_longitude, store in self._cells.get(
+                        (row, column), ()):
+                    if not self._matches(store, opens_sunday, opens_evenings):
+                        continue
+                    distance = distance_km(latitude, longitude,
+                                           store_latitude, store_longitude)
+                    if distance <= radius_km:
+                        results.append((distance, store))
+        results.sort(key=lambda entry: entry[0])
+        return results
+
+
+class StoreTable(object):
+    """Object modeling a columnar view over stores.
+
+    Coordinates and ids are kept in contiguous numpy arrays, the opening
+    flags in boolean masks and the city and format as codes into a table of
+    interned strings, so filters and distances are computed for all stores
+    at once. Filters return boolean masks that can be combined with the
+    usual numpy operators and turned back into Store objects. Requires
+    numpy to be installed.
+    """
+    def __init__(self, stores):
+        _load_numpy()
+        logger_name = '{base}.{suffix}'.format(base=LOGGER_BASENAME,
+                                               suffix=self.__class__.__name__)
+        self._logger = logging.getLogger(logger_name)
+        self._stores = list(stores)
+        size = len(self._stores)
+        self.ids = numpy.empty(size, dtype=numpy.int64)
+        self.latitudes = numpy.empty(size, dtype=numpy.float64)
+        self.longitudes = numpy.empty(size, dtype=numpy.float64)
+        self.opens_sunday = numpy.empty(size, dtype=bool)
+        self.opens_evenings = numpy.empty(size, dtype=bool)
+        self.city_codes = numpy.empty(size, dtype=numpy.int32)
+        self.format_codes = numpy.empty(size, dtype=numpy.int32)
+        self.cities = []
+        self.formats = []
+        cities, formats = {}, {}
+        for index, store in enumerate(self._stores):
+            self.ids[index] = int(store.id) if store.id is not None else -1
+            self.latitudes[index] = (float(store.latitude)
+                                     if store.latitude is not None
+                                     else numpy.nan)
+            self.longitudes[index] = (float(store.longtitude)
+                                      if store.longtitude is not None
+                                      else numpy.nan)
+            self.opens_sunday[index] = store.opens_sunday
+            self.opens_evenings[index] = store.opens_evenings
+            self.city_codes[index] = self._intern(cities,
+                                                  self.cities,
+                                                  store.city)
+            self.format_codes[index] = self._intern(formats,
+                                                    self.formats,
+                                                    store._format)  # pylint: disable=protected-access
+
+    def __len__(self):
+        return len(self._stores)
+
+    @staticmethod
+    def _intern(codes, values, value):
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(values)
+            values.append(value)
+        return code
+
+    @staticmethod
+    def _code_mask(codes, values, value):
+        try:
+            return codes == values.index(value)
+        except ValueError:
+            return numpy.zeros(len(codes), dtype=bool)
+
+    def filter(self, city=None, format_=None,
+               opens_sunday=None, opens_evenings=None):
+        """Selects the stores matching all the provided criteria
+
+        :param city: The city the stores should be in
+        :param format_: The format of the stores
+        :param opens_sunday: The required state of the sunday opening flag
+        :param opens_evenings: The required state of the evening opening flag
+        :return: A boolean mask over the stores of the table
+        """
+        mask = numpy.ones(len(self), dtype=bool)
+        if city is not None:
+            mask &= self._code_mask(self.city_codes, self.cities, city)
+        if format_ is not None:
+            mask &= self._code_mask(self.format_codes, self.formats, format_)
+        if opens_sunday is not None:
+            mask &= self.opens_sunday == bool(opens_sunday)
+        if opens_evenings is not None:
+            mask &= self.opens_evenings == bool(opens_evenings)
+        return mask
+
+    def distances(self, latitude, longitude):
+        """Calculates the distance of every store to a point
+
+        :param latitude: The latitude of the point
+        :param longitude: The longitude of the point
+        :return: An array of distances in km, nan for stores without
+        coordinates
+        """
+        return self.distance_matrix([latitude], [longitude])[0]
+
+    def distance_matrix(self, latitudes, longitudes):
+        """Calculates the distance of every store to many points at once
+
+        :param latitudes: A sequence with the latitudes of the points
+        :param longitudes: A sequence with the longitudes of the points
+        :return: An array of distances in km with a row per point
+        """
+        point_latitudes = numpy.radians(
+            numpy.asarray(latitudes, dtype=numpy.float64))[:, numpy.newaxis]
+        point_longitudes = numpy.radians(
+            numpy.asarray(longitudes, dtype=numpy.float64))[:, numpy.newaxis]
+        store_latitudes = numpy.radians(self.latitudes)
+        store_longitudes = numpy.radians(self.longitudes)
+        value = (numpy.sin((store_latitudes - point_latitudes) / 2) ** 2 +
+                 numpy.cos(point_latitudes) * numpy.cos(store_latitudes) *
+                 numpy.sin((store_longitudes - point_longitudes) / 2) ** 2)
+        return 2 * EARTH_RADIUS_KM * numpy.arcsin(
+            numpy.minimum(1.0, numpy.sqrt(value)))
+
+    def group_by_city(self, mask=None):
+        """Groups the positions of the stores by their city
+
+        :param mask: An optional boolean mask to restrict the stores
+        :return: A dictionary of city to an array of store positions
+        """
+        codes = self.city_codes if mask is None else self.city_codes[mask]
+        positions = (numpy.arange(len(self)) if mask is None
+                     else numpy.flatnonzero(mask))
+        return {self.cities[code]: positions[codes == code]
+                for code in numpy.unique(codes)}
+
+    def store(self, position):
+        """Retrieves the store object at a position of the table
+
+        :param position: The position of the store
+        :return: A store object
+        """
+        return self._stores[position]
+
+    def stores(self, selection=None):
+        """Retrieves the store objects of a selection
+
+        :param selection: A boolean mask or an array of positions, if not
+        provided all the stores are returned
+        :return: A list of store objects
+        """
+        if selection is None:
+            return list(self._stores)
+        selection = numpy.asarray(selection)
+        if selection.dtype == bool:
+            selection = numpy.flatnonzero(selection)
+        return [self._stores[position] for position in selection]
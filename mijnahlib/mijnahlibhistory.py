@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: mijnahlibhistory.py
+"""
+History module file
+
+Holds an append only store of the price and discount changes of products
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from .mijnahlib import LOGGER_BASENAME, Product
+
+__author__ = '''Costas Tyfoxylos <costas.tyf@gmail.com>'''
+__docformat__ = 'plaintext'
+__date__ = '''10-05-2017'''
+
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+# sqlite limits the number of parameters of a statement.
+QUERY_CHUNK_SIZE = 500
+
+PriceChange = namedtuple('PriceChange', ('product_id', 'timestamp', 'price',
+                                         'price_previously', 'has_discount'))
+
+SCHEMA = ('CREATE TABLE IF NOT EXISTS price_changes ('
+          'product_id TEXT NOT NULL, '
+          'timestamp REAL NOT NULL, '
+          'price REAL, '
+          'price_previously REAL, '
+          'has_discount INTEGER NOT NULL, '
+          'discount_started INTEGER NOT NULL)',
+          'CREATE INDEX IF NOT EXISTS price_changes_product '
+          'ON price_changes (product_id, timestamp)',
+          'CREATE INDEX IF NOT EXISTS price_changes_discount_started '
+          'ON price_changes (discount_started, timestamp)',
+          'CREATE TABLE IF NOT EXISTS latest_prices ('
+          'product_id TEXT PRIMARY KEY, '
+          'timestamp REAL NOT NULL, '
+          'price REAL, '
+          'price_previously REAL, '
+          'has_discount INTEGER NOT NULL)')
+
+COLUMNS = 'product_id, timestamp, price, price_previously, has_discount'
+
+
+def _change(row):
+    product_id, timestamp, price, price_previously, has_discount = row
+    return PriceChange(product_id, timestamp, price, price_previously,
+                       bool(has_discount))
+
+
+class PriceHistory(object):
+    """Object modeling the price history of products.
+
+    Snapshots of products are compared to the last known state of every
+    product and only the changes of price or discount are appended. The
+    history is kept in sqlite, indexed so the changes of a product and the
+    products that went on discount after a moment are found without
+    scanning the whole history.
+    """
+    def __init__(self, path=':memory:'):
+        logger_name = '{base}.{suffix}'.format(base=LOGGER_BASENAME,
+                                               suffix=self.__class__.__name__)
+        self._logger = logging.getLogger(logger_name)
+        self.path = path
+        self._database = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._database:
+            for statement in SCHEMA:
+                self._database.execute(statement)
+
+    def _latest(self, product_ids):
+        latest = {}
+        for index in range(0, len(product_ids), QUERY_CHUNK_SIZE):
+            chunk = product_ids[index:index + QUERY_CHUNK_SIZE]
+            rows = self._database.execute(
+                'SELECT {columns} FROM latest_prices WHERE product_id IN '
+                '({marks})'.format(columns=COLUMNS,
+                                   marks=', '.join('?' * len(chunk))),
+                chunk)
+            latest.update((row[0], _change(row)) for row in rows)
+        return latest
+
+    def record(self, products, timestamp=None):
+        """Records a snapshot of products
+
+        Items that are not products are ignored and a product seen more
+        than once in the snapshot is recorded with its last state.
+
+        :param products: An iterable of Product objects
+        :param timestamp: The time of the snapshot, now if not set
+        :return: The number of changes recorded
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        snapshot = OrderedDict((product.id, product) for product in products
+                               if isinstance(product, Product))
+        with self._lock:
+            latest = self._latest(list(snapshot))
+            changes = []
+            for product_id, product in snapshot.items():
+                previous = latest.get(product_id)
+                if previous is not None and (
+                        previous.price,
+                        previous.price_previously,
+                        previous.has_discount) == (product.price,
+                                                   product.price_previously,
+                                                   product.has_discount):
+                    continue
+                started = product.has_discount and not (previous and
+                                                        previous.has_discount)
+                changes.append((product_id, timestamp, product.price,
+                                product.price_previously,
+                                int(product.has_discount), int(started)))
+            with self._database:
+                self._database.executemany(
+                    'INSERT INTO price_changes VALUES (?, ?, ?, ?, ?, ?)',
+                    changes)
+                self._database.executemany(
+                    'INSERT OR REPLACE INTO latest_prices VALUES '
+                    '(?, ?, ?, ?, ?)', [change[:5] for change in changes])
+        self._logger.debug('Recorded %s changes of %s products',
+                           len(changes), len(snapshot))
+        return len(changes)
+
+    def went_on_discount_since(self, since):
+        """Retrieves the products that went on discount after a moment
+
+        :param since: The time in seconds since the epoch
+        :return: A list of PriceChange objects ordered by time
+        """
+        with self._lock:
+            rows = self._database.execute(
+                'SELECT {columns} FROM price_changes WHERE '
+                'discount_started = 1 AND timestamp >= ? '
+                'ORDER BY timestamp'.format(columns=COLUMNS), (since,))
+            return [_change(row) for row in rows]
+
+    def history(self, product_id, since=None):
+        """Retrieves the price changes of a product
+
+        :param product_id: The internal id of the product
+        :param since: The time in seconds since the epoch to start from
+        :return: A list of PriceChange objects ordered by time
+        """
+        with self._lock:
+            rows = self._database.execute(
+                'SELECT {columns} FROM price_changes WHERE product_id = ? '
+                'AND timestamp >= ? ORDER BY timestamp'.format(
+                    columns=COLUMNS), (product_id, since or 0))
+            return [_change(row) for row in rows]
+
+    def latest(self, product_id):
+        """Retrieves the last known state of a product
+
+        :param product_id: The internal id of the product
+        :return: A PriceChange object or None if never recorded
+        """
+        with self._lock:
+            return self._latest([product_id]).get(product_id)
+
+    def close(self):
+        """Closes the database of the history"""
+        self._database.close()
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: mijnahlibhours.py
+"""
+Opening hours module file
+
+Parses the opening hours of stores into weekly intervals and indexes them
+for queries on the stores open at a time
+"""
+
+import logging
+import re
+from bisect import bisect_right
+from datetime import date, timedelta
+
+__author__ = '''Costas Tyfoxylos <costas.tyf@gmail.com>'''
+__docformat__ = 'plaintext'
+__date__ = '''10-05-2017'''
+
+LOGGER_BASENAME = '''mijnahlib'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+DEFAULT_BUCKET_MINUTES = 15
+SUNDAY = 6
+# Stores that are not flagged as open in the evening close by then.
+EVENING_MINUTE = 20 * 60
+
+# Days are numbered like datetime.weekday, monday is 0.
+DAY_NAMES = {name: number
+             for number, names in enumerate((
+                 ('monday', 'maandag', 'mo', 'ma'),
+                 ('tuesday', 'dinsdag', 'tu', 'di'),
+                 ('wednesday', 'woensdag', 'we', 'wo'),
+                 ('thursday', 'donderdag', 'th', 'do'),
+                 ('friday', 'vrijdag', 'fr', 'vr'),
+                 ('saturday', 'zaterdag', 'sa', 'za'),
+                 ('sunday', 'zondag', 'su', 'zo')))
+             for full_name in names
+             for name in (full_name, full_name[:3])}
+
+TIME_RANGE_PATTERN = re.compile(r'(\d{1,2})[:.](\d{2})\s*(?:-|tot|to)\s*'
+                                r'(\d{1,2})[:.](\d{2})')
+
+
+def _day_number(day):
+    if isinstance(day, int):
+        return day % 7
+    day = u'{}'.format(day).strip().lower()
+    if day.isdigit():
+        return int(day) % 7
+    return DAY_NAMES.get(day, DAY_NAMES.get(day[:3]))
+
+
+def _time_ranges(text):
+    for match in TIME_RANGE_PATTERN.finditer(text or u''):
+        start_hour, start_minute, end_hour, end_minute = map(int,
+                                                             match.groups())
+        yield start_hour * 60 + start_minute, end_hour * 60 + end_minute
+
+
+def _day_intervals(day, ranges):
+    # a range ending before it starts runs past midnight
+    offset = day * MINUTES_PER_DAY
+    for start, end in ranges:
+        if end <= start:
+            end += MINUTES_PER_DAY
+        yield offset + start, offset + end
+
+
+def _status_intervals(info, today):
+    ranges = [(start, end if end > start else end + MINUTES_PER_DAY)
+              for start, end in _time_ranges(info.get('status'))]
+    if not ranges:
+        return []
+    weekday = (today or date.today()).weekday()
+    intervals = list(_day_intervals(weekday, ranges))
+    if not info.get('openEvening'):
+        ranges = [(start, min(end, EVENING_MINUTE)) for start, end in ranges
+                  if start < EVENING_MINUTE]
+    for day in range(7):
+        if day == weekday or (day == SUNDAY and not info.get('sunday')):
+            continue
+        intervals.extend(_day_intervals(day, ranges))
+    return intervals
+
+
+def parse_opening_hours(info, today=None):
+    """Parses the opening hours of a store payload
+
+    The hours are expected under openingHours either as a mapping of day to
+    a text like '08:00 - 22:00' or as a list of entries with a day and
+    from/to or open/close times. Days are names in english or dutch or
+    numbers with monday as 0.
+
+    The store directory only carries the hours of the day it was retrieved
+    on, as a status text like 'Vandaag open 08:00 - 22:00', with sunday and
+    openEvening flags. Without openingHours these hours are used for today
+    and assumed for the other days of the week, sunday only for stores
+    flagged as open on sundays and up to 20:00 for stores not flagged as
+    open in the evening.
+
+    :param info: The payload of a store
+    :param today: The date the payload was retrieved on, today if not set
+    :return: A WeeklyHours object or None if the payload has no hours
+    """
+    hours = info.get('openingHours')
+    if not hours:
+        intervals = _status_intervals(info, today)
+        return WeeklyHours(intervals) if intervals else None
+    intervals = []
+    if isinstance(hours, dict):
+        entries = [(day, _time_ranges(text)) for day, text in hours.items()]
+    else:
+        entries = []
+        for entry in hours:
+            start = entry.get('from', entry.get('open'))
+            end = entry.get('to', entry.get('close'))
+            text = (u'{} - {}'.format(start, end) if start and end
+                    else entry.get('hours'))
+            entries.append((entry.get('day'), _time_ranges(text)))
+    for day, ranges in entries:
+        number = _day_number(day) if day is not None else None
+        if number is None:
+            LOGGER.warning('Ignoring opening hours of unknown day %s', day)
+            continue
+        intervals.extend(_day_intervals(number, ranges))
+    return WeeklyHours(intervals)
+
+
+def minute_of_week(moment):
+    """Calculates the minute of the week of a moment
+
+    :param moment: A datetime in the local time of the stores
+    :return: The minutes since monday midnight
+    """
+    return (moment.weekday() * MINUTES_PER_DAY + moment.hour * 60 +
+            moment.minute)
+
+
+class WeeklyHours(object):
+    """Object modeling the weekly opening hours of a store.
+
+    The hours are kept as sorted and merged intervals of minutes of the
+    week. Intervals running past sunday midnight wrap to monday.
+    """
+    __slots__ = ('intervals', '_starts')
+
+    def __init__(self, intervals):
+        wrapped = []
+        for start, end in intervals:
+            if end > MINUTES_PER_WEEK:
+                wrapped.append((start, MINUTES_PER_WEEK))
+                wrapped.append((0, end - MINUTES_PER_WEEK))
+            elif end > start:
+                wrapped.append((start, end))
+        merged = []
+        for start, end in sorted(wrapped):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        #: The sorted (start, end) minutes of the week the store is open
+        self.intervals = tuple(merged)
+        self._starts = [start for start, _ in merged]
+
+    def __bool__(self):
+        return bool(self.intervals)
+
+    __nonzero__ = __bool__
+
+    def is_open_at_minute(self, minute):
+        """Whether the store is open at a minute of the week
+
+        :param minute: The minutes since monday midnight
+        :return: True if open False otherwise
+        """
+        index = bisect_right(self._starts, minute) - 1
+        return index >= 0 and minute < self.intervals[index][1]
+
+    def is_open(self, moment):
+        """Whether the store is open at a moment
+
+        :param moment: A datetime in the local time of the stores
+        :return: True if open False otherwise
+        """
+        return self.is_open_at_minute(minute_of_week(moment))
+
+    def next_opening(self, moment):
+        """Calculates when the store opens next
+
+        :param moment: A datetime in the local time of the stores
+        :return: The moment itself if the store is open, the datetime it
+        opens next otherwise or None if it never opens
+        """
+        if not self.intervals:
+            return None
+        minute = minute_of_week(moment)
+        if self.is_open_at_minute(minute):
+            return moment
+        index = bisect_right(self._starts, minute)
+        if index < len(self._starts):
+            wait = self._starts[index] - minute
+        else:
+            wait = MINUTES_PER_WEEK - minute + self._starts[0]
+        start = moment.replace(second=0, microsecond=0)
+        return start + timedelta(minutes=wait)
+
+
+class OpeningHoursIndex(object):
+    """Object modeling an index of the stores by the time they are open.
+
+    The week is split in buckets and every bucket keeps the stores open for
+    all of it and the stores open for part of it. A query only checks the
+    hours of the stores open for part of its bucket. Stores without opening
+    hours in their payload, weekly or of the day, are not indexed and a
+    warning is logged if none of the stores has any, since no store would
+    ever be found open.
+    """
+    def __init__(self, stores, bucket_minutes=DEFAULT_BUCKET_MINUTES):
+        self.bucket_minutes = bucket_minutes
+        buckets = -(-MINUTES_PER_WEEK // bucket_minutes)
+        self._full = [set() for _ in range(buckets)]
+        self._partial = [set() for _ in range(buckets)]
+        self._stores = {}
+        self._positions = {}
+        count = 0
+        for position, store in enumerate(stores):
+            count += 1
+            hours = store.opening_hours
+            if not hours:
+                continue
+            self._stores[store.id] = store
+            self._positions[store.id] = position
+            for start, end in hours.intervals:
+                first = start // bucket_minutes
+                last = (end - 1) // bucket_minutes
+                for bucket in range(first, last + 1):
+                    bucket_start = bucket * bucket_minutes
+                    if (start <= bucket_start and
+                            end >= bucket_start + bucket_minutes):
+                        self._full[bucket].add(store.id)
+                    else:
+                        self._partial[bucket].add(store.id)
+        # a store fully open in a bucket through one interval is not partial
+        for full, partial in zip(self._full, self._partial):
+            partial.difference_update(full)
+        if count and not self._stores:
+            LOGGER.warning('None of the %s stores has opening hours in its '
+                           'payload, no store will be found open', count)
+
+    def __len__(self):
+        return len(self._stores)
+
+    def store_ids_open_at(self, moment):
+        """The ids of the stores open at a moment
+
+        :param moment: A datetime in the local time of the stores
+        :return: A set of store ids
+        """
+        minute = minute_of_week(moment)
+        bucket = minute // self.bucket_minutes
+        open_ids = set(self._full[bucket])
+        open_ids.update(
+            store_id for store_id in self._partial[bucket]
+            if self._stores[store_id].opening_hours.is_open_at_minute(minute))
+        return open_ids
+
+    def stores_open_at(self, moment):
+        """The stores open at a moment
+
+        :param moment: A datetime in the local time of the stores
+        :return: A list of store objects in the order of the stores payload
+        """
+        return [self._stores[store_id]
+                for store_id in sorted(self.store_ids_open_at(moment),
+                                       key=self._positions.get)]
+
+    @staticmethod
+    def next_opening(store, moment):
+        """Calculates when a store opens next
+
+        :param store: A store object
+        :param moment: A datetime in the local time of the stores
+        :return: The moment itself if the store is open, the datetime it
+        opens next otherwise or None if its hours are unknown
+        """
+        if not store.opening_hours:
+            return None
+        return store.opening_hours.next_opening(moment)
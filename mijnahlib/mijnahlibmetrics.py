@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: mijnahlibmetrics.py
+"""
+Metrics module file
+
+Holds the instrumentation of the requests made to the server
+"""
+
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    from urllib.parse import urlsplit, parse_qs
+except ImportError:  # pragma: no cover
+    from urlparse import urlsplit, parse_qs
+
+__author__ = '''Costas Tyfoxylos <costas.tyf@gmail.com>'''
+__docformat__ = 'plaintext'
+__date__ = '''10-05-2017'''
+
+LOGGER_BASENAME = '''mijnahlib'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+# The upper bounds in seconds of the latency histogram buckets.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+# Identifiers in paths are collapsed so endpoints do not explode in number.
+IDENTIFIER_PATTERN = re.compile(r'/(wi\d+|\d+)(?=/|$)')
+
+
+def endpoint_name(method, url):
+    """Calculates the name a request is accounted under
+
+    The delegate endpoint is named after the url it delegates to.
+
+    :param method: The http method of the request
+    :param url: The url of the request
+    :return: A string of the method and the normalized path
+    """
+    parts = urlsplit(url)
+    path = parts.path
+    if path.endswith('/delegate'):
+        delegated = parse_qs(parts.query).get('url', [''])[0]
+        path = '{path}?url={delegated}'.format(path=path,
+                                               delegated=delegated)
+    return '{method} {path}'.format(method=method,
+                                    path=IDENTIFIER_PATTERN.sub('/{id}', path))
+
+
+class _EndpointMetrics(object):
+    """Object modeling the metrics of a single endpoint"""
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.duration = 0.0
+        self.statuses = {}
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.retries = 0
+
+    def record(self, status, duration, request_bytes, response_bytes):
+        self.count += 1
+        self.duration += duration
+        self.request_bytes += request_bytes
+        self.response_bytes += response_bytes
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        for index, bound in enumerate(self.buckets):
+            if duration <= bound:
+                self.bucket_counts[index] += 1
+                break
+
+    def as_dict(self):
+        cumulative, buckets = 0, OrderedDict()
+        for bound, count in zip(self.buckets, self.bucket_counts):
+            cumulative += count
+            buckets[bound] = cumulative
+        buckets[float('inf')] = self.count
+        return {'count': self.count,
+                'duration': self.duration,
+                'buckets': buckets,
+                'statuses': dict(self.statuses),
+                'request_bytes': self.request_bytes,
+                'response_bytes': self.response_bytes,
+                'retries': self.retries}
+
+
+class Instrumentation(object):
+    """Object modeling the instrumentation of the requests to the server.
+
+    Once attached to a session it records the status, latency and payload
+    sizes of every response per endpoint in latency histograms. The metrics
+    can be exported as a dictionary or in the prometheus text format. An
+    optional span callback receives a dictionary describing every request.
+    A single instance can be attached to many sessions.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS, span_callback=None):
+        logger_name = '{base}.{suffix}'.format(base=LOGGER_BASENAME,
+                                               suffix=self.__class__.__name__)
+        self._logger = logging.getLogger(logger_name)
+        self.buckets = tuple(sorted(buckets))
+        self.span_callback = span_callback
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def attach(self, session):
+        """Registers the instrumentation as a response hook of a session
+
+        :param session: A requests session
+        """
+        session.hooks['response'].append(self._on_response)
+
+    def _metrics(self, endpoint):
+        metrics = self._endpoints.get(endpoint)
+        if metrics is None:
+            metrics = self._endpoints[endpoint] = _EndpointMetrics(
+                self.buckets)
+        return metrics
+
+    def _on_response(self, response, **kwargs):
+        request = response.request
+        body = request.body or b''
+        if kwargs.get('stream'):
+            # the body of streamed responses is not read here
+            response_bytes = int(response.headers.get('content-length', 0))
+        else:
+            response_bytes = len(response.content or b'')
+        self.record_response(request.method,
+                             request.url,
+                             response.status_code,
+                             response.elapsed.total_seconds(),
+                             len(body),
+                             response_bytes)
+        return response
+
+    def record_response(self, method, url, status, duration,
+                        request_bytes=0, response_bytes=0):
+        """Records a request and reports its span to the span callback
+
+        Clients that cannot be attached through a session hook, like the
+        asynchronous one, report their responses here.
+
+        :param method: The http method of the request
+        :param url: The url of the request
+        :param status: The status code of the response
+        :param duration: The duration of the request in seconds
+        :param request_bytes: The size of the request body
+        :param response_bytes: The size of the response body
+        """
+        endpoint = endpoint_name(method, url)
+        self.record(endpoint, status, duration, request_bytes, response_bytes)
+        if self.span_callback:
+            try:
+                self.span_callback({'endpoint': endpoint,
+                                    'method': method,
+                                    'url': url,
+                                    'status': status,
+                                    'start': time.time() - duration,
+                                    'duration': duration,
+                                    'request_bytes': request_bytes,
+                                    'response_bytes': response_bytes})
+            except Exception:  # pylint: disable=broad-except
+                self._logger.exception('Span callback failed')
+
+    def record(self, endpoint, status, duration,
+               request_bytes=0, response_bytes=0):
+        """Records a request
+
+        :param endpoint: The name of the endpoint
+        :param status: The status code of the response
+        :param duration: The duration of the request in seconds
+        :param request_bytes: The size of the request body
+        :param response_bytes: The size of the response body
+        """
+        with self._lock:
+            self._metrics(endpoint).record(status, duration,
+                                           request_bytes, response_bytes)
+
+    def record_retry(self, endpoint):
+        """Records a retry of a request
+
+        :param endpoint: The name of the endpoint
+        """
+        with self._lock:
+            self._metrics(endpoint).retries += 1
+
+    def as_dict(self):
+        """The metrics of all the endpoints as a dictionary"""
+        with self._lock:
+            return {endpoint: metrics.as_dict()
+                    for endpoint, metrics in self._endpoints.items()}
+
+    def to_prometheus(self, prefix='mijnahlib'):
+        """The metrics of all the endpoints in the prometheus text format
+
+        :param prefix: The prefix of the metric names
+        :return: The text of the exposition
+        """
+        metrics = self.as_dict()
+        lines = []
+
+        def header(name, kind, description):
+            lines.append('# HELP {prefix}_{name} {description}'.format(
+                prefix=prefix, name=name, description=description))
+            lines.append('# TYPE {prefix}_{name} {kind}'.format(
+                prefix=prefix, name=name, kind=kind))
+
+        def sample(name, labels, value):
+            text = ','.join('{}="{}"'.format(key, label.replace('"', '\\"'))
+                            for key, label in labels)
+            lines.append('{prefix}_{name}{{{labels}}} {value}'.format(
+                prefix=prefix, name=name, labels=text, value=value))
+
+        header('request_duration_seconds', 'histogram',
+               'Latency of the requests to the server.')
+        for endpoint in sorted(metrics):
+            values = metrics[endpoint]
+            for bound, count in values['buckets'].items():
+                bound = '+Inf' if bound == float('inf') else repr(bound)
+                sample('request_duration_seconds_bucket',
+                       (('endpoint', endpoint), ('le', bound)), count)
+            sample('request_duration_seconds_sum',
+                   (('endpoint', endpoint),), values['duration'])
+            sample('request_duration_seconds_count',
+                   (('endpoint', endpoint),), values['count'])
+        header('requests_total', 'counter',
+               'Requests to the server by response status.')
+        for endpoint in sorted(metrics):
+            for status, count in sorted(metrics[endpoint]['statuses'].items()):
+                sample('requests_total',
+                       (('endpoint', endpoint), ('status', str(status))),
+                       count)
+        for name, key, description in (
+                ('request_bytes_total', 'request_bytes',
+                 'Bytes sent in request bodies.'),
+                ('response_bytes_total', 'response_bytes',
+                 'Bytes received in response bodies.'),
+                ('retries_total', 'retries', 'Retried requests.')):
+            header(name, 'counter', description)
+            for endpoint in sorted(metrics):
+                sample(name, (('endpoint', endpoint),),
+                       metrics[endpoint][key])
+        return '\n'.join(lines) + '\n'
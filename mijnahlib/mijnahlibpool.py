@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: mijnahlibpool.py
+"""
+Pool module file
+
+Manages many accounts over a shared and bounded set of connections
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from requests.adapters import BaseAdapter, HTTPAdapter
+
+from .mijnahlib import LOGGER_BASENAME, DEFAULT_WORKERS, Server
+from .mijnahlibcache import StoreDirectoryCache
+from .mijnahlibretry import CircuitBreaker
+
+__author__ = '''Costas Tyfoxylos <costas.tyf@gmail.com>'''
+__docformat__ = 'plaintext'
+__date__ = '''10-05-2017'''
+
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+# The maximum number of open connections to the server shared by all the
+# accounts of a pool.
+DEFAULT_MAX_CONNECTIONS = 20
+
+AccountResult = namedtuple('AccountResult', ('username', 'result', 'error'))
+
+
+class TokenBucket(object):
+    """Object modeling a token bucket rate limiter.
+
+    Tokens are refilled at rate per second up to the capacity, which is at
+    least one token, acquiring blocks until a token is available.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        # a bucket that cannot hold a whole token would never hand one out
+        self.capacity = max(1.0, float(capacity or rate))
+        self._tokens = self.capacity
+        self._updated_at = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def acquire(self):
+        """Takes a token from the bucket waiting for one if needed"""
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class LatencyStats(object):
+    """Object modeling the latency statistics of an account"""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, duration):
+        """Records the duration of a request
+
+        :param duration: The duration in seconds
+        """
+        with self._lock:
+            self.count += 1
+            self.total += duration
+            self.maximum = max(self.maximum, duration)
+
+    def as_dict(self):
+        """The statistics as a dictionary"""
+        with self._lock:
+            return {'count': self.count,
+                    'total': self.total,
+                    'mean': self.total / self.count if self.count else 0.0,
+                    'max': self.maximum}
+
+
+class _AccountAdapter(BaseAdapter):
+    """Rate limits and times the requests of an account on a shared adapter"""
+    def __init__(self, adapter, buckets, latency):
+        super(_AccountAdapter, self).__init__()
+        self._adapter = adapter
+        self._buckets = buckets
+        self._latency = latency
+
+    def send(self, request, **kwargs):  # pylint: disable=arguments-differ
+        for bucket in self._buckets:
+            bucket.acquire()
+        start = time.time()
+        try:
+            return self._adapter.send(request, **kwargs)
+        finally:
+            self._latency.record(time.time() - start)
+
+    def close(self):
+        # the shared adapter is closed by the pool
+        pass
+
+
+class ServerPool(object):
+    """Object modeling a pool of servers of many accounts.
+
+    All the servers share a single connection pool that never opens more
+    than max_connections sockets, a store directory cache and a circuit
+    breaker, so a degraded endpoint is cut off for every account. Requests
+    are limited by a global and a per account token bucket and operations
+    can be fanned out over all the accounts on a bounded worker pool. A
+    transport adapter can replace the shared connection pool, to record,
+    replay or fake the interactions with the server.
+    """
+    def __init__(self,
+                 max_connections=DEFAULT_MAX_CONNECTIONS,
+                 workers=DEFAULT_WORKERS,
+                 global_rate=None,
+                 account_rate=None,
+                 store_cache=None,
+                 circuit_breaker=None,
+                 transport=None):
+        logger_name = '{base}.{suffix}'.format(base=LOGGER_BASENAME,
+                                               suffix=self.__class__.__name__)
+        self._logger = logging.getLogger(logger_name)
+        self.workers = workers
+        self.account_rate = account_rate
+        self._adapter = transport or HTTPAdapter(pool_maxsize=max_connections,
+                                                 pool_block=True)
+        self._global_bucket = TokenBucket(global_rate) if global_rate else None
+        self._store_cache = store_cache or StoreDirectoryCache()
+        self._circuit_breaker = circuit_breaker or CircuitBreaker()
+        self._servers = OrderedDict()
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._servers)
+
+    def __iter__(self):
+        return iter(list(self._servers.values()))
+
+    def __getitem__(self, username):
+        return self._servers[username]
+
+    def add(self, username, password, **kwargs):
+        """Adds an account to the pool
+
+        :param username: The username of the account
+        :param password: The password of the account
+        :param kwargs: Extra keyword arguments are passed to the Server, a
+        transport is used for the account instead of the shared one and is
+        rate limited and timed like it
+        :return: The Server object of the account
+        """
+        kwargs.setdefault('store_cache', self._store_cache)
+        kwargs.setdefault('circuit_breaker', self._circuit_breaker)
+        buckets = [bucket for bucket in (self._global_bucket,) if bucket]
+        if self.account_rate:
+            buckets.append(TokenBucket(self.account_rate))
+        latency = LatencyStats()
+        kwargs['transport'] = _AccountAdapter(kwargs.get('transport') or
+                                              self._adapter,
+                                              buckets,
+                                              latency)
+        server = Server(username, password, **kwargs)
+        with self._lock:
+            self._servers[username] = server
+            self._latencies[username] = latency
+        return server
+
+    def remove(self, username):
+        """Removes an account from the pool
+
+        :param username: The username of the account
+        """
+        with self._lock:
+            server = self._servers.pop(username)
+            self._latencies.pop(username)
+        server.session.close()
+
+    def map(self, function):
+        """Runs a function for every account on the worker pool
+
+        :param function: A callable accepting a Server object
+        :return: A dictionary of username to AccountResult objects
+        """
+        def run(server):
+            try:
+                return AccountResult(server.username, function(server), None)
+            except Exception as error:  # pylint: disable=broad-except
+                self._logger.error('Operation for %s failed with %s',
+                                   server.username, error)
+                return AccountResult(server.username, None, error)
+        servers = list(self)
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            results = executor.map(run, servers)
+            return OrderedDict((result.username, result)
+                               for result in results)
+
+    def contents(self):
+        """Retrieves the shopping cart contents of all the accounts
+
+        :return: A dictionary of username to AccountResult objects
+        """
+        return self.map(lambda server: server.shopping_cart.contents)
+
+    @property
+    def latencies(self):
+        """The request latency statistics per account"""
+        with self._lock:
+            latencies = list(self._latencies.items())
+        return OrderedDict((username, latency.as_dict())
+                           for username, latency in latencies)
+
+    def close(self):
+        """Closes the sessions of all the accounts and the shared pool"""
+        for server in self:
+            server.session.close()
+        self._adapter.close()
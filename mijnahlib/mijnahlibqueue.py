@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: mijnahlibqueue.py
+"""
+Queue module file
+
+Holds a durable write behind queue for the additions to a shopping cart
+"""
+
+import logging
+import sqlite3
+import threading
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .mijnahlib import (CONNECTION_POOL_SIZE,
+                        DEFAULT_WORKERS,
+                        LOGGER_BASENAME,
+                        ItemSubmission)
+from .mijnahlibexceptions import CircuitOpenError
+
+__author__ = '''Costas Tyfoxylos <costas.tyf@gmail.com>'''
+__docformat__ = 'plaintext'
+__date__ = '''10-05-2017'''
+
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+# How often in seconds the queue is flushed in the background.
+DEFAULT_FLUSH_INTERVAL = 0.5
+# The number of distinct pending items that triggers an early flush.
+DEFAULT_FLUSH_SIZE = 100
+
+SCHEMA = ('CREATE TABLE IF NOT EXISTS pending_items ('
+          'submission_type TEXT NOT NULL, '
+          'item TEXT NOT NULL, '
+          'quantity INTEGER NOT NULL DEFAULT 0, '
+          'in_flight INTEGER NOT NULL DEFAULT 0, '
+          'PRIMARY KEY (submission_type, item))')
+
+
+class WriteBehindQueue(object):
+    """Object modeling a durable write behind queue of cart additions.
+
+    Additions are written to a sqlite database file and return a future
+    right away. Repeated additions of an item are coalesced into a single
+    quantity and a background flusher submits them concurrently every
+    flush interval, or earlier once flush size items are pending. Items are
+    marked in flight while submitted, items in flight when a process died
+    are queued again on start so an addition is delivered at least once.
+    Additions the server did not answer, or answered with a server error,
+    stay queued and their futures pending until a later flush delivers
+    them. Additions the server rejected are dropped, as are additions that
+    failed with any other error, like invalid credentials, whose futures
+    fail with that error.
+    """
+    def __init__(self,
+                 cart,
+                 path,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 flush_size=DEFAULT_FLUSH_SIZE,
+                 workers=DEFAULT_WORKERS):
+        logger_name = '{base}.{suffix}'.format(base=LOGGER_BASENAME,
+                                               suffix=self.__class__.__name__)
+        self._logger = logging.getLogger(logger_name)
+        self._cart = cart
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.workers = max(1, min(workers, CONNECTION_POOL_SIZE))
+        self._database = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._futures = defaultdict(list)
+        self._wake = threading.Event()
+        self._closed = False
+        with self._database:
+            self._database.execute(SCHEMA)
+            recovered = self._database.execute(
+                'UPDATE pending_items SET quantity = quantity + in_flight, '
+                'in_flight = 0 WHERE in_flight > 0').rowcount
+        if recovered:
+            self._logger.warning('Queued %s items again that were in flight '
+                                 'when the queue was last used', recovered)
+        self._flusher = threading.Thread(target=self._run,
+                                         name='mijnahlib-write-behind')
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def __len__(self):
+        with self._lock:
+            return self._database.execute(
+                'SELECT COUNT(*) FROM pending_items WHERE quantity > 0'
+            ).fetchone()[0]
+
+    def put(self, submission_type, item, quantity=1):
+        """Queues the addition of an item
+
+        :param submission_type: PRODUCT for ids or UNSPECIFIED for
+        descriptions
+        :param item: The id or description of the item
+        :param quantity: The quantity as an integer
+        :return: A future resolving to the ItemSubmission of the flush that
+        delivered or rejected the addition
+        """
+        if self._closed:
+            raise RuntimeError('The write behind queue is closed')
+        future = Future()
+        key = submission_type, item
+        with self._lock:
+            with self._database:
+                updated = self._database.execute(
+                    'UPDATE pending_items SET quantity = quantity + ? '
+                    'WHERE submission_type = ? AND item = ?',
+                    (int(quantity), submission_type, item)).rowcount
+                if not updated:
+                    self._database.execute(
+                        'INSERT INTO pending_items (submission_type, item, '
+                        'quantity) VALUES (?, ?, ?)',
+                        (submission_type, item, int(quantity)))
+            self._futures[key].append(future)
+            pending = len(self._futures)
+        if pending >= self.flush_size:
+            self._wake.set()
+        return future
+
+    def _take(self):
+        # moves the pending quantities in flight along with their futures
+        with self._lock:
+            with self._database:
+                self._database.execute(
+                    'UPDATE pending_items SET in_flight = quantity, '
+                    'quantity = 0 WHERE quantity > 0')
+                rows = self._database.execute(
+                    'SELECT submission_type, item, in_flight FROM '
+                    'pending_items WHERE in_flight > 0').fetchall()
+            futures, self._futures = self._futures, defaultdict(list)
+        return rows, futures
+
+    @staticmethod
+    def _is_retried(submission):
+        # without an answer or with a server error the addition is sent
+        # again, any other answer or error is final
+        from requests.exceptions import RequestException
+        if submission.success:
+            return False
+        if submission.status_code is None:
+            return isinstance(submission.error,
+                              (RequestException, CircuitOpenError))
+        return (submission.status_code >= 500 or
+                submission.status_code == 429)
+
+    def _send(self, row):
+        submission_type, item, quantity = row
+        item_types = {'PRODUCT': 'id', 'UNSPECIFIED': 'description'}
+        try:
+            return self._cart._send_item(  # pylint: disable=protected-access
+                submission_type, item_types[submission_type], item, quantity)
+        except Exception as error:  # pylint: disable=broad-except
+            self._logger.error('Submitting item %s failed with %s',
+                               item, error)
+            return ItemSubmission(item, quantity, False, None, error)
+
+    def _settle(self, results, futures):
+        """Settles the rows of a flush
+
+        Rows to send again are queued with their futures, which are put in
+        front of the futures of additions made during the flush.
+
+        :param results: A list of (row, ItemSubmission) tuples
+        :param futures: The futures of the rows by item key
+        :return: A list of (future, ItemSubmission) tuples to resolve
+        """
+        resolved = []
+        with self._lock:
+            with self._database:
+                for (submission_type, item, _), result in results:
+                    key = submission_type, item
+                    if self._is_retried(result):
+                        self._database.execute(
+                            'UPDATE pending_items SET quantity = quantity + '
+                            'in_flight, in_flight = 0 WHERE '
+                            'submission_type = ? AND item = ?', key)
+                        self._futures[key][:0] = futures.pop(key, ())
+                        continue
+                    self._database.execute(
+                        'UPDATE pending_items SET in_flight = 0 WHERE '
+                        'submission_type = ? AND item = ?', key)
+                    resolved.extend((future, result)
+                                    for future in futures.pop(key, ()))
+                self._database.execute(
+                    'DELETE FROM pending_items WHERE quantity = 0 AND '
+                    'in_flight = 0')
+        return resolved
+
+    def flush(self):
+        """Submits the pending additions and waits for them
+
+        Additions that were not delivered stay queued for the next flush
+        and their futures stay pending. Additions that failed with an error
+        other than a transport one are dropped and their futures fail with
+        the error.
+
+        :return: A list of ItemSubmission results
+        """
+        with self._flush_lock:
+            rows, futures = self._take()
+            if not rows:
+                return []
+            workers = min(self.workers, len(rows))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                submissions = list(executor.map(self._send, rows))
+            for future, submission in self._settle(list(zip(rows,
+                                                            submissions)),
+                                                   futures):
+                if submission.status_code is None and submission.error:
+                    future.set_exception(submission.error)
+                else:
+                    future.set_result(submission)
+            self._logger.debug('Flushed %s items', len(rows))
+            return submissions
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:  # pylint: disable=broad-except
+                self._logger.exception('Flushing the write behind queue '
+                                       'failed')
+
+    def close(self):
+        """Flushes the pending additions and stops the background flusher
+
+        Additions still not delivered stay in the database for the next
+        queue on the same path, their futures fail.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self._flusher.join()
+        try:
+            self.flush()
+        finally:
+            with self._lock:
+                futures, self._futures = self._futures, defaultdict(list)
+            self._database.close()
+            error = RuntimeError('The write behind queue was closed before '
+                                 'the addition was delivered, it stays '
+                                 'queued in {}'.format(self.path))
+            for pending in futures.values():
+                for future in pending:
+                    future.set_exception(error)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: mijnahlibresolver.py
+"""
+Resolver module file
+
+Resolves free text descriptions to products with a local trigram index
+"""
+
+import logging
+import re
+import threading
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+__author__ = '''Costas Tyfoxylos <costas.tyf@gmail.com>'''
+__docformat__ = 'plaintext'
+__date__ = '''10-05-2017'''
+
+LOGGER_BASENAME = '''mijnahlib'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+# The share of the trigrams of a description that a product description has
+# to contain to be considered a match.
+DEFAULT_THRESHOLD = 0.6
+DEFAULT_SEARCH_WORKERS = 4
+
+NON_WORD_PATTERN = re.compile(r'[\W_]+', re.UNICODE)
+
+
+def normalize(description):
+    """Normalizes a description for matching
+
+    :param description: The text of the description
+    :return: The lowercase text with soft hyphens and punctuation removed
+    """
+    text = (description or u'').replace(u'\xad', u'').lower()
+    return u' '.join(NON_WORD_PATTERN.sub(u' ', text).split())
+
+
+def trigrams(text):
+    """Calculates the trigrams of a normalized text
+
+    :param text: The normalized text
+    :return: A set of the trigrams of every padded word
+    """
+    grams = set()
+    for word in text.split():
+        padded = u'  {} '.format(word)
+        grams.update(padded[index:index + 3]
+                     for index in range(len(padded) - 2))
+    return grams
+
+
+class DescriptionResolver(object):
+    """Object modeling a resolver of descriptions to product ids.
+
+    Product descriptions seen in the cart or in catalogue lookups are kept
+    in an inverted trigram index. A description resolves to the product
+    whose description contains the largest share of its trigrams, preferring
+    the closest in length and then the lowest id, so ties resolve the same
+    way every time. Only if nothing matches locally the remote search is
+    asked and its results are indexed for the next time.
+    """
+    def __init__(self, search=None, threshold=DEFAULT_THRESHOLD):
+        logger_name = '{base}.{suffix}'.format(base=LOGGER_BASENAME,
+                                               suffix=self.__class__.__name__)
+        self._logger = logging.getLogger(logger_name)
+        self.search = search
+        self.threshold = threshold
+        self._descriptions = {}
+        self._exact = {}
+        self._postings = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._descriptions)
+
+    def add(self, product_id, description):
+        """Indexes the description of a product
+
+        :param product_id: The internal id of the product
+        :param description: The description of the product
+        """
+        text = normalize(description)
+        if not product_id or not text:
+            return
+        with self._lock:
+            previous = self._descriptions.get(product_id)
+            if previous is not None and previous[0] == text:
+                return
+            if previous is not None:
+                for gram in previous[1]:
+                    self._postings[gram].discard(product_id)
+                if self._exact.get(previous[0]) == product_id:
+                    del self._exact[previous[0]]
+            grams = trigrams(text)
+            self._descriptions[product_id] = (text, grams)
+            self._exact.setdefault(text, product_id)
+            for gram in grams:
+                self._postings[gram].add(product_id)
+
+    def add_products(self, products):
+        """Indexes the descriptions of products
+
+        :param products: An iterable of Product objects, unspecified
+        products have no id and are left to the caller to filter out
+        """
+        for product in products:
+            self.add(product.id, product.description)
+
+    def _match(self, text):
+        grams = trigrams(text)
+        if not grams:
+            return None
+        with self._lock:
+            product_id = self._exact.get(text)
+            if product_id is not None:
+                return product_id
+            shared = defaultdict(int)
+            for gram in grams:
+                for candidate in self._postings.get(gram, ()):
+                    shared[candidate] += 1
+            best, best_score = None, None
+            for candidate, count in shared.items():
+                containment = float(count) / len(grams)
+                if containment < self.threshold:
+                    continue
+                size = len(self._descriptions[candidate][1])
+                score = (containment, float(count) / (len(grams) + size -
+                                                      count))
+                if (best_score is None or score > best_score or
+                        (score == best_score and candidate < best)):
+                    best, best_score = candidate, score
+            return best
+
+    def _search(self, text):
+        try:
+            self.add_products(self.search(text))
+        except Exception:  # pylint: disable=broad-except
+            self._logger.exception('Searching for %s failed', text)
+            return None
+        return self._match(text)
+
+    def resolve(self, description):
+        """Resolves a description to a product id
+
+        :param description: The free text description
+        :return: The internal id of the product or None if not found
+        """
+        text = normalize(description)
+        product_id = self._match(text)
+        if product_id is None and self.search is not None and text:
+            product_id = self._search(text)
+        return product_id
+
+    def resolve_many(self, descriptions, workers=DEFAULT_SEARCH_WORKERS):
+        """Resolves many descriptions to product ids
+
+        Descriptions are matched locally first and the remaining ones are
+        searched remotely concurrently.
+
+        :param descriptions: An iterable of free text descriptions
+        :param workers: The maximum number of concurrent remote searches
+        :return: A dictionary of description to product id or None
+        """
+        texts = OrderedDict((description, normalize(description))
+                            for description in descriptions)
+        matches = {text: self._match(text) for text in set(texts.values())}
+        missing = [text for text, product_id in matches.items()
+                   if product_id is None and text]
+        if missing and self.search is not None:
+            workers = max(1, min(workers, len(missing)))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                matches.update(zip(missing, executor.map(self._search,
+                                                         missing)))
+        return OrderedDict((description, matches[text])
+                           for description, text in texts.items())
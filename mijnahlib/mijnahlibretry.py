@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: mijnahlibretry.py
+"""
+Retry module file
+
+Holds the retry policy and the circuit breaker used for the requests
+"""
+
+import logging
+import random
+import threading
+import time
+
+from requests.exceptions import ConnectionError as RequestsConnectionError
+from requests.exceptions import ConnectTimeout, Timeout
+
+try:
+    from urllib3.exceptions import NewConnectionError
+except ImportError:  # pragma: no cover
+    from requests.packages.urllib3.exceptions import NewConnectionError
+
+from .mijnahlibexceptions import CircuitOpenError
+
+__author__ = '''Costas Tyfoxylos <costas.tyf@gmail.com>'''
+__docformat__ = 'plaintext'
+__date__ = '''10-05-2017'''
+
+LOGGER_BASENAME = '''mijnahlib'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'))
+
+# Statuses that are retried for idempotent requests.
+RETRY_STATUSES = frozenset((500, 502, 503, 504))
+
+# Statuses that mean the request was not processed, so retrying is safe even
+# for requests that are not idempotent.
+UNPROCESSED_STATUSES = frozenset((429, 503))
+
+
+def _was_not_sent(error):
+    if isinstance(error, ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+class RetryPolicy(object):
+    """Object modeling the retry policy of the requests.
+
+    Idempotent requests are retried on connection errors, timeouts and
+    server errors. Other requests, like adding to the cart, are only retried
+    when it is certain the server did not act on them, that is when the
+    connection could not be established or the server answered 429 or 503.
+    The delay grows exponentially with full jitter and honours a numeric
+    Retry-After header.
+    """
+    def __init__(self,
+                 max_retries=3,
+                 backoff_factor=0.5,
+                 max_backoff=10,
+                 jitter=True):
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+    def is_retryable(self, method, response=None, error=None):
+        """Decides whether a failed request can be retried
+
+        :param method: The http method of the request
+        :param response: The response if one was received
+        :param error: The exception raised if no response was received
+        :return: True if the request can be retried False otherwise
+        """
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        if error is not None:
+            if _was_not_sent(error):
+                return True
+            return idempotent and isinstance(error, (RequestsConnectionError,
+                                                     Timeout))
+        if response.status_code in UNPROCESSED_STATUSES:
+            return True
+        return idempotent and response.status_code in RETRY_STATUSES
+
+    def backoff(self, attempt, response=None):
+        """Calculates the delay before a retry
+
+        :param attempt: The number of the retry starting from 0
+        :param response: The response of the failed attempt if any
+        :return: The delay in seconds
+        """
+        # a failed response is falsy, so it is compared with None
+        retry_after = (response.headers.get('retry-after')
+                       if response is not None else None)
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.max_backoff)
+        delay = min(self.max_backoff, self.backoff_factor * 2 ** attempt)
+        return random.uniform(0, delay) if self.jitter else delay
+
+
+class CircuitBreaker(object):
+    """Object modeling a circuit breaker per endpoint.
+
+    After failure_threshold consecutive failures of an endpoint its circuit
+    opens and requests to it fail fast with CircuitOpenError. Once the reset
+    timeout passes a single trial request is let through, closing the
+    circuit on success and opening it again on failure. A single instance
+    can be shared between servers.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        logger_name = '{base}.{suffix}'.format(base=LOGGER_BASENAME,
+                                               suffix=self.__class__.__name__)
+        self._logger = logging.getLogger(logger_name)
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        # endpoint to [consecutive failures, opened at, trial in progress]
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def before(self, endpoint):
+        """Checks whether a request to an endpoint is allowed
+
+        :param endpoint: The name of the endpoint
+        :raises CircuitOpenError: If the circuit of the endpoint is open
+        """
+        with self._lock:
+            state = self._states.get(endpoint)
+            if not state or state[1] is None:
+                return
+            if time.time() - state[1] < self.reset_timeout or state[2]:
+                raise CircuitOpenError(endpoint)
+            state[2] = True
+
+    def success(self, endpoint):
+        """Records a successful request to an endpoint
+
+        :param endpoint: The name of the endpoint
+        """
+        with self._lock:
+            if self._states.pop(endpoint, None):
+                self._logger.info('Circuit of %s closed', endpoint)
+
+    def failure(self, endpoint):
+        """Records a failed request to an endpoint
+
+        :param endpoint: The name of the endpoint
+        """
+        with self._lock:
+            state = self._states.setdefault(endpoint, [0, None, False])
+            state[0] += 1
+            if state[2] or (state[1] is None and
+                            state[0] >= self.failure_threshold):
+                self._logger.warning('Circuit of %s opened', endpoint)
+                state[1], state[2] = time.time(), False
+
+    def is_open(self, endpoint):
+        """Whether the circuit of an endpoint is open
+
+        :param endpoint: The name of the endpoint
+        :return: True if requests to the endpoint are rejected
+        """
+        with self._lock:
+            state = self._states.get(endpoint)
+            return bool(state and state[1] is not None)
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: mijnahlibstream.py
+"""
+Streaming module file
+
+Holds an incremental json parser for the large responses of the server
+"""
+
+import codecs
+import logging
+from json.decoder import scanstring
+
+__author__ = '''Costas Tyfoxylos <costas.tyf@gmail.com>'''
+__docformat__ = 'plaintext'
+__date__ = '''10-05-2017'''
+
+LOGGER_BASENAME = '''mijnahlib'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+WHITESPACE = ' \t\n\r'
+NUMBER_CHARACTERS = '+-0123456789.eE'
+CLOSING = {'}': 'map', ']': 'array'}
+LITERALS = {'t': ('true', True), 'f': ('false', False), 'n': ('null', None)}
+
+LANES_PATH = ('_embedded', 'lanes', 'item')
+LANE_TYPE_PATH = LANES_PATH + ('type',)
+LANE_ITEMS_PATH = LANES_PATH + ('_embedded', 'items', 'item')
+
+
+class _Reader(object):
+    """Buffers decoded text from an iterable of byte or text chunks"""
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = u''
+        self.position = 0
+        self.exhausted = False
+
+    def fill(self):
+        """Reads the next chunk into the buffer
+
+        :return: False when there is nothing left to read
+        """
+        if self.exhausted:
+            return False
+        # drop what has been consumed so the buffer stays small
+        self.buffer = self.buffer[self.position:]
+        self.position = 0
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self.exhausted = True
+            self.buffer += self._decoder.decode(b'', final=True)
+            return False
+        if isinstance(chunk, bytes):
+            chunk = self._decoder.decode(chunk)
+        self.buffer += chunk
+        return True
+
+    def peek(self):
+        """Skips whitespace and returns the next character or None at end"""
+        while True:
+            while self.position < len(self.buffer):
+                character = self.buffer[self.position]
+                if character not in WHITESPACE:
+                    return character
+                self.position += 1
+            if not self.fill():
+                return None
+
+
+def _read_string(reader):
+    # the reader is positioned on the opening quote
+    while True:
+        try:
+            value, end = scanstring(reader.buffer, reader.position + 1)
+        except ValueError:
+            if not reader.fill():
+                raise
+            continue
+        reader.position = end
+        return value
+
+
+def _read_number(reader):
+    while True:
+        end = reader.position
+        while (end < len(reader.buffer) and
+               reader.buffer[end] in NUMBER_CHARACTERS):
+            end += 1
+        if end < len(reader.buffer) or not reader.fill():
+            break
+    text = reader.buffer[reader.position:end]
+    reader.position = end
+    if any(character in text for character in '.eE'):
+        return float(text)
+    return int(text)
+
+
+def _read_literal(reader):
+    literal, value = LITERALS[reader.buffer[reader.position]]
+    while len(reader.buffer) - reader.position < len(literal):
+        if not reader.fill():
+            break
+    if reader.buffer[reader.position:reader.position + len(literal)] != literal:
+        raise ValueError('Invalid literal at {}'.format(reader.position))
+    reader.position += len(literal)
+    return value
+
+
+def parse_events(chunks):
+    """Parses json incrementally from chunks of text or bytes
+
+    :param chunks: An iterable of byte or text chunks
+    :return: A generator of (path, event, value) tuples where the path is a
+    tuple of the keys leading to the event, with 'item' for array entries,
+    and the event one of start_map, map_key, end_map, start_array,
+    end_array and value
+    """
+    reader = _Reader(chunks)
+    # every entry is [container type, path, expecting a key]
+    stack = []
+    while True:
+        character = reader.peek()
+        if character is None:
+            if stack:
+                raise ValueError('Incomplete json document')
+            return
+        if stack and character == ',':
+            reader.position += 1
+            if stack[-1][0] == 'map':
+                stack[-1][2] = True
+            continue
+        if stack and character in CLOSING:
+            if CLOSING[character] != stack[-1][0]:
+                raise ValueError('Unexpected {!r} at {}'.format(
+                    character, reader.position))
+            reader.position += 1
+            container, path, _ = stack.pop()
+            yield path, 'end_{}'.format(container), None
+            continue
+        if stack and stack[-1][0] == 'map':
+            if character != '"' or not stack[-1][2]:
+                raise ValueError('Expected key at {}'.format(reader.position))
+            key = _read_string(reader)
+            if reader.peek() != ':':
+                raise ValueError('Expected : at {}'.format(reader.position))
+            reader.position += 1
+            stack[-1][2] = False
+            yield stack[-1][1], 'map_key', key
+            path = stack[-1][1] + (key,)
+        elif stack:
+            path = stack[-1][1] + ('item',)
+        else:
+            path = ()
+        character = reader.peek()
+        if character == '{':
+            reader.position += 1
+            stack.append(['map', path, True])
+            yield path, 'start_map', None
+        elif character == '[':
+            reader.position += 1
+            stack.append(['array', path, False])
+            yield path, 'start_array', None
+        elif character == '"':
+            yield path, 'value', _read_string(reader)
+        elif character in LITERALS:
+            yield path, 'value', _read_literal(reader)
+        elif character is not None and character in NUMBER_CHARACTERS:
+            yield path, 'value', _read_number(reader)
+        else:
+            raise ValueError('Unexpected {!r} at {}'.format(character,
+                                                             reader.position))
+
+
+class _Builder(object):
+    """Assembles python objects from parser events"""
+    def __init__(self):
+        self._containers = []
+        self._keys = []
+        self.value = None
+
+    def _add(self, value):
+        if not self._containers:
+            self.value = value
+        elif isinstance(self._containers[-1], list):
+            self._containers[-1].append(value)
+        else:
+            self._containers[-1][self._keys.pop()] = value
+
+    def event(self, event, value):
+        """Feeds an event to the builder
+
+        :return: True when the top level object is complete
+        """
+        if event == 'map_key':
+            self._keys.append(value)
+        elif event in ('start_map', 'start_array'):
+            container = {} if event == 'start_map' else []
+            self._add(container)
+            self._containers.append(container)
+        elif event in ('end_map', 'end_array'):
+            self._containers.pop()
+        else:
+            self._add(value)
+        return not self._containers
+
+
+def iter_lane_items(chunks, lane_type):
+    """Yields the items of the lanes of a type as they are decoded
+
+    Items of lanes of other types are skipped and, when the type of the lane
+    precedes its items in the payload, never built.
+
+    :param chunks: An iterable of byte or text chunks of the payload
+    :param lane_type: The type of the lanes to yield the items of
+    :return: A generator of item payloads
+    """
+    current_type = None
+    pending = []
+    builder = None
+    for path, event, value in parse_events(chunks):
+        if builder is None:
+            if path == LANE_TYPE_PATH and event == 'value':
+                current_type = value
+                if current_type == lane_type:
+                    for item in pending:
+                        yield item
+                pending = []
+                continue
+            if path == LANES_PATH and event == 'end_map':
+                current_type, pending = None, []
+                continue
+            if (path != LANE_ITEMS_PATH or
+                    event not in ('start_map', 'start_array', 'value') or
+                    current_type not in (None, lane_type)):
+                continue
+            builder = _Builder()
+        if not builder.event(event, value):
+            continue
+        item, builder = builder.value, None
+        if current_type == lane_type:
+            yield item
+        elif current_type is None:
+            pending.append(item)
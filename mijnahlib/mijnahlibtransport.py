@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: mijnahlibtransport.py
+"""
+Transport module file
+
+Holds transports that record, replay or fake the interactions with the
+server so the library can be exercised without network or credentials
+"""
+
+import base64
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict, deque
+from email.message import Message
+
+try:
+    from urllib.parse import urlsplit, parse_qs
+except ImportError:  # pragma: no cover
+    from urlparse import urlsplit, parse_qs
+
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.cookies import extract_cookies_to_jar
+from requests.exceptions import ConnectionError as RequestsConnectionError
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+from .mijnahlib import LOGGER_BASENAME, LOGIN_ERROR_MESSAGE, LOGIN_PATH
+
+__author__ = '''Costas Tyfoxylos <costas.tyf@gmail.com>'''
+__docformat__ = 'plaintext'
+__date__ = '''10-05-2017'''
+
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+SESSION_COOKIE = 'fake_session'
+ITEMS_PATH = '/service/rest/shoppinglists/0/items'
+PRODUCT_PATH = '/producten/product/'
+SEARCH_PATH = '/zoeken'
+
+
+class _Headers(Message):
+    """The headers of a raw response as both python versions read them"""
+    def getheaders(self, name):
+        return self.get_all(name, [])
+
+
+class _RawResponse(object):
+    """Stands in for the urllib3 response so cookies can be extracted"""
+    def __init__(self, headers):
+        self._original_response = self
+        self.msg = _Headers()
+        for name, value in headers:
+            self.msg[name] = value
+
+    def close(self):
+        pass
+
+
+def build_response(request, status, headers=(), body=b''):
+    """Builds a response object for a request without any network
+
+    :param request: The prepared request the response belongs to
+    :param status: The status code of the response
+    :param headers: A sequence of (name, value) header tuples
+    :param body: The body of the response in bytes
+    :return: A requests Response object
+    """
+    response = Response()
+    response.request = request
+    response.url = request.url
+    response.status_code = status
+    response.headers = CaseInsensitiveDict(headers)
+    response.encoding = 'utf-8'
+    response.raw = _RawResponse(headers)
+    response._content = body  # pylint: disable=protected-access
+    response._content_consumed = True  # pylint: disable=protected-access
+    extract_cookies_to_jar(response.cookies, request, response.raw)
+    return response
+
+
+def _encode_body(body):
+    if body is None:
+        return None
+    if not isinstance(body, bytes):
+        body = body.encode('utf-8')
+    try:
+        return {'text': body.decode('utf-8')}
+    except UnicodeDecodeError:
+        return {'base64': base64.b64encode(body).decode('ascii')}
+
+
+def _decode_body(body):
+    if body is None:
+        return b''
+    if 'base64' in body:
+        return base64.b64decode(body['base64'])
+    return body['text'].encode('utf-8')
+
+
+class RecordingAdapter(HTTPAdapter):
+    """Object modeling a transport that records the real interactions.
+
+    Every request and response passing through is kept in a cassette that
+    can be saved and later served by a ReplayAdapter.
+    """
+    def __init__(self, path, **kwargs):
+        super(RecordingAdapter, self).__init__(**kwargs)
+        self.path = path
+        self.interactions = []
+        self._lock = threading.Lock()
+
+    def send(self, request, **kwargs):  # pylint: disable=arguments-differ
+        kwargs['stream'] = False
+        response = super(RecordingAdapter, self).send(request, **kwargs)
+        # the raw headers keep repeated headers like Set-Cookie apart
+        headers = getattr(response.raw, 'headers', response.headers)
+        interaction = {'request': {'method': request.method,
+                                   'url': request.url,
+                                   'body': _encode_body(request.body)},
+                       'response': {'status': response.status_code,
+                                    'headers': list(headers.items()),
+                                    'body': _encode_body(response.content)}}
+        with self._lock:
+            self.interactions.append(interaction)
+        return response
+
+    def save(self):
+        """Writes the recorded interactions to the cassette"""
+        with self._lock:
+            with open(self.path, 'w') as cassette:
+                json.dump({'interactions': self.interactions}, cassette,
+                          indent=2)
+
+
+class ReplayAdapter(BaseAdapter):
+    """Object modeling a transport that replays a recorded cassette.
+
+    Requests are matched on their method and url, repeated requests get the
+    recorded responses in order and the last one once they run out.
+    Unmatched requests raise a ConnectionError.
+    """
+    def __init__(self, path):
+        super(ReplayAdapter, self).__init__()
+        self.path = path
+        with open(path) as cassette:
+            interactions = json.load(cassette).get('interactions', [])
+        self._responses = defaultdict(deque)
+        for interaction in interactions:
+            request = interaction['request']
+            self._responses[(request['method'],
+                             request['url'])].append(interaction['response'])
+        self._lock = threading.Lock()
+
+    def send(self, request, **kwargs):  # pylint: disable=arguments-differ
+        with self._lock:
+            responses = self._responses.get((request.method, request.url))
+            if not responses:
+                raise RequestsConnectionError(
+                    'No recorded interaction for {} {}'.format(request.method,
+                                                               request.url),
+                    request=request)
+            recorded = (responses.popleft() if len(responses) > 1
+                        else responses[0])
+        headers = [tuple(header) for header in recorded['headers']]
+        return build_response(request,
+                              recorded['status'],
+                              headers,
+                              _decode_body(recorded['body']))
+
+    def close(self):
+        pass
+
+
+def fake_product(product_id, price=None, discount=False):
+    """Builds a product payload like the ones the server provides
+
+    :param product_id: The internal id of the product
+    :param price: The price of the product, derived from the id if not set
+    :param discount: Whether the product is on discount
+    :return: A dictionary of the product payload
+    """
+    number = int(''.join(character for character in product_id
+                         if character.isdigit()) or 0)
+    if price is None:
+        price = round(0.5 + number % 1000 / 100.0, 2)
+    previous_price = round(price * 1.25, 2) if discount else None
+    return {'id': product_id,
+            'description': u'Product\xad {}'.format(number),
+            'brandName': 'AH',
+            'categoryName': 'Category {}'.format(number % 10),
+            'unitSize': '1 stuk',
+            'availability': {'orderable': True},
+            'priceLabel': {'now': price, 'was': previous_price},
+            'discount': {'label': '25% korting'} if discount else None}
+
+
+class FakeServer(BaseAdapter):
+    """Object modeling an in process fake of the server.
+
+    It simulates the login, the session probe, the store directory, the
+    product pages and search, the shopping list delegate and the item
+    submissions, updates and removals for a set of accounts, with a
+    configurable latency per request and a rate of 503 errors. It is mounted
+    as the transport of a Server.
+    """
+    def __init__(self,
+                 accounts=None,
+                 stores=None,
+                 services=None,
+                 products=None,
+                 latency=0,
+                 error_rate=0,
+                 seed=None):
+        logger_name = '{base}.{suffix}'.format(base=LOGGER_BASENAME,
+                                               suffix=self.__class__.__name__)
+        super(FakeServer, self).__init__()
+        self._logger = logging.getLogger(logger_name)
+        self.accounts = dict(accounts or {})
+        self.stores = stores if stores is not None else []
+        self.services = services if services is not None else {}
+        self.products = products if products is not None else []
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.carts = defaultdict(OrderedDict)
+        self._sessions = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def send(self, request, **kwargs):  # pylint: disable=arguments-differ
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.requests += 1
+            if self.error_rate and self._random.random() < self.error_rate:
+                return build_response(request, 503, body=b'Unavailable')
+            return self._handle(request)
+
+    def close(self):
+        pass
+
+    def _username(self, request):
+        cookies = request.headers.get('Cookie', '')
+        for cookie in cookies.split(';'):
+            name, _, value = cookie.strip().partition('=')
+            if name == SESSION_COOKIE:
+                return self._sessions.get(value)
+        return None
+
+    @staticmethod
+    def _json(request, payload, status=200):
+        return build_response(request,
+                              status,
+                              [('Content-Type', 'application/json')],
+                              json.dumps(payload).encode('utf-8'))
+
+    @staticmethod
+    def _redirect(request, location, cookie=None):
+        headers = [('Location', location)]
+        if cookie:
+            headers.append(('Set-Cookie', cookie))
+        return build_response(request, 302, headers)
+
+    def _handle(self, request):
+        parts = urlsplit(request.url)
+        path, method = parts.path, request.method
+        username = self._username(request)
+        if path == LOGIN_PATH + '/basis' and method == 'POST':
+            return self._login(request)
+        if path == '/data/winkelinformatie/winkels/json':
+            return self._json(request, {'stores': self.stores,
+                                        'services': self.services})
+        if path.startswith('/mijn') and not path.startswith(LOGIN_PATH):
+            if username is None:
+                return self._redirect(request, LOGIN_PATH)
+            return build_response(request, 200, body=b'<html></html>')
+        if path == '/service/rest/delegate':
+            delegated = parse_qs(parts.query).get('url', [''])[0]
+            if delegated.startswith(PRODUCT_PATH):
+                return self._product_page(request,
+                                          delegated[len(PRODUCT_PATH):])
+            if delegated.startswith(SEARCH_PATH + '?'):
+                query = parse_qs(delegated.partition('?')[2]).get('rq', [''])
+                return self._search(request, query[0])
+        if username is None:
+            return build_response(request, 401, body=b'Unauthorized')
+        if path == '/service/rest/delegate':
+            delegated = parse_qs(parts.query).get('url', [''])[0]
+            if delegated == '/mijnlijst':
+                return self._json(request, self._shopping_list(username))
+        if path == ITEMS_PATH and method == 'POST':
+            return self._add_item(request, username)
+        if path.startswith(ITEMS_PATH + '/') and method in ('PATCH',
+                                                            'DELETE'):
+            return self._change_item(request, username,
+                                     path[len(ITEMS_PATH) + 1:])
+        return build_response(request, 404, body=b'Not found')
+
+    def _login(self, request):
+        form = parse_qs(request.body or '')
+        username = form.get('userName', [None])[0]
+        password = form.get('password', [None])[0]
+        if self.accounts.get(username) != password or password is None:
+            body = (u'<html><div class="error_notices"><p>{}</p></div>'
+                    u'</html>').format(LOGIN_ERROR_MESSAGE)
+            return build_response(request, 200, body=body.encode('utf-8'))
+        token = uuid.uuid4().hex
+        self._sessions[token] = username
+        return self._redirect(request, '/mijn/welkom',
+                              '{}={}; Path=/'.format(SESSION_COOKIE, token))
+
+    def _product_page(self, request, product_id):
+        if not product_id.startswith('wi'):
+            return build_response(request, 404, body=b'Not found')
+        item = {'type': 'ProductDetail',
+                '_embedded': {'product': fake_product(product_id)}}
+        return self._json(request, {'_embedded': {'lanes': [
+            {'type': 'ProductDetailLane', '_embedded': {'items': [item]}}]}})
+
+    def _search(self, request, query):
+        words = query.lower().split()
+        items = [{'type': 'Product', '_embedded': {'product': product}}
+                 for product in self.products
+                 if all(word in product.get('description', u'').replace(
+                     u'\xad', u'').lower() for word in words)]
+        return self._json(request, {'_embedded': {'lanes': [
+            {'type': 'SearchLane', '_embedded': {'items': items}}]}})
+
+    def _add_item(self, request, username):
+        data = json.loads(request.body)
+        item = data.get('item', {})
+        quantity = int(data.get('quantity', 1))
+        if data.get('type') == 'PRODUCT':
+            key = ('product', item.get('id'))
+        else:
+            key = ('unspecified', item.get('description'))
+        cart = self.carts[username]
+        if key in cart:
+            cart[key]['quantity'] += quantity
+        else:
+            cart[key] = {'id': uuid.uuid4().hex, 'quantity': quantity}
+        return self._json(request, {'id': cart[key]['id']})
+
+    def _change_item(self, request, username, list_item_id):
+        cart = self.carts[username]
+        for key, entry in cart.items():
+            if entry['id'] == list_item_id:
+                break
+        else:
+            return build_response(request, 404, body=b'Not found')
+        if request.method == 'DELETE':
+            del cart[key]
+            return build_response(request, 204)
+        entry['quantity'] = int(json.loads(request.body)['quantity'])
+        return self._json(request, {'id': list_item_id})
+
+    def _shopping_list(self, username):
+        items = []
+        for (kind, identifier), entry in self.carts[username].items():
+            list_item = {'id': entry['id'], 'quantity': entry['quantity']}
+            if kind == 'product':
+                items.append({'type': 'Product',
+                              'navItem': {'link': {'href': '/producten/'
+                                                           'product/{}'.format(
+                                                               identifier)}},
+                              '_embedded': {'listItem': list_item,
+                                            'product': fake_product(
+                                                identifier)}})
+            else:
+                items.append({'type': 'UnspecifiedItem',
+                              'description': identifier,
+                              '_embedded': {'listItem': list_item}})
+        return {'_embedded': {'lanes': [
+            {'type': 'ShoppingListLane', '_embedded': {'items': items}}]}}
@@ -31,6 +31,10 @@ setup(
                  '''mijnahlib'''},
     include_package_data=True,
     install_requires=requirements,
+    extras_require={'numpy': ['numpy'], 'async': ['httpx']},
+    entry_points={
+        'console_scripts': ['mijnahlib = mijnahlib.mijnahlibcli:main'],
+    },
     license='''Copyright (c) 2017, (Costas Tyfoxylos). All rights reserved.''',
     zip_safe=False,
     keywords='''mijnahlib''',
@@ -0,0 +1,502 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+benchmarks
+----------------------------------
+Benchmarks of `mijnahlib` against the in process fake server.
+
+They are not part of the test run, run them with::
+
+    python -m tests.benchmarks
+
+Every benchmark logs its timings and asserts only a loose relation
+between the compared approaches, so they stay stable on slow or busy
+machines.
+"""
+
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:  # pragma: no cover
+    import mock
+
+try:
+    import tracemalloc
+except ImportError:  # pragma: no cover
+    tracemalloc = None
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:  # pragma: no cover
+    BeautifulSoup = None
+
+from requests.adapters import HTTPAdapter
+
+from mijnahlib import (InvalidCredentials,
+                       ProductCache,
+                       Server,
+                       SessionStore,
+                       StoreDirectoryCache,
+                       StoreIndex)
+from mijnahlib.mijnahlib import (LOGIN_ERROR_MESSAGE,
+                                 ItemFactory,
+                                 Store,
+                                 extract_error_notice)
+from mijnahlib.mijnahlibgeo import distance_km
+from mijnahlib.mijnahlibtransport import (FakeServer,
+                                          RecordingAdapter,
+                                          ReplayAdapter,
+                                          fake_product)
+
+LOGGER = logging.getLogger('benchmarks')
+
+USERNAME = 'user@example.com'
+PASSWORD = 'secret'
+ACCOUNTS = {USERNAME: PASSWORD}
+# Every request to the fake server takes this long, like a fast network.
+LATENCY = 0.005
+
+
+def stores(count):
+    """Builds the payloads of stores spread over the netherlands
+
+    :param count: The number of stores
+    :return: A list of store payloads, the same on every run
+    """
+    generator = random.Random(count)
+    return [{'no': number,
+             'city': 'City {}'.format(number % 50),
+             'street': 'Straat',
+             'housenr': str(number),
+             'zip': '1234AB',
+             'format': ('AH', 'AH XL', 'AH to go')[number % 3],
+             'lat': generator.uniform(50.8, 53.5),
+             'lng': generator.uniform(3.4, 7.2),
+             'sunday': number % 2 == 0,
+             'openEvening': number % 3 == 0,
+             'status': u'Vandaag open 08:00 - 22:00'}
+            for number in range(count)]
+
+
+def cart_lines(count, start=0):
+    """Builds the payloads of shopping cart lines like the server does
+
+    :param count: The number of product lines
+    :param start: The number of the first product
+    :return: A list of item payloads
+    """
+    return [{'type': 'Product',
+             'navItem': {'link': {'href': '/producten/product/wi{}'.format(
+                 number)}},
+             '_embedded': {'listItem': {'id': 'entry{}'.format(number),
+                                        'quantity': 1 + number % 3},
+                           'product': fake_product('wi{}'.format(number),
+                                                   discount=number % 4 == 0)}}
+            for number in range(start, start + count)]
+
+
+def best_of(function, repeat=3):
+    """Runs a function a few times
+
+    :param function: The function to time
+    :param repeat: The number of runs
+    :return: The seconds of the fastest run
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        function()
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def report(name, **timings):
+    """Logs the timings of a benchmark in milliseconds
+
+    :param name: The name of the benchmark
+    :param timings: The seconds each compared approach took
+    """
+    LOGGER.info('%s: %s', name, ', '.join(
+        '{} {:.2f}ms'.format(label, seconds * 1000)
+        for label, seconds in sorted(timings.items())))
+
+
+class TestBulkAddBenchmarks(unittest.TestCase):
+
+    def test_throughput(self):
+        items = [('wi{}'.format(number), 1) for number in range(60)]
+        throughput = {}
+        for workers in (1, 4, 8):
+            fake = FakeServer(ACCOUNTS, latency=LATENCY)
+            cart = Server(USERNAME, PASSWORD, transport=fake).shopping_cart
+            cart.add_item_by_id('wi0')
+            start = time.time()
+            # a single worker is the loop over add_item_by_id
+            if workers == 1:
+                for item, quantity in items:
+                    cart.add_item_by_id(item, quantity)
+            else:
+                results = cart.add_items(items, workers)
+                self.assertTrue(all(result.success for result in results))
+            throughput[workers] = len(items) / (time.time() - start)
+            self.assertEqual(fake.carts[USERNAME][('product', 'wi0')]
+                             ['quantity'], 2)
+            self.assertEqual(len(fake.carts[USERNAME]), len(items))
+        LOGGER.info('bulk add throughput: %s', ', '.join(
+            '{} workers {:.0f} items/s'.format(workers, rate)
+            for workers, rate in sorted(throughput.items())))
+        self.assertGreater(throughput[4], throughput[1])
+        self.assertGreater(throughput[8], throughput[4])
+
+
+class TestLoginBenchmarks(unittest.TestCase):
+
+    def test_stored_session(self):
+        fake = FakeServer(ACCOUNTS, latency=LATENCY)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        store = SessionStore(directory)
+        Server(USERNAME, PASSWORD, session_store=store,
+               transport=fake)._ensure_authenticated()
+
+        def login():
+            Server(USERNAME, PASSWORD,
+                   transport=fake)._ensure_authenticated()
+
+        def resume():
+            Server(USERNAME, PASSWORD, session_store=store,
+                   transport=fake)._ensure_authenticated()
+
+        login_time, resume_time = best_of(login), best_of(resume)
+        report('login', login=login_time, resumed=resume_time)
+        self.assertLess(resume_time, login_time)
+
+
+class TestStoreDirectoryBenchmarks(unittest.TestCase):
+
+    def test_cached_lookups(self):
+        fake = FakeServer(ACCOUNTS, stores=stores(1000), latency=LATENCY)
+        server = Server(USERNAME, PASSWORD, transport=fake,
+                        store_cache=StoreDirectoryCache(ttl=3600))
+
+        def fetched():
+            server._store_cache.invalidate()
+            return server.stores
+
+        fetch_time = best_of(fetched)
+        requests = fake.requests
+        cached_time = best_of(lambda: server.stores)
+        report('store directory of 1000 stores', fetched=fetch_time,
+               cached=cached_time)
+        self.assertEqual(fake.requests, requests)
+        self.assertLess(cached_time * 10, fetch_time)
+
+
+class TestStoreIndexBenchmarks(unittest.TestCase):
+
+    def setUp(self):
+        self.stores = [Store(info) for info in stores(5000)]
+        self.points = [(51.0 + number * 0.07, 3.6 + number * 0.19)
+                       for number in range(20)]
+
+    def scan(self, latitude, longitude):
+        distances = ((distance_km(latitude, longitude,
+                                  store.latitude, store.longtitude), store)
+                     for store in self.stores)
+        return sorted(distances, key=lambda entry: entry[0])
+
+    def test_nearest(self):
+        index = StoreIndex(self.stores)
+        for latitude, longitude in self.points:
+            expected = [store.id for _, store
+                        in self.scan(latitude, longitude)[:5]]
+            self.assertEqual([store.id for _, store
+                              in index.nearest(latitude, longitude, k=5)],
+                             expected)
+        scan_time = best_of(lambda: [self.scan(*point)[:5]
+                                     for point in self.points])
+        index_time = best_of(lambda: [index.nearest(latitude, longitude, k=5)
+                                      for latitude, longitude
+                                      in self.points])
+        report('nearest 5 of 5000 stores', scan=scan_time, index=index_time)
+        self.assertLess(index_time, scan_time)
+
+    def test_within(self):
+        index = StoreIndex(self.stores)
+        latitude, longitude = self.points[5]
+        expected = [store.id for distance, store
+                    in self.scan(latitude, longitude) if distance <= 10]
+        self.assertEqual([store.id for _, store
+                          in index.within(latitude, longitude, 10)],
+                         expected)
+        scan_time = best_of(lambda: [entry for entry
+                                     in self.scan(latitude, longitude)
+                                     if entry[0] <= 10])
+        index_time = best_of(lambda: index.within(latitude, longitude, 10))
+        report('stores within 10km', scan=scan_time, index=index_time)
+        self.assertLess(index_time, scan_time)
+
+
+class TestCartBenchmarks(unittest.TestCase):
+
+    def test_cart_reads(self):
+        cart = Server(USERNAME, PASSWORD,
+                      transport=FakeServer(ACCOUNTS,
+                                           latency=LATENCY)).shopping_cart
+        cart.add_items([('wi{}'.format(number), 1) for number in range(200)])
+
+        def refreshed():
+            cart.invalidate()
+            return cart.contents
+
+        refresh_time = best_of(refreshed)
+        cached_time = best_of(lambda: cart.contents)
+        report('reads of a 200 item cart', refreshed=refresh_time,
+               cached=cached_time)
+        self.assertEqual(len(cart.contents), 200)
+        self.assertLess(cached_time, refresh_time)
+
+
+class TestProductCatalogueBenchmarks(unittest.TestCase):
+
+    def test_lookups(self):
+        fake = FakeServer(ACCOUNTS, latency=LATENCY)
+        product_ids = ['wi{}'.format(number) for number in range(40)]
+
+        def catalogue():
+            return Server(USERNAME, PASSWORD, transport=fake,
+                          product_cache=ProductCache()).products
+
+        def loop():
+            products = catalogue()
+            for product_id in product_ids:
+                products.get(product_id)
+
+        products = catalogue()
+        products.get_many(product_ids)
+        requests = fake.requests
+        loop_time = best_of(loop, repeat=1)
+        concurrent_time = best_of(lambda: catalogue().get_many(product_ids),
+                                  repeat=1)
+        cached_time = best_of(lambda: products.get_many(product_ids))
+        report('lookups of 40 products', loop=loop_time,
+               concurrent=concurrent_time, cached=cached_time)
+        self.assertEqual(fake.requests, requests + 2 * len(product_ids))
+        self.assertLess(concurrent_time, loop_time)
+        self.assertLess(cached_time, concurrent_time)
+
+
+class DictWalkingProduct(object):
+    """The products as they were, walking the payload on every access"""
+    def __init__(self, info):
+        self._info = info
+
+    @property
+    def price(self):
+        return (self._info.get('_embedded').get('product').get('priceLabel',
+                                                                {})
+                .get('now'))
+
+    @property
+    def has_discount(self):
+        return bool(self._info.get('_embedded').get('product').get(
+            'discount'))
+
+    @property
+    def brand(self):
+        return self._info.get('_embedded').get('product').get('brandName')
+
+    @property
+    def description(self):
+        return self._info.get('_embedded').get('product').get(
+            'description').replace(u'\xad', u'')
+
+
+class TestModelBenchmarks(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server(USERNAME, PASSWORD,
+                             transport=FakeServer(ACCOUNTS))
+        self.lines = cart_lines(10000)
+
+    @staticmethod
+    def read(items):
+        for item in items:
+            item.price, item.has_discount, item.brand, item.description
+
+    def test_attribute_access(self):
+        items = [ItemFactory(self.server, line) for line in self.lines]
+        walking = [DictWalkingProduct(line) for line in self.lines]
+        self.assertEqual([(item.price, item.description) for item in items],
+                         [(item.price, item.description) for item in walking])
+        shared_time = best_of(lambda: self.read(items))
+        walking_time = best_of(lambda: self.read(walking))
+        report('reads of 10k items', shared=shared_time,
+               dict_walking=walking_time)
+        self.assertLess(shared_time, walking_time)
+
+    @unittest.skipIf(tracemalloc is None, 'tracemalloc is not available')
+    def test_memory(self):
+        tracemalloc.start()
+        try:
+            items = [ItemFactory(self.server, line) for line in self.lines]
+            size, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        LOGGER.info('memory of 10k items: %.0f bytes per item',
+                    size / float(len(items)))
+        # the payloads are allocated before, only the models are counted
+        self.assertLess(size / float(len(items)), 1024)
+
+
+class TestInterningBenchmarks(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server(USERNAME, PASSWORD,
+                             transport=FakeServer(ACCOUNTS))
+        generator = random.Random(25)
+        # carts of 30 out of 200 popular products, as served every time
+        popular = cart_lines(200)
+        self.carts = [json.dumps(generator.sample(popular, 30))
+                      for _ in range(2000)]
+
+    def build(self, factory):
+        tracemalloc.start()
+        try:
+            start = time.time()
+            carts = [[factory(line) for line in json.loads(cart)]
+                     for cart in self.carts]
+            seconds = time.time() - start
+            size, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return carts, size, seconds
+
+    @unittest.skipIf(tracemalloc is None, 'tracemalloc is not available')
+    def test_memory_of_many_carts(self):
+        carts, interned_size, interned_time = self.build(
+            lambda line: ItemFactory(self.server, line))
+        _, walking_size, walking_time = self.build(DictWalkingProduct)
+        LOGGER.info('memory of 2000 carts: interned %.1fMB, payloads kept '
+                    '%.1fMB', interned_size / 1e6, walking_size / 1e6)
+        report('building 2000 carts', interned=interned_time,
+               dict_walking=walking_time)
+        self.assertEqual(len(set(id(item._data) for cart in carts
+                                 for item in cart)), 200)
+        self.assertLess(interned_size * 3, walking_size)
+
+
+def login_page(elements):
+    """Builds a failed login page
+
+    The page is synthetic, shaped like the real one with navigation, scripts
+    and a form around the error notices.
+
+    :param elements: The number of navigation entries around the notices
+    :return: The html of the page
+    """
+    navigation = u''.join(u'<li class="nav"><a href="/{0}">Entry {0}</a>'
+                          u'</li>'.format(number)
+                          for number in range(elements // 2))
+    return (u'<html><head><script>var notices = "error_notices";</script>'
+            u'</head><body><ul>{navigation}</ul><form><div class="login">'
+            u'<div class="error_notices"><p>{message}</p></div></div>'
+            u'<input name="userName"/></form><ul>{navigation}</ul>'
+            u'</body></html>').format(navigation=navigation,
+                                      message=LOGIN_ERROR_MESSAGE)
+
+
+def login(password, transport):
+    """Logs in through a transport
+
+    :param password: The password to log in with
+    :param transport: The transport adapter of the server
+    :return: True if the login succeeded False otherwise
+    """
+    server = Server(USERNAME, password, transport=transport)
+    try:
+        server._ensure_authenticated()  # pylint: disable=protected-access
+    except InvalidCredentials:
+        return False
+    return True
+
+
+class TestLoginPageBenchmarks(unittest.TestCase):
+
+    @unittest.skipIf(BeautifulSoup is None,
+                     'beautifulsoup4 is not installed')
+    def test_error_notice(self):
+        page = login_page(2000)
+
+        def full_parse():
+            soup = BeautifulSoup(page, 'html.parser')
+            return soup.find('div', {'class': 'error_notices'}).text
+
+        self.assertEqual(extract_error_notice(page), full_parse())
+        notice_time = best_of(lambda: extract_error_notice(page))
+        parse_time = best_of(full_parse)
+        report('error notice of a 2000 element login page',
+               notice=notice_time, full_parse=parse_time)
+        self.assertLess(notice_time, parse_time)
+
+    def test_replayed_logins(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        fake = FakeServer(ACCOUNTS)
+        # the cassettes match on urls only so every outcome gets its own
+        cassettes = {}
+        for password in (PASSWORD, 'wrong'):
+            cassettes[password] = os.path.join(directory,
+                                               '{}.json'.format(password))
+            recorder = RecordingAdapter(cassettes[password])
+            with mock.patch.object(HTTPAdapter, 'send',
+                                   side_effect=fake.send):
+                login(password, recorder)
+            recorder.save()
+        self.assertTrue(login(PASSWORD, ReplayAdapter(cassettes[PASSWORD])))
+        self.assertFalse(login('wrong', ReplayAdapter(cassettes['wrong'])))
+        success_time = best_of(lambda: login(
+            PASSWORD, ReplayAdapter(cassettes[PASSWORD])))
+        failure_time = best_of(lambda: login(
+            'wrong', ReplayAdapter(cassettes['wrong'])))
+        report('replayed logins', success=success_time, failure=failure_time)
+
+
+def import_time(statement):
+    """Times a statement in a fresh interpreter
+
+    :param statement: The python statement to run
+    :return: The seconds it took, without the start of the interpreter
+    """
+    code = ('import sys, time; start = time.time(); {}; '
+            'print(time.time() - start)').format(statement)
+    output = subprocess.check_output([sys.executable, '-c', code])
+    return float(output.decode('ascii').strip().splitlines()[-1])
+
+
+class TestImportBenchmarks(unittest.TestCase):
+
+    def test_import_time(self):
+        package_time = min(import_time('import mijnahlib')
+                           for _ in range(3))
+        server_time = min(import_time('from mijnahlib import Server')
+                          for _ in range(3))
+        report('import', package=package_time, server=server_time)
+        if sys.version_info >= (3, 7):
+            self.assertLess(package_time, server_time)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    unittest.main()
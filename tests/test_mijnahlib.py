@@ -5,25 +5,1758 @@
 test_mijnahlib
 ----------------------------------
 Tests for `mijnahlib` module.
+
+The tests run against the in process fake server and cassettes recorded
+from it, so they need neither network nor credentials.
 """
 
-from betamax.fixtures import unittest
+import copy
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from datetime import date, datetime, timedelta
+
+try:
+    from unittest import mock
+except ImportError:  # pragma: no cover
+    import mock
+
+try:
+    import asyncio
+except ImportError:  # pragma: no cover
+    asyncio = None
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover
+    httpx = None
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+from requests import Request
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError as RequestsConnectionError
+from requests.exceptions import ConnectTimeout, ReadTimeout
+
+from mijnahlib import (CircuitBreaker,
+                       CircuitOpenError,
+                       DescriptionResolver,
+                       Instrumentation,
+                       InvalidCredentials,
+                       PriceHistory,
+                       ProductCache,
+                       RetryPolicy,
+                       Server,
+                       ServerPool,
+                       SessionStore,
+                       StoreDirectoryCache,
+                       StoreIndex,
+                       StoreTable,
+                       UnknownServerError)
+from mijnahlib import mijnahlib as mijnahlibmodule
+from mijnahlib import mijnahlibcli
+from mijnahlib import mijnahlibgeo
+from mijnahlib import mijnahlibhours
+from mijnahlib.mijnahlib import (LOGIN_ERROR_MESSAGE,
+                                 ItemFactory,
+                                 Product,
+                                 ProductData,
+                                 Store,
+                                 UnspecifiedProduct,
+                                 extract_error_notice)
+from mijnahlib.mijnahlibcli import Checkpoint, OrderImporter, read_orders
+from mijnahlib.mijnahlibgeo import distance_km
+from mijnahlib.mijnahlibhours import OpeningHoursIndex, parse_opening_hours
+from mijnahlib.mijnahlibmetrics import endpoint_name
+from mijnahlib.mijnahlibpool import TokenBucket
+from mijnahlib.mijnahlibresolver import normalize
+from mijnahlib.mijnahlibstream import iter_lane_items
+from mijnahlib.mijnahlibtransport import (FakeServer,
+                                          RecordingAdapter,
+                                          ReplayAdapter,
+                                          build_response,
+                                          fake_product)
+
+USERNAME = 'user@example.com'
+PASSWORD = 'secret'
+ACCOUNTS = {USERNAME: PASSWORD}
+STORES = [{'no': number,
+           'city': ('Utrecht', 'Amsterdam', 'Delft')[number % 3],
+           'street': 'Straat',
+           'housenr': str(number),
+           'zip': '1234AB',
+           'format': 'AH',
+           'lat': 52.0 + number * 0.01,
+           'lng': 5.0 + number * 0.01,
+           'sunday': number % 2 == 0,
+           'openEvening': number % 3 == 0}
+          for number in range(30)]
 
+# A store as the store directory provides it, with only the hours of the day.
+DIRECTORY_STORE = {'no': 1432,
+                   'format': 'AH',
+                   'street': 'Oudegracht',
+                   'housenr': '1',
+                   'zip': '3511AA',
+                   'city': 'Utrecht',
+                   'phoneNumber': '030-1234567',
+                   'lat': 52.09,
+                   'lng': 5.12,
+                   'sunday': True,
+                   'openEvening': False,
+                   'status': u'Vandaag open 08:00 - 22:00'}
 
-class TestMijnahlib(unittest.BetamaxTestCase):
+
+class FakeServerTestCase(unittest.TestCase):
+    """Base of the tests that run against a fresh fake server"""
 
     def setUp(self):
         """
         Test set up
 
-        This is where you can setup things that you use throughout the tests. This method is called before every test.
+        Creates a fake server with one account and a server using it.
         """
-        pass
+        self.fake = FakeServer(ACCOUNTS, stores=STORES)
+        self.server = Server(USERNAME, PASSWORD, transport=self.fake)
 
-    def tearDown(self):
-        """
-        Test tear down
+    def cart_quantities(self):
+        return {key: entry['quantity']
+                for key, entry in self.fake.carts[USERNAME].items()}
 
-        This is where you should tear down what you've setup in setUp before. This method is called after every test.
-        """
-        pass
+
+class TestImport(unittest.TestCase):
+
+    @unittest.skipIf(sys.version_info < (3, 7),
+                     'the package imports eagerly before python 3.7')
+    def test_package_import_is_lazy(self):
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, mijnahlib; print(sorted(name for name in '
+            '("requests", "numpy", "httpx", "mijnahlib.mijnahlib") '
+            'if name in sys.modules))'])
+        self.assertEqual(output.decode('ascii').strip(), '[]')
+
+    def test_objects_are_loaded_on_access(self):
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, mijnahlib; mijnahlib.Server; '
+            'print("{} {}".format("mijnahlib.mijnahlib" in sys.modules, '
+            '"numpy" in sys.modules))'])
+        self.assertEqual(output.decode('ascii').strip(), 'True False')
+
+
+class TestModels(FakeServerTestCase):
+
+    def test_items_are_slotted(self):
+        product = ItemFactory(self.server, {
+            'type': 'Product',
+            'navItem': {'link': {'href': '/producten/product/wi12'}},
+            '_embedded': {'listItem': {'id': 'entry', 'quantity': 2},
+                          'product': fake_product('wi12', discount=True)}})
+        unspecified = ItemFactory(self.server, {
+            'type': 'UnspecifiedItem',
+            'description': u'ma\xadgere melk',
+            '_embedded': {'listItem': {'id': 'other', 'quantity': 1}}})
+        store = self.server.stores[0]
+        for model in (product, unspecified, store):
+            self.assertFalse(hasattr(model, '__dict__'))
+        self.assertEqual(product.description, u'Product 12')
+        self.assertEqual(product.quantity, 2)
+        self.assertTrue(product.has_discount)
+        self.assertEqual(unspecified.description, u'magere melk')
+        self.assertIsNone(unspecified.price)
+        self.assertEqual(copy.copy(unspecified).description, u'magere melk')
+
+
+class TestProductData(unittest.TestCase):
+
+    @staticmethod
+    def item(product):
+        return {'type': 'Product',
+                '_embedded': {'listItem': {'id': 'entry', 'quantity': 1},
+                              'product': product}}
+
+    def test_equal_payloads_share_details(self):
+        first = ItemFactory(Server(USERNAME, PASSWORD),
+                            self.item(fake_product('wi5')))
+        second = ItemFactory(Server(USERNAME, PASSWORD),
+                             self.item(fake_product('wi5')))
+        self.assertIs(first._data, second._data)
+        self.assertEqual((second.id, second.price, second.description),
+                         ('wi5', 0.55, u'Product 5'))
+
+    def test_changed_payloads_get_new_details(self):
+        server = Server(USERNAME, PASSWORD)
+        first = ItemFactory(server, self.item(fake_product('wi6')))
+        second = ItemFactory(server, self.item(fake_product('wi6', 2.0,
+                                                            True)))
+        self.assertIsNot(first._data, second._data)
+        self.assertEqual((first.price, first.has_discount), (0.56, False))
+        self.assertEqual((second.price, second.price_previously,
+                          second.has_discount), (2.0, 2.5, True))
+        self.assertIs(ProductData.intern(fake_product('wi6', 2.0, True)),
+                      second._data)
+
+    def test_products_keep_only_the_cart_entry(self):
+        product = ItemFactory(Server(USERNAME, PASSWORD),
+                              self.item(fake_product('wi7')))
+        self.assertEqual(Product.__slots__, ('_data',))
+        self.assertFalse(hasattr(product, '__dict__'))
+        self.assertEqual((product.quantity, product.list_item_id,
+                          product.brand), (1, 'entry', 'AH'))
+
+    def test_partial_payloads_are_merged(self):
+        full = ProductData.intern(fake_product('wi8'))
+        description = {'id': 'wi8',
+                       'description': fake_product('wi8')['description']}
+        self.assertIs(ProductData.intern(description, partial=True), full)
+        self.assertIsNot(ProductData.intern(description), full)
+        data = ProductData.intern(fake_product('wi8'))
+        merged = ProductData.intern({'id': 'wi8', 'description': u'Nieuw'},
+                                    partial=True)
+        self.assertIsNot(merged, data)
+        self.assertEqual((merged.description, merged.price, merged.brand),
+                         (u'Nieuw', data.price, data.brand))
+        self.assertEqual(data.description, u'Product 8')
+
+
+class TestAuthentication(FakeServerTestCase):
+
+    def test_authentication_is_deferred(self):
+        self.assertFalse(self.server._authenticated)
+        self.server.stores
+        self.assertEqual(self.fake._sessions, {})
+        self.server.shopping_cart.contents
+        self.assertTrue(self.server._authenticated)
+
+    def test_expired_session_is_renewed_once(self):
+        self.server.shopping_cart.add_item_by_id('wi1')
+        self.fake._sessions.clear()
+        self.assertTrue(self.server.shopping_cart.add_item_by_id('wi1'))
+        self.assertEqual(self.cart_quantities(), {('product', 'wi1'): 2})
+        self.assertEqual(len(self.fake._sessions), 1)
+
+    def test_concurrent_expiries_log_in_once(self):
+        cart = self.server.shopping_cart
+        cart.add_item_by_id('wi0')
+        self.fake._sessions.clear()
+        # the requests overlap so they all see the session expire
+        self.fake.latency = 0.01
+        results = cart.add_items([('wi{}'.format(number), 1)
+                                  for number in range(1, 9)], workers=8)
+        self.assertTrue(all(result.success for result in results))
+        self.assertEqual(len(self.fake._sessions), 1)
+        self.assertEqual(len(self.cart_quantities()), 9)
+
+    def test_invalid_credentials(self):
+        server = Server(USERNAME, 'wrong', transport=self.fake)
+        with self.assertRaises(InvalidCredentials) as context:
+            server.shopping_cart.contents
+        self.assertIn('onjuist', str(context.exception))
+
+
+    def session_store(self, **kwargs):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        return SessionStore(directory, **kwargs)
+
+    def test_stored_session_is_resumed(self):
+        store = self.session_store()
+        Server(USERNAME, PASSWORD, session_store=store,
+               transport=self.fake).shopping_cart.contents
+        logins = len(self.fake._sessions)
+        Server(USERNAME, PASSWORD, session_store=store,
+               transport=self.fake).shopping_cart.contents
+        self.assertEqual(len(self.fake._sessions), logins)
+
+    def test_rejected_stored_session_is_replaced(self):
+        store = self.session_store()
+        Server(USERNAME, PASSWORD, session_store=store,
+               transport=self.fake).shopping_cart.contents
+        self.fake._sessions.clear()
+        Server(USERNAME, PASSWORD, session_store=store,
+               transport=self.fake).shopping_cart.contents
+        self.assertEqual(len(self.fake._sessions), 1)
+        Server(USERNAME, PASSWORD, session_store=store,
+               transport=self.fake).shopping_cart.contents
+        self.assertEqual(len(self.fake._sessions), 1)
+
+    def test_expired_stored_session_is_not_loaded(self):
+        store = self.session_store(ttl=0)
+        Server(USERNAME, PASSWORD, session_store=store,
+               transport=self.fake).shopping_cart.contents
+        self.assertIsNone(store.load(USERNAME))
+
+
+class TestErrorNotice(unittest.TestCase):
+
+    def test_notice_is_extracted(self):
+        page = (u'<html><div class="page"><div class="box error_notices">'
+                u'<p>Het e-mailadres</p><div> is onjuist</div></div>'
+                u'<div>Other</div></div></html>')
+        self.assertEqual(extract_error_notice(page),
+                         u'Het e-mailadres is onjuist')
+
+    def test_mentions_outside_a_class_are_ignored(self):
+        page = (u'<html><script>var c="error_notices";</script>'
+                u'<div id="error_notices">Het e-mailadres</div></html>')
+        self.assertEqual(extract_error_notice(page), LOGIN_ERROR_MESSAGE)
+
+    def test_script_before_the_notices(self):
+        page = (u'<html><script>var c="error_notices";</script>'
+                u"<div class='error_notices'>Onjuist</div></html>")
+        self.assertEqual(extract_error_notice(page), u'Onjuist')
+
+
+class TestShoppingCart(FakeServerTestCase):
+
+    def test_add_item_by_id_and_description(self):
+        cart = self.server.shopping_cart
+        self.assertTrue(cart.add_item_by_id('wi1', 2))
+        self.assertTrue(cart.add_item_by_description('melk'))
+        self.assertEqual(self.cart_quantities(),
+                         {('product', 'wi1'): 2, ('unspecified', 'melk'): 1})
+
+    def test_add_items_merges_duplicates(self):
+        results = self.server.shopping_cart.add_items(
+            [('wi1', 1), ('melk', 1), ('wi1', 2)])
+        self.assertEqual([(result.item, result.quantity, result.success)
+                          for result in results],
+                         [('wi1', 3, True), ('melk', 1, True)])
+        self.assertEqual(self.cart_quantities(),
+                         {('product', 'wi1'): 3, ('unspecified', 'melk'): 1})
+
+    def test_add_items_reports_every_item(self):
+        add_item = self.fake._add_item
+
+        def rejecting(request, username):
+            if b'wi2' in request.body:
+                return build_response(request, 400)
+            return add_item(request, username)
+
+        with mock.patch.object(self.fake, '_add_item', rejecting):
+            results = self.server.shopping_cart.add_items(
+                [('wi{}'.format(number), 1) for number in range(1, 5)])
+        self.assertEqual([(result.item, result.success, result.status_code)
+                          for result in results],
+                         [('wi1', True, 200), ('wi2', False, 400),
+                          ('wi3', True, 200), ('wi4', True, 200)])
+        self.assertEqual(len(self.cart_quantities()), 3)
+        self.assertEqual(self.server.shopping_cart.add_items([]), [])
+
+    def test_contents(self):
+        self.server.shopping_cart.add_items([('wi12', 2), ('brood', 1)])
+        contents = self.server.shopping_cart.contents
+        self.assertEqual(sorted((item.description, item.quantity)
+                                for item in contents),
+                         [('Product 12', 2), ('brood', 1)])
+        product = [item for item in contents if item.id == 'wi12'][0]
+        self.assertEqual(product.price, 0.62)
+        self.assertFalse(product.has_discount)
+
+    def test_iter_contents_matches_contents(self):
+        self.server.shopping_cart.add_items([('wi{}'.format(number), 1)
+                                             for number in range(20)] +
+                                            [(u'ma\xadgere melk', 2)])
+        contents = [(item.description, item.quantity)
+                    for item in self.server.shopping_cart.contents]
+        for chunk_size in (1, 7, 64, 10240):
+            streamed = [(item.description, item.quantity)
+                        for item in self.server.shopping_cart.iter_contents(
+                            chunk_size)]
+            self.assertEqual(streamed, contents)
+
+    def test_lane_items_are_parsed_across_chunks(self):
+        items = [{'type': 'UnspecifiedItem',
+                  'description': u'cr\xe8me fra\xeeche {}'.format(number),
+                  'quantity': number, 'price': 1.5, 'tags': [None, True]}
+                 for number in range(3)]
+        # the type of the first lane follows its items in the payload
+        payload = {'_embedded': {'lanes': [
+            {'_embedded': {'items': items[:2]}, 'type': 'ShoppingListLane'},
+            {'type': 'SuggestionLane', '_embedded': {'items': [{'x': 1}]}},
+            {'type': 'ShoppingListLane', '_embedded': {'items': items[2:]}}]}}
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        chunks = [body[index:index + 1] for index in range(len(body))]
+        self.assertEqual(list(iter_lane_items(chunks, 'ShoppingListLane')),
+                         items)
+
+    def test_descriptions_are_resolved(self):
+        self.fake.products = [dict(fake_product('wi12'),
+                                   description=u'Halfvolle melk'),
+                              dict(fake_product('wi13'),
+                                   description=u'Jonge kaas')]
+        cart = self.server.shopping_cart
+        self.assertTrue(cart.add_item_by_description(u'HALFVOLLE melk',
+                                                     resolve=True))
+        results = cart.add_items([(u'jonge\xad kaas', 1), ('brood', 1),
+                                  ('wi12', 1)], resolve=True)
+        self.assertEqual([(result.item, result.quantity)
+                          for result in results],
+                         [('wi13', 1), ('brood', 1), ('wi12', 1)])
+        self.assertTrue(cart.add_item_by_description(u'Jonge kaas'))
+        self.assertEqual(self.cart_quantities(),
+                         {('product', 'wi12'): 2,
+                          ('product', 'wi13'): 1,
+                          ('unspecified', 'brood'): 1,
+                          ('unspecified', 'Jonge kaas'): 1})
+
+    def test_refresh_indexes_only_products(self):
+        self.server.shopping_cart.add_items([('wi12', 1), ('melk', 1)])
+        with mock.patch.object(UnspecifiedProduct._logger,
+                               'warning') as warning:
+            self.server.shopping_cart.refresh()
+        self.assertFalse(warning.called)
+        self.assertEqual(len(self.server.resolver), 1)
+        self.assertEqual(self.server.resolver.resolve('product 12'), 'wi12')
+
+    def test_snapshot_is_cached_until_invalidated(self):
+        cart = self.server.shopping_cart
+        snapshot = cart.snapshot
+        self.assertIs(cart.snapshot, snapshot)
+        cart.add_item_by_id('wi1')
+        self.assertIsNot(cart.snapshot, snapshot)
+
+    def test_diff(self):
+        cart = self.server.shopping_cart
+        cart.add_items([('wi1', 1), ('wi2', 1)])
+        previous = cart.refresh()
+        cart.add_items([('wi2', 1), ('wi3', 1)])
+        diff = cart.diff(previous)
+        self.assertEqual([item.id for item in diff.added], ['wi3'])
+        self.assertEqual([(old.quantity, new.quantity)
+                          for old, new in diff.changed], [(1, 2)])
+        self.assertEqual(diff.removed, [])
+
+    def test_sync(self):
+        cart = self.server.shopping_cart
+        cart.add_items([('wi1', 2), ('wi2', 1), ('Melk', 1), ('brood', 1)])
+        report = cart.sync([('wi1', 2), ('wi2', 3), ('melk', 1),
+                            ('wi3', 1)])
+        self.assertEqual([result.item for result in report.added], ['wi3'])
+        self.assertEqual([result.item for result in report.updated],
+                         ['wi2'])
+        self.assertEqual([result.item for result in report.removed],
+                         ['brood'])
+        self.assertEqual(sorted(report.unchanged), ['melk', 'wi1'])
+        self.assertEqual(self.cart_quantities(),
+                         {('product', 'wi1'): 2,
+                          ('product', 'wi2'): 3,
+                          ('product', 'wi3'): 1,
+                          ('unspecified', 'Melk'): 1})
+
+    def test_sync_matches_descriptions_like_the_resolver(self):
+        cart = self.server.shopping_cart
+        cart.add_items([(u'ma\xadgere melk', 1), (u'Volkoren  brood', 2)])
+        report = cart.sync([(u' Magere Melk ', 1), (u'volkoren brood', 2),
+                            (u'volkoren\tbrood', 1)], remove_missing=False)
+        self.assertEqual(report.added, [])
+        self.assertEqual([result.item for result in report.updated],
+                         [u'volkoren brood'])
+        self.assertEqual(report.unchanged, [u' Magere Melk '])
+        self.assertEqual(self.cart_quantities(),
+                         {('unspecified', u'ma\xadgere melk'): 1,
+                          ('unspecified', u'Volkoren  brood'): 3})
+
+    def test_unknown_item_types_are_left_out(self):
+        shopping_list = self.fake._shopping_list
+
+        def with_recipe(username):
+            payload = shopping_list(username)
+            items = payload['_embedded']['lanes'][0]['_embedded']['items']
+            items.append({'type': 'Recipe',
+                          'description': 'Lasagne',
+                          '_embedded': {'listItem': {'id': 'recipe',
+                                                     'quantity': 1}}})
+            return payload
+
+        self.server.shopping_cart.add_items([('wi1', 1), ('melk', 1)])
+        with mock.patch.object(self.fake, '_shopping_list', with_recipe):
+            contents = self.server.shopping_cart.contents
+            streamed = list(self.server.shopping_cart.iter_contents())
+        self.assertEqual(sorted(item.description for item in contents),
+                         ['Product 1', 'melk'])
+        self.assertEqual(len(streamed), 2)
+
+
+class TestDescriptionResolver(unittest.TestCase):
+
+    def test_normalize(self):
+        self.assertEqual(normalize(u' AH Ma\xadgere\t MELK, 1L! '),
+                         u'ah magere melk 1l')
+        self.assertEqual(normalize(None), u'')
+
+    def test_variants_resolve_to_the_same_product(self):
+        resolver = DescriptionResolver()
+        resolver.add('wi1', u'AH Magere melk')
+        for description in (u'ah magere melk', u'AH  Ma\xadgere\nmelk',
+                            u'AH-magere melk!', u'magere melk'):
+            self.assertEqual(resolver.resolve(description), 'wi1')
+
+    def test_closest_length_is_preferred(self):
+        resolver = DescriptionResolver()
+        resolver.add('wi1', u'AH Magere melk voordeelverpakking 2 liter')
+        resolver.add('wi2', u'AH Magere melk')
+        self.assertEqual(resolver.resolve(u'magere melk'), 'wi2')
+
+    def test_ties_resolve_to_the_lowest_id(self):
+        # both descriptions have the same trigrams
+        entries = [('wi9', u'melk halfvol'), ('wi10', u'halfvol melk')]
+        for order in (entries, entries[::-1]):
+            resolver = DescriptionResolver()
+            for product_id, description in order:
+                resolver.add(product_id, description)
+            self.assertEqual(resolver.resolve(u'halfvol melkje'), 'wi10')
+
+    def test_threshold(self):
+        resolver = DescriptionResolver()
+        resolver.add('wi1', u'AH Magere melk')
+        self.assertIsNone(resolver.resolve(u'magere kaas'))
+        self.assertIsNone(resolver.resolve(u''))
+        resolver.threshold = 0.3
+        self.assertEqual(resolver.resolve(u'magere kaas'), 'wi1')
+
+    def test_search_results_are_indexed(self):
+        search = mock.Mock(return_value=[
+            mock.Mock(id='wi5', description=u'Jonge kaas')])
+        resolver = DescriptionResolver(search=search)
+        self.assertEqual(resolver.resolve(u'jonge kaas'), 'wi5')
+        self.assertEqual(resolver.resolve_many([u'Jonge  kaas']),
+                         {u'Jonge  kaas': 'wi5'})
+        search.assert_called_once_with(u'jonge kaas')
+
+    def test_failed_search_resolves_to_nothing(self):
+        resolver = DescriptionResolver(search=mock.Mock(
+            side_effect=ValueError('unavailable')))
+        self.assertIsNone(resolver.resolve(u'jonge kaas'))
+        self.assertEqual(resolver.resolve_many([u'kaas', u'melk']),
+                         {u'kaas': None, u'melk': None})
+
+    def test_changed_description_is_reindexed(self):
+        resolver = DescriptionResolver()
+        resolver.add('wi1', u'Jonge kaas')
+        resolver.add('wi1', u'Oude kaas')
+        self.assertEqual(len(resolver), 1)
+        self.assertIsNone(resolver.resolve(u'jonge kaas'))
+        self.assertEqual(resolver.resolve(u'oude kaas'), 'wi1')
+
+
+class TestWriteBehind(FakeServerTestCase):
+
+    def setUp(self):
+        super(TestWriteBehind, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'queue.sqlite')
+        self.server = Server(USERNAME, PASSWORD, transport=self.fake,
+                             retry_policy=RetryPolicy(max_retries=0))
+        self.cart = self.server.shopping_cart
+        self.queue = self.cart.enable_write_behind(self.path,
+                                                   flush_interval=3600)
+        self.addCleanup(self.cart.disable_write_behind)
+
+    def test_additions_are_coalesced(self):
+        futures = [self.cart.add_item_by_id('wi1'),
+                   self.cart.add_item_by_id('wi1', 2),
+                   self.cart.add_item_by_description('melk')]
+        self.assertEqual(len(self.queue), 2)
+        self.queue.flush()
+        self.assertEqual([future.result(0) for future in futures],
+                         [True, True, True])
+        self.assertEqual(self.cart_quantities(),
+                         {('product', 'wi1'): 3, ('unspecified', 'melk'): 1})
+        self.assertEqual(len(self.queue), 0)
+
+    def test_undelivered_additions_stay_pending(self):
+        self.cart._ah._ensure_authenticated()
+        self.fake.error_rate = 1
+        future = self.cart.add_item_by_id('wi1')
+        self.queue.flush()
+        self.assertFalse(future.done())
+        self.assertEqual(len(self.queue), 1)
+        self.fake.error_rate = 0
+        self.queue.flush()
+        self.assertTrue(future.result(0))
+        self.assertEqual(self.cart_quantities(), {('product', 'wi1'): 1})
+
+    def test_rejected_additions_are_dropped(self):
+        def rejected(request, username):
+            return build_response(request, 400)
+
+        with mock.patch.object(self.fake, '_add_item', rejected):
+            future = self.cart.add_item_by_id('wi1')
+            self.queue.flush()
+        self.assertFalse(future.result(0))
+        self.assertEqual(len(self.queue), 0)
+        self.queue.flush()
+        self.assertEqual(self.cart_quantities(), {})
+
+    def test_additions_survive_a_restart(self):
+        self.cart._ah._ensure_authenticated()
+        self.fake.error_rate = 1
+        future = self.cart.add_item_by_id('wi1', 2)
+        self.cart.disable_write_behind()
+        with self.assertRaises(RuntimeError):
+            future.result(0)
+        self.fake.error_rate = 0
+        queue = self.cart.enable_write_behind(self.path, flush_interval=3600)
+        self.assertEqual(len(queue), 1)
+        queue.flush()
+        self.assertEqual(self.cart_quantities(), {('product', 'wi1'): 2})
+
+    def test_failed_additions_fail_their_futures(self):
+        self.fake.accounts[USERNAME] = 'changed'
+        futures = [self.cart.add_item_by_id('wi1'),
+                   self.cart.add_item_by_description('melk')]
+        submissions = self.queue.flush()
+        self.assertEqual([submission.success for submission in submissions],
+                         [False, False])
+        for future in futures:
+            self.assertIsInstance(future.exception(0), InvalidCredentials)
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(self.queue.flush(), [])
+
+
+class TestStores(FakeServerTestCase):
+
+    def test_stores(self):
+        stores = self.server.stores
+        self.assertEqual(len(stores), len(STORES))
+        self.assertEqual(stores[1].address, u'Straat 1 1234AB Amsterdam')
+        self.assertIs(self.server.stores, stores)
+
+    def test_store_index_nearest(self):
+        index = StoreIndex(self.server.stores)
+        self.assertEqual(len(index), len(STORES))
+        nearest = index.nearest(52.0, 5.0, k=3, opens_sunday=True)
+        self.assertEqual([store.id for _, store in nearest], [0, 2, 4])
+        self.assertEqual(nearest[0][0], 0)
+
+    def test_store_index_nearest_matches_a_scan(self):
+        stores = self.server.stores
+        index = StoreIndex(stores, cell_size=0.02)
+        for latitude, longitude in ((51.5, 4.5), (52.13, 5.2), (53.0, 6.0)):
+            expected = sorted(stores, key=lambda store: distance_km(
+                latitude, longitude, store.latitude, store.longtitude))
+            nearest = index.nearest(latitude, longitude, k=4,
+                                    opens_evenings=True)
+            self.assertEqual([store.id for _, store in nearest],
+                             [store.id for store in expected
+                              if store.opens_evenings][:4])
+
+    def test_store_index_within(self):
+        index = StoreIndex(self.server.stores)
+        within = index.within(52.0, 5.0, 3)
+        self.assertEqual([store.id for _, store in within], [0, 1, 2])
+        self.assertTrue(all(distance <= 3 for distance, _ in within))
+        within = index.within(52.0, 5.0, 3, opens_sunday=False)
+        self.assertEqual([store.id for _, store in within], [1])
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class TestStoreTable(FakeServerTestCase):
+
+    def setUp(self):
+        super(TestStoreTable, self).setUp()
+        self.table = StoreTable(self.server.stores)
+
+    def test_filter(self):
+        mask = self.table.filter(city='Delft', opens_sunday=True)
+        self.assertEqual([store.id for store in self.table.stores(mask)],
+                         [number for number in range(2, 30, 6)])
+        mask = (self.table.filter(opens_sunday=True) &
+                self.table.filter(opens_evenings=True))
+        self.assertEqual([store.id for store in self.table.stores(mask)],
+                         [0, 6, 12, 18, 24])
+        self.assertFalse(self.table.filter(city='Delft',
+                                           opens_evenings=True).any())
+        self.assertFalse(self.table.filter(city='Zwolle').any())
+        self.assertEqual(len(self.table.stores(self.table.filter())),
+                         len(STORES))
+
+    def test_distances_match_a_loop(self):
+        stores = self.server.stores
+        distances = self.table.distances(52.1, 4.9)
+        for store, distance in zip(stores, distances):
+            self.assertAlmostEqual(distance,
+                                   distance_km(52.1, 4.9,
+                                               store.latitude,
+                                               store.longtitude))
+        matrix = self.table.distance_matrix([52.1, 51.0], [4.9, 6.0])
+        self.assertEqual(matrix.shape, (2, len(STORES)))
+        self.assertTrue(numpy.allclose(matrix[0], distances))
+        self.assertAlmostEqual(matrix[1][7],
+                               distance_km(51.0, 6.0,
+                                           stores[7].latitude,
+                                           stores[7].longtitude))
+
+    def test_group_by_city(self):
+        groups = self.table.group_by_city(self.table.filter(opens_sunday=True))
+        self.assertEqual(sorted(groups), ['Amsterdam', 'Delft', 'Utrecht'])
+        self.assertEqual(list(groups['Utrecht']), list(range(0, 30, 6)))
+
+
+class TestStoreTableWithoutNumpy(FakeServerTestCase):
+
+    def test_missing_numpy_is_reported(self):
+        with mock.patch.object(mijnahlibgeo, 'numpy', None), \
+                mock.patch.dict(sys.modules, {'numpy': None}):
+            with self.assertRaises(ImportError) as context:
+                StoreTable(self.server.stores)
+        self.assertIn('requires numpy', str(context.exception))
+
+
+class TestServices(unittest.TestCase):
+
+    def setUp(self):
+        stores = [dict(info, services=services) for info, services in zip(
+            STORES[:6], (['pakket'], ['pakket', 'apotheek'], [],
+                         ['apotheek'], None, ['wijn']))]
+        services = {'pakket': {'name': 'Pakketpunt', 'stores': [4]},
+                    'apotheek': 'Apotheek',
+                    'bezorgen': {'label': 'Bezorgen', 'stores': [2, 99]}}
+        self.server = Server(USERNAME, PASSWORD,
+                             transport=FakeServer(ACCOUNTS, stores=stores,
+                                                  services=services))
+
+    def test_services(self):
+        services = {service.code: service for service in self.server.services}
+        self.assertEqual(sorted(services),
+                         ['apotheek', 'bezorgen', 'pakket', 'wijn'])
+        self.assertEqual([services[code].name for code in sorted(services)],
+                         ['Apotheek', 'Bezorgen', 'Pakketpunt', 'wijn'])
+        # stores are linked whether listed under the service or the store
+        self.assertEqual([store.id for store in services['pakket'].stores],
+                         [0, 1, 4])
+        self.assertEqual([store.id for store in services['bezorgen'].stores],
+                         [2])
+        store = self.server.stores[1]
+        self.assertEqual(sorted(service.code for service in store.services),
+                         ['apotheek', 'pakket'])
+
+    def test_filter(self):
+        index = self.server.service_index
+        self.assertEqual(index.store_ids('pakket'), frozenset((0, 1, 4)))
+        self.assertEqual(index.store_ids('unknown'), frozenset())
+
+        def ids(**kwargs):
+            return [store.id for store in index.filter(**kwargs)]
+
+        self.assertEqual(ids(all_of=('pakket', 'apotheek')), [1])
+        self.assertEqual(ids(any_of=('apotheek', 'wijn')), [1, 3, 5])
+        self.assertEqual(ids(all_of=('pakket',), any_of=('apotheek',
+                                                         'bezorgen')), [1])
+        self.assertEqual(ids(any_of=('pakket',), city='amsterdam'), [1, 4])
+        self.assertEqual(ids(all_of=('unknown',)), [])
+        self.assertEqual(ids(), list(range(6)))
+
+
+class TestOpeningHours(unittest.TestCase):
+
+    def test_parse_mapping_of_days(self):
+        hours = parse_opening_hours({'openingHours': {
+            'maandag': '08:00 - 22:00', 'zo': '12.00 tot 18.00',
+            'saturday': '22:00 - 02:00'}})
+        self.assertEqual(hours.intervals,
+                         ((480, 1320), (8520, 8760), (9360, 9720)))
+        self.assertTrue(hours.is_open(datetime(2017, 5, 14, 12, 30)))
+        self.assertFalse(hours.is_open(datetime(2017, 5, 15, 7, 59)))
+        self.assertEqual(hours.next_opening(datetime(2017, 5, 15, 7, 30)),
+                         datetime(2017, 5, 15, 8, 0))
+
+    def test_hours_past_sunday_midnight_wrap(self):
+        hours = parse_opening_hours({'openingHours': {'zo': '20:00 - 01:00'}})
+        self.assertEqual(hours.intervals, ((0, 60), (9840, 10080)))
+        self.assertTrue(hours.is_open(datetime(2017, 5, 15, 0, 30)))
+
+    def test_parse_list_of_entries(self):
+        hours = parse_opening_hours({'openingHours': [
+            {'day': 1, 'from': '08:00', 'to': '20:00'},
+            {'day': 'dinsdag', 'hours': '21:00-22:00'},
+            {'day': 'someday', 'open': '08:00', 'close': '09:00'}]})
+        self.assertEqual(hours.intervals, ((1920, 2640), (2700, 2760)))
+
+    def test_index(self):
+        infos = [dict(info, openingHours={'zo': '12:00 - 18:00'}
+                      if info['sunday'] else {'ma': '08:00 - 22:00'})
+                 for info in STORES]
+        index = OpeningHoursIndex([Store(info) for info in infos])
+        self.assertEqual(len(index), len(STORES))
+        self.assertEqual(
+            [store.id for store
+             in index.stores_open_at(datetime(2017, 5, 14, 17, 59))],
+            list(range(0, 30, 2)))
+        self.assertEqual(index.store_ids_open_at(
+            datetime(2017, 5, 14, 18, 0)), set())
+
+    def test_payload_without_hours_is_reported(self):
+        # the store directory is known to carry only day flags
+        stores = [Store(info) for info in STORES]
+        with mock.patch.object(mijnahlibhours.LOGGER, 'warning') as warning:
+            index = OpeningHoursIndex(stores)
+        self.assertEqual(warning.call_args[0][1], 30)
+        self.assertEqual(index.stores_open_at(datetime(2017, 5, 14, 12)),
+                         [])
+        self.assertIsNone(index.next_opening(stores[0],
+                                             datetime(2017, 5, 14, 12)))
+
+    def test_hours_of_the_day_are_parsed_from_the_status(self):
+        wednesday = date(2017, 5, 17)
+        hours = parse_opening_hours(DIRECTORY_STORE, wednesday)
+        self.assertEqual(hours.intervals[:3],
+                         ((480, 1200), (1920, 2640), (3360, 4200)))
+        self.assertTrue(hours.is_open(datetime(2017, 5, 17, 21, 30)))
+        # the other days close at 20:00 without the evening flag
+        self.assertFalse(hours.is_open(datetime(2017, 5, 18, 21, 30)))
+        self.assertTrue(hours.is_open(datetime(2017, 5, 21, 10)))
+        self.assertEqual(hours.next_opening(datetime(2017, 5, 18, 21, 30)),
+                         datetime(2017, 5, 19, 8))
+
+    def test_status_and_flags(self):
+        wednesday = date(2017, 5, 17)
+        hours = parse_opening_hours(dict(DIRECTORY_STORE, sunday=False,
+                                         openEvening=True), wednesday)
+        self.assertTrue(hours.is_open(datetime(2017, 5, 18, 21, 30)))
+        self.assertFalse(hours.is_open(datetime(2017, 5, 21, 10)))
+        hours = parse_opening_hours(dict(DIRECTORY_STORE,
+                                         status=u'Open 20:00 - 02:00'),
+                                    wednesday)
+        self.assertTrue(hours.is_open(datetime(2017, 5, 18, 1)))
+        self.assertFalse(hours.is_open(datetime(2017, 5, 19, 1)))
+        self.assertIsNone(parse_opening_hours(
+            dict(DIRECTORY_STORE, status=u'Vandaag gesloten'), wednesday))
+        self.assertIsNone(parse_opening_hours(
+            dict(DIRECTORY_STORE, status=None), wednesday))
+        self.assertTrue(parse_opening_hours(dict(
+            DIRECTORY_STORE, openingHours={'ma': '08:00 - 09:00'}),
+            wednesday).is_open(datetime(2017, 5, 15, 8, 30)))
+
+    def test_stores_open_from_the_store_directory(self):
+        stores = [dict(DIRECTORY_STORE, no=number, sunday=number % 2 == 0,
+                       openEvening=number % 3 == 0)
+                  for number in range(6)]
+        server = Server(USERNAME, PASSWORD,
+                        transport=FakeServer(ACCOUNTS, stores=stores))
+        today = datetime.combine(date.today(), datetime.min.time())
+        index = server.opening_hours
+        self.assertEqual(len(index), 6)
+        self.assertEqual([store.id for store
+                          in index.stores_open_at(today.replace(hour=21))],
+                         list(range(6)))
+        # only the stores open in the evening are open tomorrow evening
+        tomorrow = today + timedelta(days=1, hours=21)
+        self.assertEqual([store.id for store
+                          in index.stores_open_at(tomorrow)],
+                         [0] if tomorrow.weekday() == 6 else [0, 3])
+        days = (6 - today.weekday()) % 7 or 7
+        sunday = today + timedelta(days=days, hours=10)
+        self.assertEqual([store.id for store in index.stores_open_at(sunday)],
+                         [0, 2, 4] if days != 7 else list(range(6)))
+
+
+class TestStoreDirectoryCache(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'stores.json')
+        self.status = 200
+        self.payload = {'stores': STORES}
+
+    def request(self, method, url, **kwargs):
+        from requests import Request
+        prepared = Request(method, url, **kwargs).prepare()
+        return build_response(prepared, self.status,
+                              body=json.dumps(self.payload).encode('utf-8'))
+
+    def test_stale_payload_is_kept_on_errors(self):
+        cache = StoreDirectoryCache(ttl=0, path=self.path)
+        url = 'https://www.ah.nl/stores'
+        self.assertEqual(len(cache.get(self.request, url)['stores']), 30)
+        with open(self.path) as snapshot:
+            saved = json.load(snapshot)
+        self.status, self.payload = 503, {'error': 'Unavailable'}
+        self.assertEqual(len(cache.get(self.request, url)['stores']), 30)
+        with open(self.path) as snapshot:
+            self.assertEqual(json.load(snapshot), saved)
+
+    def test_error_without_payload_raises(self):
+        self.status = 503
+        with self.assertRaises(UnknownServerError):
+            StoreDirectoryCache().get(self.request, 'https://www.ah.nl/')
+
+    def test_stale_payload_is_kept_when_unreachable(self):
+        fake = FakeServer(ACCOUNTS, stores=STORES)
+        server = Server(USERNAME, PASSWORD,
+                        store_cache=StoreDirectoryCache(ttl=0),
+                        retry_policy=RetryPolicy(max_retries=0),
+                        circuit_breaker=CircuitBreaker(failure_threshold=1),
+                        transport=fake)
+        stores = server.stores
+        with mock.patch.object(fake, 'send', side_effect=(
+                RequestsConnectionError('Connection refused'))):
+            self.assertIs(server.stores, stores)
+            self.assertTrue(server.circuit_breaker.is_open(
+                'GET /data/winkelinformatie/winkels/json'))
+            self.assertIs(server.stores, stores)
+        self.assertEqual(fake.requests, 1)
+
+    def test_unreachable_without_payload_raises(self):
+        def unreachable(method, url, **kwargs):
+            raise RequestsConnectionError('Connection refused')
+
+        def cut_off(method, url, **kwargs):
+            raise CircuitOpenError(url)
+
+        for request in (unreachable, cut_off):
+            with self.assertRaises((RequestsConnectionError,
+                                    CircuitOpenError)):
+                StoreDirectoryCache().get(request, 'https://www.ah.nl/')
+
+    def test_unchanged_payload_is_revalidated(self):
+        cache = StoreDirectoryCache(ttl=0)
+        url = 'https://www.ah.nl/stores'
+        payload = cache.get(self.request, url)
+        self.status = 304
+        self.assertIs(cache.get(self.request, url), payload)
+        self.assertEqual(cache.statistics,
+                         {'hits': 0, 'misses': 2, 'revalidations': 1})
+
+
+class TestProductCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ProductCache(field_ttls={'priceLabel': 60},
+                                  default_ttl=3600)
+        self.cache.put('wi1', fake_product('wi1'))
+
+    def age(self, product_id, field, seconds):
+        stored = self.cache._memory.get(product_id)
+        value, fetched_at = stored[field]
+        stored[field] = value, fetched_at - seconds
+
+    def test_fresh_product(self):
+        self.assertEqual(self.cache.get('wi1'), fake_product('wi1'))
+        self.assertIsNone(self.cache.get('wi2'))
+        self.assertEqual(self.cache.statistics,
+                         {'hits': 1, 'misses': 1, 'size': 1})
+
+    def test_stale_field_only_misses_when_asked_for(self):
+        self.age('wi1', 'priceLabel', 120)
+        self.assertIsNone(self.cache.get('wi1'))
+        self.assertIsNone(self.cache.get('wi1', ('priceLabel',)))
+        self.assertEqual(self.cache.get('wi1', ('id', 'description')),
+                         {'id': 'wi1', 'description': u'Product\xad 1'})
+
+    def test_fields_outlive_their_default_ttl(self):
+        self.age('wi1', 'description', 7200)
+        self.assertIsNone(self.cache.get('wi1', ('description',)))
+        self.assertIsNotNone(self.cache.get('wi1', ('priceLabel',)))
+
+    def test_database_outlives_the_cache(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'products.sqlite')
+        cache = ProductCache(path=path)
+        cache.put('wi1', fake_product('wi1', discount=True))
+        cache.close()
+        cache = ProductCache(path=path)
+        self.addCleanup(cache.close)
+        self.assertEqual(cache.get('wi1'), fake_product('wi1',
+                                                        discount=True))
+
+
+class TestProductCatalogue(FakeServerTestCase):
+
+    def setUp(self):
+        super(TestProductCatalogue, self).setUp()
+        self.cache = ProductCache(field_ttls={'priceLabel': 60})
+        self.server = Server(USERNAME, PASSWORD, transport=self.fake,
+                             product_cache=self.cache)
+
+    def test_get_is_cached(self):
+        product = self.server.products.get('wi12')
+        self.assertEqual((product.id, product.price), ('wi12', 0.62))
+        requests = self.fake.requests
+        self.assertEqual(self.server.products.get('wi12').price, 0.62)
+        self.assertEqual(self.fake.requests, requests)
+        self.assertIsNone(self.server.products.get('unknown'))
+
+    def test_only_stale_fields_asked_for_are_fetched(self):
+        self.server.products.get('wi12')
+        stored = self.cache._memory.get('wi12')
+        stored['priceLabel'] = stored['priceLabel'][0], 0
+        requests = self.fake.requests
+        product = self.server.products.get('wi12', fields=('description',))
+        self.assertEqual((product.description, product.price),
+                         (u'Product 12', None))
+        self.assertEqual(self.fake.requests, requests)
+        self.assertEqual(self.server.products.get('wi12').price, 0.62)
+        self.assertEqual(self.fake.requests, requests + 1)
+
+    def test_partial_lookups_keep_the_known_details(self):
+        product = self.server.products.get('wi13')
+        requests = self.fake.requests
+        described = self.server.products.get('wi13', fields=('description',))
+        self.assertIs(described._data, product._data)
+        self.assertEqual((described.description, described.price),
+                         (u'Product 13', 0.63))
+        self.assertEqual(self.fake.requests, requests)
+
+    def test_get_many(self):
+        self.server.products.get('wi1')
+        requests = self.fake.requests
+        products = self.server.products.get_many(['wi1', 'wi2', 'wi1',
+                                                  'unknown'])
+        self.assertEqual(list(products), ['wi1', 'wi2', 'unknown'])
+        self.assertEqual(products['wi2'].price, 0.52)
+        self.assertIsNone(products['unknown'])
+        self.assertEqual(self.fake.requests, requests + 2)
+
+
+class TestPriceHistory(FakeServerTestCase):
+
+    def setUp(self):
+        super(TestPriceHistory, self).setUp()
+        self.history = PriceHistory()
+        self.addCleanup(self.history.close)
+
+    def product(self, product_id, price, discount=False):
+        return ItemFactory(self.server, {
+            'type': 'Product',
+            'navItem': {'link': {'href': '/producten/product/{}'.format(
+                product_id)}},
+            '_embedded': {'listItem': {'id': product_id, 'quantity': 1},
+                          'product': fake_product(product_id, price,
+                                                  discount)}})
+
+    def test_unchanged_prices_are_not_recorded(self):
+        unspecified = ItemFactory(self.server, {
+            'type': 'UnspecifiedItem', 'description': 'melk',
+            '_embedded': {'listItem': {'id': 'melk', 'quantity': 1}}})
+        self.assertEqual(self.history.record([self.product('wi1', 1.0),
+                                              self.product('wi2', 2.0),
+                                              unspecified], 100), 2)
+        self.assertEqual(self.history.record([self.product('wi1', 1.0),
+                                              self.product('wi2', 2.0)],
+                                             200), 0)
+        # the last state of a product seen twice in a snapshot counts
+        self.assertEqual(self.history.record([self.product('wi1', 9.0),
+                                              self.product('wi1', 1.5)],
+                                             300), 1)
+        self.assertEqual([(change.timestamp, change.price) for change
+                          in self.history.history('wi1')],
+                         [(100, 1.0), (300, 1.5)])
+        self.assertEqual(self.history.latest('wi1').price, 1.5)
+        self.assertIsNone(self.history.latest('melk'))
+
+    def test_history_since(self):
+        for timestamp, price in ((100, 1.0), (200, 1.1), (300, 1.2)):
+            self.history.record([self.product('wi1', price)], timestamp)
+        self.assertEqual([change.price for change
+                          in self.history.history('wi1', since=200)],
+                         [1.1, 1.2])
+        self.assertEqual(self.history.history('wi2'), [])
+
+    def test_went_on_discount_since(self):
+        self.history.record([self.product('wi1', 1.5),
+                             self.product('wi2', 2.0, discount=True)], 100)
+        self.history.record([self.product('wi1', 1.2, discount=True)], 200)
+        # a new price during the discount does not start a new one
+        self.history.record([self.product('wi1', 1.1, discount=True)], 300)
+        changes = self.history.went_on_discount_since(150)
+        self.assertEqual([(change.product_id, change.timestamp,
+                           change.price, change.price_previously)
+                          for change in changes],
+                         [('wi1', 200, 1.2, 1.5)])
+        self.assertEqual([change.product_id for change
+                          in self.history.went_on_discount_since(0)],
+                         ['wi2', 'wi1'])
+        self.history.record([self.product('wi1', 1.5)], 400)
+        self.history.record([self.product('wi1', 1.2, discount=True)], 500)
+        self.assertEqual([change.timestamp for change
+                          in self.history.went_on_discount_since(150)],
+                         [200, 500])
+
+    def test_history_is_kept_in_the_database(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'history.sqlite')
+        history = PriceHistory(path)
+        history.record([self.product('wi1', 1.0)], 100)
+        history.close()
+        history = PriceHistory(path)
+        self.addCleanup(history.close)
+        self.assertEqual(history.record([self.product('wi1', 1.0)], 200), 0)
+        self.assertEqual(history.latest('wi1').timestamp, 100)
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_fractional_rate_hands_out_tokens(self):
+        bucket = TokenBucket(0.5)
+        self.assertEqual(bucket.capacity, 1.0)
+        bucket.acquire()
+        bucket._updated_at -= 2
+        start = time.time()
+        bucket.acquire()
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_capacity(self):
+        self.assertEqual(TokenBucket(5).capacity, 5.0)
+        self.assertEqual(TokenBucket(5, 2).capacity, 2.0)
+
+
+class TestServerPool(unittest.TestCase):
+
+    def setUp(self):
+        self.accounts = {'first@example.com': 'first',
+                         'second@example.com': 'second'}
+        self.fake = FakeServer(self.accounts, stores=STORES)
+
+    def test_add(self):
+        pool = ServerPool(transport=self.fake)
+        first = pool.add('first@example.com', 'first')
+        second = pool.add('second@example.com', 'second')
+        self.assertEqual(len(pool), 2)
+        self.assertIs(pool['first@example.com'], first)
+        first.shopping_cart.add_item_by_id('wi1')
+        self.assertEqual(len(first.stores), len(STORES))
+        requests = self.fake.requests
+        # the store directory is shared, so is not downloaded again
+        self.assertEqual(len(second.stores), len(STORES))
+        self.assertEqual(self.fake.requests, requests)
+        self.assertEqual(list(self.fake.carts['first@example.com']),
+                         [('product', 'wi1')])
+        self.assertEqual(pool.latencies['first@example.com']['count'],
+                         requests)
+        self.assertEqual(pool.latencies['second@example.com']['count'], 0)
+        pool.remove('second@example.com')
+        self.assertEqual(list(pool), [first])
+
+    def test_account_transport_is_wrapped(self):
+        other = FakeServer(self.accounts)
+        pool = ServerPool(transport=self.fake, account_rate=100)
+        server = pool.add('first@example.com', 'first', transport=other)
+        server.shopping_cart.add_item_by_id('wi1')
+        self.assertEqual(self.fake.requests, 0)
+        self.assertEqual(list(other.carts['first@example.com']),
+                         [('product', 'wi1')])
+        self.assertEqual(pool.latencies['first@example.com']['count'],
+                         other.requests)
+
+    def test_rate_is_limited_per_account(self):
+        pool = ServerPool(transport=self.fake, account_rate=40)
+        limited = pool.add('first@example.com', 'first')
+        other = pool.add('second@example.com', 'second')
+        url = limited.url + '/data/winkelinformatie/winkels/json'
+        start = time.time()
+        for _ in range(50):
+            limited.session.get(url)
+        # the bucket starts full, the last 10 requests wait for tokens
+        self.assertGreaterEqual(time.time() - start, 0.2)
+        start = time.time()
+        for _ in range(20):
+            other.session.get(url)
+        self.assertLess(time.time() - start, 0.2)
+
+    def test_map_isolates_errors(self):
+        pool = ServerPool(transport=self.fake)
+        pool.add('first@example.com', 'first')
+        pool.add('second@example.com', 'wrong')
+        pool['first@example.com'].shopping_cart.add_item_by_id('wi1')
+        results = pool.contents()
+        self.assertEqual(list(results),
+                         ['first@example.com', 'second@example.com'])
+        first = results['first@example.com']
+        self.assertIsNone(first.error)
+        self.assertEqual([item.id for item in first.result], ['wi1'])
+        second = results['second@example.com']
+        self.assertIsNone(second.result)
+        self.assertIsInstance(second.error, InvalidCredentials)
+
+
+class TestInstrumentation(FakeServerTestCase):
+
+    def test_requests_and_retries_are_recorded(self):
+        instrumentation = Instrumentation()
+        server = Server(USERNAME, PASSWORD, transport=self.fake,
+                        instrumentation=instrumentation,
+                        retry_policy=RetryPolicy(backoff_factor=0,
+                                                 jitter=False))
+        add_item = self.fake._add_item
+        responses = []
+
+        def unavailable_once(request, username):
+            responses.append(request)
+            if len(responses) == 1:
+                return build_response(request, 503)
+            return add_item(request, username)
+
+        with mock.patch.object(self.fake, '_add_item', unavailable_once):
+            self.assertTrue(server.shopping_cart.add_item_by_id('wi1'))
+        metrics = instrumentation.as_dict()
+        login = metrics['POST /mijn/inloggen/basis']
+        self.assertEqual(login['statuses'], {302: 1})
+        self.assertGreater(login['request_bytes'], 0)
+        items = metrics['POST /service/rest/shoppinglists/{id}/items']
+        self.assertEqual((items['count'], items['statuses'],
+                          items['retries']), (2, {503: 1, 200: 1}, 1))
+        self.assertEqual(items['buckets'][float('inf')], 2)
+        self.assertGreater(items['response_bytes'], 0)
+        self.assertEqual(sum(endpoint['count']
+                             for endpoint in metrics.values()),
+                         self.fake.requests)
+
+    def test_latency_buckets(self):
+        instrumentation = Instrumentation(buckets=(0.1, 0.01))
+        for duration in (0.005, 0.01, 0.05, 5):
+            instrumentation.record('GET /x', 200, duration)
+        metrics = instrumentation.as_dict()['GET /x']
+        self.assertEqual(list(metrics['buckets'].items()),
+                         [(0.01, 2), (0.1, 3), (float('inf'), 4)])
+        self.assertAlmostEqual(metrics['duration'], 5.065)
+
+    def test_span_callback(self):
+        spans = []
+        instrumentation = Instrumentation(span_callback=spans.append)
+        server = Server(USERNAME, PASSWORD, transport=self.fake,
+                        instrumentation=instrumentation)
+        self.assertEqual(len(server.stores), len(STORES))
+        span = spans[-1]
+        self.assertEqual((span['endpoint'], span['method'], span['status']),
+                         ('GET /data/winkelinformatie/winkels/json', 'GET',
+                          200))
+        self.assertGreater(span['response_bytes'], 0)
+        self.assertLessEqual(span['start'] + span['duration'], time.time())
+
+    def test_failing_span_callback_is_ignored(self):
+        def failing(span):
+            raise ValueError(span)
+
+        instrumentation = Instrumentation(span_callback=failing)
+        server = Server(USERNAME, PASSWORD, transport=self.fake,
+                        instrumentation=instrumentation)
+        self.assertEqual(len(server.stores), len(STORES))
+        self.assertEqual(instrumentation.as_dict()[
+            'GET /data/winkelinformatie/winkels/json']['count'], 1)
+
+    def test_endpoint_names(self):
+        self.assertEqual(endpoint_name('PATCH', 'https://www.ah.nl/service/'
+                                                'rest/shoppinglists/0/items/'
+                                                '123'),
+                         'PATCH /service/rest/shoppinglists/{id}/items/{id}')
+        self.assertEqual(endpoint_name('GET', 'https://www.ah.nl/service/'
+                                              'rest/delegate?url=/producten/'
+                                              'product/wi12&x=1'),
+                         'GET /service/rest/delegate?url=/producten/product/'
+                         '{id}')
+
+    def test_prometheus(self):
+        instrumentation = Instrumentation(buckets=(0.1,))
+        instrumentation.record('GET /"x"', 200, 0.05, 10, 20)
+        instrumentation.record_retry('GET /"x"')
+        lines = instrumentation.to_prometheus(prefix='ah').splitlines()
+        for line in ('# TYPE ah_request_duration_seconds histogram',
+                     'ah_request_duration_seconds_bucket'
+                     '{endpoint="GET /\\"x\\"",le="0.1"} 1',
+                     'ah_request_duration_seconds_bucket'
+                     '{endpoint="GET /\\"x\\"",le="+Inf"} 1',
+                     'ah_requests_total'
+                     '{endpoint="GET /\\"x\\"",status="200"} 1',
+                     'ah_request_bytes_total{endpoint="GET /\\"x\\""} 10',
+                     'ah_retries_total{endpoint="GET /\\"x\\""} 1'):
+            self.assertIn(line, lines)
+
+
+class TestRetryPolicy(FakeServerTestCase):
+
+    @staticmethod
+    def response(status, headers=()):
+        request = Request('POST', 'https://www.ah.nl/items').prepare()
+        return build_response(request, status, headers)
+
+    def test_retry_after_is_honoured(self):
+        policy = RetryPolicy(max_backoff=10)
+        self.assertEqual(policy.backoff(0, self.response(
+            503, [('Retry-After', '7')])), 7)
+        self.assertEqual(policy.backoff(0, self.response(
+            429, [('Retry-After', '60')])), 10)
+        policy = RetryPolicy(backoff_factor=1, jitter=False)
+        # dates are not supported and fall back to the exponential delay
+        self.assertEqual(policy.backoff(2, self.response(
+            503, [('Retry-After', 'Wed, 21 Oct 2015 07:28:00 GMT')])), 4)
+
+    def test_backoff_is_capped(self):
+        policy = RetryPolicy(backoff_factor=1, max_backoff=5, jitter=False)
+        self.assertEqual([policy.backoff(attempt) for attempt in range(5)],
+                         [1, 2, 4, 5, 5])
+        policy = RetryPolicy(backoff_factor=1, max_backoff=5)
+        for attempt in range(10):
+            self.assertTrue(0 <= policy.backoff(attempt) <= 5)
+
+    def test_is_retryable(self):
+        policy = RetryPolicy()
+        self.assertTrue(policy.is_retryable('POST',
+                                            response=self.response(503)))
+        self.assertTrue(policy.is_retryable('POST',
+                                            response=self.response(429)))
+        self.assertFalse(policy.is_retryable('POST',
+                                             response=self.response(500)))
+        self.assertTrue(policy.is_retryable('GET',
+                                            response=self.response(500)))
+        self.assertFalse(policy.is_retryable('GET',
+                                             response=self.response(404)))
+        self.assertTrue(policy.is_retryable('POST', error=ConnectTimeout()))
+        self.assertFalse(policy.is_retryable('POST', error=ReadTimeout()))
+        self.assertTrue(policy.is_retryable('GET', error=ReadTimeout()))
+
+    def test_retry_waits_for_retry_after(self):
+        add_item = self.fake._add_item
+        responses = []
+
+        def unavailable_once(request, username):
+            responses.append(request)
+            if len(responses) == 1:
+                return build_response(request, 503, [('Retry-After', '7')])
+            return add_item(request, username)
+
+        with mock.patch.object(self.fake, '_add_item', unavailable_once), \
+                mock.patch.object(mijnahlibmodule.time, 'sleep') as sleep:
+            self.assertTrue(self.server.shopping_cart.add_item_by_id('wi1'))
+        sleep.assert_called_once_with(7.0)
+        self.assertEqual(self.cart_quantities(), {('product', 'wi1'): 1})
+
+    def test_session_expiring_during_a_retry_is_renewed(self):
+        add_item = self.fake._add_item
+        responses = []
+
+        def expiring(request, username):
+            responses.append(request)
+            if len(responses) == 1:
+                self.fake._sessions.clear()
+                return build_response(request, 503)
+            return add_item(request, username)
+
+        self.server.retry_policy = RetryPolicy(backoff_factor=0)
+        with mock.patch.object(self.fake, '_add_item', expiring):
+            self.assertTrue(self.server.shopping_cart.add_item_by_id('wi1'))
+        self.assertEqual(self.cart_quantities(), {('product', 'wi1'): 1})
+        self.assertEqual(len(self.fake._sessions), 1)
+
+    def test_rejected_session_is_renewed_only_once(self):
+        def rejecting(request, username):
+            return build_response(request, 401)
+
+        with mock.patch.object(self.fake, '_add_item', rejecting):
+            self.assertFalse(self.server.shopping_cart.add_item_by_id('wi1'))
+        # the first login and a single renewal
+        self.assertEqual(len(self.fake._sessions), 2)
+
+
+class TestCircuitBreaker(FakeServerTestCase):
+
+    def test_open_half_open_and_closed(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+        breaker.failure('GET /x')
+        breaker.before('GET /x')
+        breaker.failure('GET /x')
+        self.assertTrue(breaker.is_open('GET /x'))
+        self.assertRaises(CircuitOpenError, breaker.before, 'GET /x')
+        breaker.before('GET /y')
+        time.sleep(0.06)
+        # a single trial request is let through
+        breaker.before('GET /x')
+        self.assertRaises(CircuitOpenError, breaker.before, 'GET /x')
+        breaker.failure('GET /x')
+        self.assertRaises(CircuitOpenError, breaker.before, 'GET /x')
+        time.sleep(0.06)
+        breaker.before('GET /x')
+        breaker.success('GET /x')
+        self.assertFalse(breaker.is_open('GET /x'))
+        breaker.before('GET /x')
+
+    def test_success_resets_the_failures(self):
+        breaker = CircuitBreaker(failure_threshold=2)
+        breaker.failure('GET /x')
+        breaker.success('GET /x')
+        breaker.failure('GET /x')
+        self.assertFalse(breaker.is_open('GET /x'))
+
+    def test_failing_endpoint_is_cut_off(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        server = Server(USERNAME, PASSWORD, transport=self.fake,
+                        retry_policy=RetryPolicy(max_retries=0),
+                        circuit_breaker=breaker)
+
+        def unavailable(request, username):
+            return build_response(request, 503)
+
+        with mock.patch.object(self.fake, '_add_item', unavailable):
+            for _ in range(2):
+                self.assertFalse(server.shopping_cart.add_item_by_id('wi1'))
+            requests = self.fake.requests
+            with self.assertRaises(CircuitOpenError):
+                server.shopping_cart.add_item_by_id('wi1')
+        self.assertEqual(self.fake.requests, requests)
+        # other endpoints are not affected
+        self.assertEqual(len(server.stores), len(STORES))
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'orders.checkpoint')
+
+    def test_progress_is_resumed(self):
+        checkpoint = Checkpoint(self.path)
+        checkpoint.mark_done([3, 4], 0)
+        checkpoint.mark_done([1, 2], 4)
+        checkpoint.mark_done([7], 4)
+        resumed = Checkpoint(self.path)
+        self.assertEqual((resumed.watermark, resumed.done), (4, {7}))
+        self.assertTrue(resumed.is_done(2))
+        self.assertFalse(resumed.is_done(5))
+
+    def test_stalled_watermark_appends(self):
+        checkpoint = Checkpoint(self.path)
+        # line 1 keeps failing so the watermark never moves
+        for start in range(2, 20002, 50):
+            checkpoint.mark_done(range(start, start + 50), 0)
+        sizes = []
+        for start in range(20002, 20502, 50):
+            checkpoint.mark_done(range(start, start + 50), 0)
+            sizes.append(os.path.getsize(self.path))
+        growth = [after - before for before, after in zip(sizes, sizes[1:])]
+        self.assertTrue(all(0 < size < 1000 for size in growth))
+        resumed = Checkpoint(self.path)
+        self.assertEqual(resumed.done, set(range(2, 20502)))
+        self.assertFalse(resumed.is_done(1))
+
+    def test_compacted_once_the_watermark_moves(self):
+        checkpoint = Checkpoint(self.path)
+        for start in range(2, 3002, 50):
+            checkpoint.mark_done(range(start, start + 50), 0)
+        checkpoint.mark_done([1], 3001)
+        checkpoint.mark_done([3005], 3001)
+        with open(self.path) as saved:
+            self.assertEqual(len(saved.readlines()), 2)
+        resumed = Checkpoint(self.path)
+        self.assertEqual((resumed.watermark, resumed.done), (3001, {3005}))
+
+    def test_partial_entry_is_ignored(self):
+        Checkpoint(self.path).mark_done([1, 2], 2)
+        with open(self.path, 'a') as checkpoint:
+            checkpoint.write('{"watermark": 5, "do')
+        self.assertEqual(Checkpoint(self.path).watermark, 2)
+
+
+class TestOrderImport(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.accounts = {'first@example.com': 'first',
+                         'second@example.com': 'second'}
+        self.fake = FakeServer(self.accounts)
+        self.orders = self.write('orders.csv',
+                                 'account,item,quantity\n'
+                                 'first@example.com,wi1,2\n'
+                                 'second@example.com,melk,\n'
+                                 'first@example.com,wi2,1\n'
+                                 'first@example.com,wi3,1\n'
+                                 'second@example.com,wi1,3\n'
+                                 'first@example.com,wi1,1\n')
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as output:
+            output.write(text)
+        return path
+
+    def importer(self, checkpoint=None):
+        pool = ServerPool(transport=self.fake)
+        self.addCleanup(pool.close)
+        return OrderImporter(pool, self.accounts, checkpoint, batch_size=2)
+
+    def quantities(self, account):
+        return {key: entry['quantity']
+                for key, entry in self.fake.carts[account].items()}
+
+    def test_read_orders(self):
+        self.assertEqual(list(read_orders(self.orders))[:2],
+                         [(2, 'first@example.com', 'wi1', 2),
+                          (3, 'second@example.com', 'melk', 1)])
+        orders = self.write('orders.jsonl',
+                            '{"account": "first@example.com", '
+                            '"item": "wi1", "quantity": 2}\n\n'
+                            '{"account": "first@example.com"}\n'
+                            '{"account": "second@example.com", '
+                            '"item": " melk "}\n')
+        self.assertEqual(list(read_orders(orders)),
+                         [(1, 'first@example.com', 'wi1', 2),
+                          (4, 'second@example.com', 'melk', 1)])
+
+    def test_import(self):
+        statistics = self.importer().run(read_orders(self.orders))
+        self.assertEqual([statistics[key] for key
+                          in ('lines', 'skipped', 'added', 'failed')],
+                         [6, 0, 6, 0])
+        self.assertEqual(self.quantities('first@example.com'),
+                         {('product', 'wi1'): 3, ('product', 'wi2'): 1,
+                          ('product', 'wi3'): 1})
+        self.assertEqual(self.quantities('second@example.com'),
+                         {('unspecified', 'melk'): 1, ('product', 'wi1'): 3})
+
+    def test_import_resumes_after_a_partial_run(self):
+        path = os.path.join(self.directory, 'orders.checkpoint')
+        add_item = self.fake._add_item
+
+        def rejecting(request, username):
+            if b'wi2' in request.body:
+                return build_response(request, 400)
+            return add_item(request, username)
+
+        with mock.patch.object(self.fake, '_add_item', rejecting):
+            statistics = self.importer(Checkpoint(path)).run(
+                read_orders(self.orders))
+        self.assertEqual((statistics['added'], statistics['failed']), (5, 1))
+        checkpoint = Checkpoint(path)
+        self.assertEqual(checkpoint.watermark, 3)
+        self.assertFalse(checkpoint.is_done(4))
+        statistics = self.importer(checkpoint).run(read_orders(self.orders))
+        self.assertEqual([statistics[key] for key
+                          in ('lines', 'skipped', 'added', 'failed')],
+                         [6, 5, 1, 0])
+        # the lines added by the first run are not added again
+        self.assertEqual(self.quantities('first@example.com'),
+                         {('product', 'wi1'): 3, ('product', 'wi2'): 1,
+                          ('product', 'wi3'): 1})
+        checkpoint = Checkpoint(path)
+        self.assertTrue(all(checkpoint.is_done(number)
+                            for number in range(2, 8)))
+
+    def test_failing_orders_are_not_checkpointed(self):
+        path = os.path.join(self.directory, 'orders.checkpoint')
+        self.accounts['second@example.com'] = 'wrong'
+        orders = self.write('more.csv',
+                            'account,item,quantity\n'
+                            'first@example.com,wi1,1\n'
+                            'second@example.com,wi1,1\n'
+                            'third@example.com,wi1,1\n'
+                            'first@example.com,wi2,1\n')
+        statistics = self.importer(Checkpoint(path)).run(read_orders(orders))
+        self.assertEqual((statistics['added'], statistics['failed']), (2, 2))
+        checkpoint = Checkpoint(path)
+        self.assertEqual([number for number in range(2, 6)
+                          if checkpoint.is_done(number)], [2, 5])
+
+    def test_main(self):
+        accounts = self.write('accounts.json', json.dumps(self.accounts))
+        with mock.patch.object(HTTPAdapter, 'send',
+                               side_effect=self.fake.send), \
+                mock.patch.object(mijnahlibcli, '_report') as report:
+            status = mijnahlibcli.main(['--log-level', 'error', 'import',
+                                        self.orders, '--accounts', accounts,
+                                        '--batch-size', '2'])
+        self.assertEqual(status, 0)
+        self.assertEqual(report.call_args[0][0]['added'], 6)
+        self.assertEqual(len(self.fake.carts['second@example.com']), 2)
+
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.cassette = os.path.join(directory, 'cassette.json')
+        self.fake = FakeServer(ACCOUNTS, stores=STORES)
+        self.fake.carts[USERNAME][('product', 'wi7')] = {'id': 'entry',
+                                                         'quantity': 2}
+        recorder = RecordingAdapter(self.cassette)
+        with mock.patch.object(HTTPAdapter, 'send',
+                               side_effect=self.fake.send):
+            server = Server(USERNAME, PASSWORD, transport=recorder)
+            server.shopping_cart.contents
+            server.stores
+        recorder.save()
+
+    def test_cassette_is_replayed(self):
+        server = Server(USERNAME, PASSWORD,
+                        transport=ReplayAdapter(self.cassette))
+        contents = server.shopping_cart.contents
+        self.assertEqual([(item.id, item.quantity) for item in contents],
+                         [('wi7', 2)])
+        self.assertEqual(len(server.stores), len(STORES))
+        self.assertIn('fake_session', server.session.cookies.keys())
+
+    def test_cassette_is_json(self):
+        with open(self.cassette) as cassette:
+            interactions = json.load(cassette)['interactions']
+        self.assertTrue(any(interaction['request']['method'] == 'POST'
+                            for interaction in interactions))
+
+    def test_unrecorded_request_fails(self):
+        from requests.exceptions import ConnectionError as RequestsError
+        server = Server(USERNAME, PASSWORD,
+                        transport=ReplayAdapter(self.cassette))
+        with self.assertRaises(RequestsError):
+            server.shopping_cart.add_item_by_id('wi1')
+
+
+@unittest.skipIf(asyncio is None or httpx is None,
+                 'asyncio and httpx are needed')
+class TestAsyncServer(unittest.TestCase):
+
+    def setUp(self):
+        from mijnahlib.mijnahlibasync import async_transport
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.addCleanup(self.loop.close)
+        self.fake = FakeServer(ACCOUNTS, stores=STORES)
+        self.transport = async_transport(self.fake)
+        self.server = self.async_server()
+
+    def async_server(self, password=PASSWORD, **kwargs):
+        from mijnahlib import AsyncServer
+        server = AsyncServer(USERNAME, password, transport=self.transport,
+                             **kwargs)
+        self.addCleanup(self.run_until_complete, server.aclose())
+        return server
+
+    def run_until_complete(self, awaitable):
+        return self.loop.run_until_complete(awaitable)
+
+    def cart_quantities(self):
+        return {key: entry['quantity']
+                for key, entry in self.fake.carts[USERNAME].items()}
+
+    def test_add_items_and_contents(self):
+        results = self.run_until_complete(self.server.shopping_cart.add_items(
+            [('wi1', 1), ('melk', 1), ('wi1', 2)]))
+        self.assertEqual([(result.item, result.quantity, result.success)
+                          for result in results],
+                         [('wi1', 3, True), ('melk', 1, True)])
+        contents = self.run_until_complete(self.server.shopping_cart.contents)
+        self.assertEqual([(item.description, item.quantity)
+                          for item in contents],
+                         [('Product 1', 3), ('melk', 1)])
+
+    def test_concurrent_requests_log_in_once(self):
+        cart = self.server.shopping_cart
+        self.run_until_complete(asyncio.gather(
+            *[cart.add_item_by_id('wi{}'.format(number))
+              for number in range(10)]))
+        self.assertEqual(len(self.fake._sessions), 1)
+        self.assertEqual(len(self.fake.carts[USERNAME]), 10)
+
+    def test_expired_session_is_renewed(self):
+        cart = self.server.shopping_cart
+        self.run_until_complete(cart.add_item_by_id('wi1'))
+        self.fake._sessions.clear()
+        self.assertTrue(self.run_until_complete(cart.add_item_by_id('wi1')))
+        self.assertEqual(self.cart_quantities(), {('product', 'wi1'): 2})
+
+    def test_invalid_credentials(self):
+        from mijnahlib import AsyncServer
+        with self.assertRaises(InvalidCredentials):
+            self.run_until_complete(AsyncServer.create(
+                USERNAME, 'wrong', transport=self.transport))
+
+    def test_stores(self):
+        stores = self.run_until_complete(self.server.stores)
+        self.assertEqual(len(stores), len(STORES))
+        self.assertIs(self.run_until_complete(self.server.stores), stores)
+
+    def test_concurrent_store_lookups_share_a_request(self):
+        results = self.run_until_complete(asyncio.gather(
+            *[self.server.stores for _ in range(5)]))
+        self.assertEqual(self.fake.requests, 1)
+        self.assertTrue(all(stores is results[0] for stores in results))
+
+    def test_failed_store_lookup_raises(self):
+        server = self.async_server(retry_policy=RetryPolicy(max_retries=0))
+        self.fake.error_rate = 1
+        with self.assertRaises(UnknownServerError):
+            self.run_until_complete(server.stores)
+        self.fake.error_rate = 0
+        self.assertEqual(len(self.run_until_complete(server.stores)),
+                         len(STORES))
+
+    def test_store_cache_is_shared_with_servers(self):
+        cache = StoreDirectoryCache()
+        Server(USERNAME, PASSWORD, transport=self.fake,
+               store_cache=cache).stores
+        server = self.async_server(store_cache=cache)
+        self.assertEqual(len(self.run_until_complete(server.stores)),
+                         len(STORES))
+        self.assertEqual(cache.statistics,
+                         {'hits': 1, 'misses': 1, 'revalidations': 0})
+
+    def test_stored_session_is_resumed(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        store = SessionStore(directory)
+        Server(USERNAME, PASSWORD, session_store=store,
+               transport=self.fake).shopping_cart.contents
+        server = self.async_server(session_store=store)
+        self.run_until_complete(server.shopping_cart.add_item_by_id('wi1'))
+        self.assertEqual(len(self.fake._sessions), 1)
+        self.fake._sessions.clear()
+        server = self.async_server(session_store=store)
+        self.run_until_complete(server.shopping_cart.add_item_by_id('wi1'))
+        self.assertEqual(len(self.fake._sessions), 1)
+        self.assertEqual(self.cart_quantities(), {('product', 'wi1'): 2})
+
+    def test_descriptions_are_resolved(self):
+        resolver = DescriptionResolver()
+        resolver.add('wi12', u'Halfvolle melk')
+        cart = self.async_server(resolver=resolver).shopping_cart
+        self.assertTrue(self.run_until_complete(
+            cart.add_item_by_description('halfvolle  MELK', resolve=True)))
+        results = self.run_until_complete(cart.add_items(
+            [('Halfvolle melk', 1), ('brood', 1)], resolve=True))
+        self.assertEqual([result.item for result in results],
+                         ['wi12', 'brood'])
+        self.run_until_complete(cart.add_item_by_description('melk'))
+        self.assertEqual(self.cart_quantities(),
+                         {('product', 'wi12'): 2,
+                          ('unspecified', 'brood'): 1,
+                          ('unspecified', 'melk'): 1})
+
+    def test_requests_are_instrumented(self):
+        instrumentation = Instrumentation()
+        server = self.async_server(
+            instrumentation=instrumentation,
+            retry_policy=RetryPolicy(backoff_factor=0, jitter=False))
+        add_item = self.fake._add_item
+        responses = []
+
+        def unavailable_once(request, username):
+            responses.append(request)
+            if len(responses) == 1:
+                return build_response(request, 503)
+            return add_item(request, username)
+
+        with mock.patch.object(self.fake, '_add_item', unavailable_once):
+            self.assertTrue(self.run_until_complete(
+                server.shopping_cart.add_item_by_id('wi1')))
+        metrics = instrumentation.as_dict()
+        login = metrics['POST /mijn/inloggen/basis']
+        self.assertEqual(login['statuses'], {302: 1})
+        self.assertGreater(login['request_bytes'], 0)
+        self.assertEqual(metrics['GET /mijn/welkom']['statuses'], {200: 1})
+        items = metrics['POST /service/rest/shoppinglists/{id}/items']
+        self.assertEqual((items['statuses'], items['retries']),
+                         ({503: 1, 200: 1}, 1))